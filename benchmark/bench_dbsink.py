@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+"""
+Rows/sec written to a files db: ORM session.add (the old IndexFiles path) versus BulkSink.
+Run from the repository root: python -m benchmark.bench_dbsink
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from db import Base, create_sqlite_engine
+from db.filesdb import FilesDb
+from db.sink import BulkSink
+
+
+def make_row(i):
+    return dict(
+        path="/archive/photos/%04d/%02d/IMG_%07d.JPG" % (2000 + i % 20, i % 12 + 1, i),
+        size=1000000 + i,
+        date=str(1500000000.0 + i),
+        hash="%0128x" % (i * 2654435761),
+        camera="Canon EOS 5D Mark III",
+        lens="[24, 105, 4, 4]",
+        exp_time="[1/200]",
+        exp_fnum="[8]",
+        exp_iso="[400]",
+        focal_length="[50]",
+        flash="[16]",
+        mtime_ns=1500000000000000000 + i,
+        inode=i,
+        missing=False
+    )
+
+
+def bench_orm(db_file, rows, commit_every):
+    """
+    Same as the old IndexFiles.db_insert: one ORM object per row, a commit every commit_every rows
+    (the old 5 second timer)
+    """
+    engine = create_engine('sqlite:///' + db_file)
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+
+    start = time.perf_counter()
+    for i in range(rows):
+        session.add(FilesDb(**make_row(i)))
+        if (i + 1) % commit_every == 0:
+            session.commit()
+    session.commit()
+    return time.perf_counter() - start
+
+
+def bench_sink(db_file, rows, batch_rows):
+    engine = create_sqlite_engine(db_file)
+    Base.metadata.create_all(engine)
+    sink = BulkSink(engine, FilesDb.__table__, batch_rows)
+
+    start = time.perf_counter()
+    for i in range(rows):
+        sink.add(make_row(i))
+    sink.flush()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the ORM insert path with the bulk sink")
+
+    parser.add_argument('--rows', help='Rows to insert', type=int, default=200000)
+    parser.add_argument('--batch', help='Rows per transaction, used for both paths', type=int, default=5000)
+    parser.add_argument('--dir', help='Where to create the test databases', default=None)
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        for name, bench in (("orm", bench_orm), ("sink", bench_sink)):
+            elapsed = bench(os.path.join(tmp, name + ".db"), args.rows, args.batch)
+            print("%-5s %9d rows in %7.2fs = %10.0f rows/sec" % (name, args.rows, elapsed, args.rows / elapsed))
@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+"""
+EXIF extraction speed: exifread (details=True, what ExifInfo used) versus fileinfo.fastexif, for the ExifInfo
+fields and for the DateTimeDigitized lookup of the date tools. Checks that both give the same output.
+Without --corpus, a synthetic corpus (JPEG, CR2, NEF, TIFF and files without EXIF) is generated.
+Run from the repository root: python -m benchmark.bench_exif
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+import exifread
+
+from fileinfo import ExifInfo
+from fileinfo.fastexif import exif_values, read_tags, Unsupported
+from benchmark.synthetic import make_corpus
+
+DATE_TAG = "EXIF DateTimeDigitized"
+
+
+def old_date(path):
+    with open(path, "rb") as f:
+        tags = exifread.process_file(f, details=False)
+    return tags[DATE_TAG].values if DATE_TAG in tags else None
+
+
+def new_date(path):
+    with open(path, "rb") as f:
+        found, tags = exif_values(f, [DATE_TAG], details=False)
+    return tags.get(DATE_TAG)
+
+
+def supported(path):
+    with open(path, "rb") as f:
+        try:
+            read_tags(f, [DATE_TAG])
+            return True
+        except Unsupported:
+            return False
+
+
+def timed(function, paths):
+    start = time.perf_counter()
+    results = [function(path) for path in paths]
+    return time.perf_counter() - start, results
+
+
+def list_corpus(folder):
+    paths = []
+    for root, dirs, files in os.walk(folder):
+        paths.extend(os.path.join(root, f) for f in files)
+    return sorted(paths)
+
+
+def run(paths):
+    print("%d files, %d handled by the fast parser" % (len(paths), sum(supported(path) for path in paths)))
+
+    benches = [
+        ("ExifInfo", lambda path: ExifInfo(path, fast=False).getinfo(), lambda path: ExifInfo(path).getinfo()),
+        ("date", old_date, new_date),
+    ]
+    for name, old, new in benches:
+        old_time, old_results = timed(old, paths)
+        new_time, new_results = timed(new, paths)
+        mismatches = [path for path, a, b in zip(paths, old_results, new_results) if a != b]
+        print("%-9s exifread %8.0f files/s   fast %8.0f files/s   x%.1f   %d mismatches" %
+              (name, len(paths) / old_time, len(paths) / new_time, old_time / new_time, len(mismatches)))
+        for path in mismatches[:10]:
+            print("    " + path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare exifread with the fast EXIF parser")
+
+    parser.add_argument('--corpus', help='Folder with the files to read. Default: synthetic files', default=None)
+    parser.add_argument('--files', help='Number of synthetic files', type=int, default=3000)
+    parser.add_argument('--size', help='Size of the synthetic files', type=int, default=256 * 1024)
+    parser.add_argument('--dir', help='Where to create the synthetic files', default=None)
+
+    args = parser.parse_args()
+
+    # exifread warns about every file without EXIF
+    logging.getLogger("exifread").setLevel(logging.ERROR)
+
+    if args.corpus is not None:
+        run(list_corpus(args.corpus))
+    else:
+        with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+            run(make_corpus(tmp, args.files, args.size))
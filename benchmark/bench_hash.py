@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+"""
+Hashing throughput (MB/s) per file size, algorithm and read method:
+ - iter: the old HashFile loop, iter(lambda: f.read(bsize), b""), a new bytes object per block
+ - readinto: HashFile.hashStream, one reused buffer
+ - mmap: the whole file mapped, used by HashFile for big files
+Files are read once before timing, so this measures the page cache, not the disk.
+Run from the repository root: python -m benchmark.bench_hash
+"""
+import argparse
+import mmap
+import os
+import tempfile
+import time
+
+from fileinfo.hash import HashFile, ALGORITHMS
+
+SIZES = [4 * 1024, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024, 256 * 1024 * 1024]
+
+
+def read_iter(hasher, path):
+    file_hash = hasher.hash_func()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(hasher.hash_bsize), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def read_into(hasher, path):
+    file_hash = hasher.hash_func()
+    with open(path, "rb", buffering=0) as f:
+        hasher.hashStream(f, file_hash)
+    return file_hash.hexdigest()
+
+
+def read_mmap(hasher, path):
+    file_hash = hasher.hash_func()
+    with open(path, "rb", buffering=0) as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            file_hash.update(mapped)
+    return file_hash.hexdigest()
+
+
+METHODS = {"iter": read_iter, "readinto": read_into, "mmap": read_mmap}
+
+
+def make_file(folder, size):
+    path = os.path.join(folder, "bench_%d.bin" % size)
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            chunk = min(remaining, 16 * 1024 * 1024)
+            f.write(os.urandom(chunk))
+            remaining -= chunk
+    return path
+
+
+def bench(method, hasher, path, size, min_bytes):
+    """
+    :return: MB/s, hashing the file as many times as needed to read at least min_bytes
+    """
+    repeat = max(1, min_bytes // size)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        method(hasher, path)
+    elapsed = time.perf_counter() - start
+    return repeat * size / elapsed / (1024 * 1024)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hashing throughput per algorithm and read method")
+
+    parser.add_argument('--sizes', help='File sizes in bytes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--algorithms', help='Algorithms to test', nargs='+', choices=sorted(ALGORITHMS),
+                        default=sorted(ALGORITHMS))
+    parser.add_argument('--min-mb', help='Hash at least this many MB per measure', type=int, default=256)
+    parser.add_argument('--dir', help='Where to create the test files', default=None)
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        files = [(size, make_file(tmp, size)) for size in args.sizes]
+        # Warm the page cache
+        for size, path in files:
+            read_iter(HashFile(), path)
+
+        print("%-10s %12s" % ("algorithm", "size") + "".join("%12s" % name for name in METHODS))
+        for algorithm in args.algorithms:
+            hasher = HashFile(algorithm=algorithm)
+            for size, path in files:
+                results = [bench(method, hasher, path, size, args.min_mb * 1024 * 1024) for method in METHODS.values()]
+                print("%-10s %12d" % (algorithm, size) + "".join("%7.0f MB/s" % mbs for mbs in results))
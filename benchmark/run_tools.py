@@ -0,0 +1,297 @@
+#!/usr/bin/python3
+"""
+End to end benchmark of the tools on synthetic photo trees. Each tool runs as its own process, non-interactively,
+on a fresh copy of the tree (hard links, made before the clock starts), once per worker count.
+Recorded per run: wall time, files/s and MB/s over the whole tree, CPU time, and the peak RSS of the biggest
+process of the run (the tool or one of its workers). The results are appended to a JSON lines file together with
+the commit, so runs of different commits can be compared with --summary.
+The trees are kept in the work folder and reused: the page cache is warm unless a tree is bigger than the RAM.
+Run from the repository root: python -m benchmark.run_tools
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmark.synthetic import make_tree
+from utils.executors import EXECUTORS
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Name of the indexed folder in the reference db, given to hydra_synctodb as strippath
+REFERENCE_ROOT = "reference_root"
+
+
+def link_tree(source, destination, flatten=False):
+    """
+    Copy a tree with hard links, or plain copies if the file system does not support them
+    :param flatten: put all the files in destination itself
+    """
+    for root, dirs, files in os.walk(source):
+        folder = destination if flatten else os.path.join(destination, os.path.relpath(root, source))
+        os.makedirs(folder, exist_ok=True)
+        for file in files:
+            try:
+                os.link(os.path.join(root, file), os.path.join(folder, file))
+            except OSError:
+                shutil.copy2(os.path.join(root, file), os.path.join(folder, file))
+
+
+def index_tree(source, folder, db_file, skip_every=0):
+    """
+    Index a copy of a tree with hydra_indexfiles, untimed, for the tools reading a db
+    :param skip_every: leave one file out of skip_every, to get differences to compare
+    :return: db_file
+    """
+    copy = os.path.join(folder, REFERENCE_ROOT)
+    link_tree(source, copy)
+    if skip_every > 0:
+        for root, dirs, files in os.walk(copy):
+            for file in sorted(files)[::skip_every]:
+                os.unlink(os.path.join(root, file))
+
+    with open(os.path.join(folder, "index.log"), "w") as log:
+        subprocess.run([sys.executable, os.path.join(REPO, "hydra_indexfiles.py"), copy], cwd=folder,
+                       stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, check=True)
+    db_files = [file for file in os.listdir(copy) if file.startswith("files_") and file.endswith(".db")]
+    os.replace(os.path.join(copy, db_files[0]), db_file)
+    shutil.rmtree(copy)
+    return db_file
+
+
+class Tool():
+    """
+    How to run one tool on a copy of the tree
+    """
+    # Worker counts are ignored by the tool, it runs once
+    single_run = False
+    # The copy is flattened, every file in the root
+    flatten = False
+
+    def __init__(self, name, script):
+        self.name = name
+        self.script = script
+
+    def prepare(self, tree, folder):
+        """
+        Untimed setup shared by all the runs of a tree, done once
+        """
+        pass
+
+    def command(self, copy, workers):
+        """
+        :param copy: fresh copy of the tree
+        :return: (arguments after the script, working directory)
+        """
+        raise NotImplementedError
+
+
+class IndexFilesTool(Tool):
+    def command(self, copy, workers):
+        return [copy, "--workers", str(workers)], copy
+
+
+class DeleteDuplicatesTool(Tool):
+    def command(self, copy, workers):
+        return [copy, "--workers", str(workers), "--batch"], copy
+
+
+class MoveToDateFolderTool(Tool):
+    def command(self, copy, workers):
+        destination = copy + "_dated"
+        os.makedirs(destination, exist_ok=True)
+        return [copy, destination, "--workers", str(workers), "--batch"], copy
+
+
+class SyncToDbTool(Tool):
+    # All the files are moved back to the folders they have in the reference db
+    flatten = True
+
+    def prepare(self, tree, folder):
+        self.db_file = index_tree(tree, folder, os.path.join(folder, "reference.db"))
+
+    def command(self, copy, workers):
+        return [".", self.db_file, REFERENCE_ROOT, "--workers", str(workers)], copy
+
+
+class CompareDbTool(Tool):
+    single_run = True
+
+    def prepare(self, tree, folder):
+        self.db_file = index_tree(tree, os.path.join(folder, "source"), os.path.join(folder, "source.db"))
+        self.other_db_file = index_tree(tree, os.path.join(folder, "target"), os.path.join(folder, "target.db"),
+                                        skip_every=10)
+
+    def command(self, copy, workers):
+        return [self.db_file, self.other_db_file, "--report", os.path.join(copy, "compare.csv")], copy
+
+
+TOOLS = {tool.name: tool for tool in [
+    IndexFilesTool("indexfiles", "hydra_indexfiles.py"),
+    DeleteDuplicatesTool("deleteduplicates", "hydra_deleteduplicates.py"),
+    SyncToDbTool("synctodb", "hydra_synctodb.py"),
+    CompareDbTool("comparedb", "hydra_comparedb.py"),
+    MoveToDateFolderTool("movetodatefolder", "hydra_movetodatefolder.py"),
+]}
+
+
+def measure(command, cwd, log_file):
+    """
+    Run a command, with no stdin: a tool asking for input fails instead of waiting
+    :return: dict with returncode, wall_seconds, cpu_seconds and peak_rss_kb
+    """
+    with open(log_file, "w") as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=cwd, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+        # The usage of the child includes the children it waited for, the workers
+        pid, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    # kB on Linux, bytes on macOS
+    peak_rss_kb = usage.ru_maxrss // 1024 if sys.platform == "darwin" else usage.ru_maxrss
+    return {"returncode": process.returncode, "wall_seconds": wall,
+            "cpu_seconds": usage.ru_utime + usage.ru_stime, "peak_rss_kb": peak_rss_kb}
+
+
+def git_commit():
+    """
+    :return: (commit, True if the working tree has changes), (None, False) outside of git
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO,
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+    return commit, len(status.strip()) > 0
+
+
+def run(args):
+    commit, dirty = git_commit()
+    os.makedirs(args.work_dir, exist_ok=True)
+
+    for layout in args.layouts:
+        tree_args = {"no_files": args.files, "sizes": args.sizes, "duplicates": args.duplicates,
+                     "no_exif": args.no_exif, "layout": layout, "depth": args.depth, "fanout": args.fanout,
+                     "seed": args.seed}
+        tree_name = "tree_" + hashlib.sha1(json.dumps(tree_args, sort_keys=True).encode()).hexdigest()[:12]
+        tree = os.path.join(args.work_dir, tree_name)
+        print("Tree " + tree + " " + json.dumps(tree_args))
+        built = make_tree(tree, **tree_args)
+
+        run_dir = tempfile.mkdtemp(prefix="run_", dir=args.work_dir)
+        for name in args.tools:
+            tool = TOOLS[name]
+            tool_dir = os.path.join(run_dir, name)
+            os.makedirs(tool_dir)
+            tool.prepare(tree, tool_dir)
+
+            for workers in args.workers[:1] if tool.single_run else args.workers:
+                for repeat in range(args.repeat):
+                    copy = os.path.join(tool_dir, "w" + str(workers) + "_" + str(repeat))
+                    link_tree(tree, copy, tool.flatten)
+                    arguments, cwd = tool.command(copy, workers)
+                    if args.executor is not None and tool.single_run is False:
+                        arguments += ["--executor", args.executor]
+                    log_file = copy + ".log"
+                    result = measure([sys.executable, os.path.join(REPO, tool.script)] + arguments, cwd, log_file)
+
+                    record = {
+                        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+                        "commit": commit, "dirty": dirty, "host": platform.node(), "cpus": os.cpu_count(),
+                        "python": platform.python_version(), "tree": tree_name, "tree_args": tree_args,
+                        "tool": name, "workers": None if tool.single_run else workers, "repeat": repeat,
+                        "executor": None if tool.single_run else args.executor,
+                        "files": built["no_files"], "bytes": built["no_bytes"],
+                    }
+                    record.update(result)
+                    record["files_per_sec"] = built["no_files"] / result["wall_seconds"]
+                    record["mb_per_sec"] = built["no_bytes"] / 1e6 / result["wall_seconds"]
+                    with open(args.results, "a") as f:
+                        f.write(json.dumps(record) + "\n")
+
+                    print("%-8s %-17s workers %-4s %8.2fs %9.1f files/s %8.1f MB/s %8.0f MB peak" %
+                          (layout, name, "-" if tool.single_run else workers, result["wall_seconds"],
+                           record["files_per_sec"], record["mb_per_sec"], result["peak_rss_kb"] / 1024))
+                    if result["returncode"] != 0:
+                        print("    FAILED with code " + str(result["returncode"]) + ", see " + log_file)
+                    else:
+                        shutil.rmtree(copy)
+                        if os.path.isdir(copy + "_dated"):
+                            shutil.rmtree(copy + "_dated")
+                        if args.keep is False:
+                            os.unlink(log_file)
+
+        if args.keep is False:
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def summary(results_file):
+    """
+    Print the best files/s of each tree, tool and worker count, one column per commit
+    """
+    best = {}
+    commits = []
+    with open(results_file) as f:
+        for line in f:
+            record = json.loads(line)
+            if record["returncode"] != 0:
+                continue
+            commit = str(record["commit"]) + ("+" if record["dirty"] else "")
+            if commit not in commits:
+                commits.append(commit)
+            key = (record["tree"], record["tool"], record["workers"] or 0, record.get("executor") or "default")
+            best.setdefault(key, {})
+            best[key][commit] = max(best[key].get(commit, 0), record["files_per_sec"])
+
+    print("Best files/s per commit, + means uncommitted changes")
+    print("%-19s %-17s %7s %-8s " % ("tree", "tool", "workers", "executor") +
+          "".join("%12s" % commit for commit in commits))
+    for key in sorted(best):
+        tree, tool, workers, executor = key
+        cells = "".join("%12s" % ("%.1f" % best[key][commit] if commit in best[key] else "-") for commit in commits)
+        print("%-19s %-17s %7s %-8s " % (tree, tool, workers or "-", executor) + cells)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the tools on synthetic photo trees and record their speed")
+
+    parser.add_argument('--files', help='Files per tree', type=int, default=1000)
+    parser.add_argument('--sizes', help='File size distribution: fixed:SIZE, uniform:MIN:MAX or '
+                                        'lognormal:MEDIAN:SIGMA, sizes with K, M or G', default='lognormal:2M:0.6')
+    parser.add_argument('--duplicates', help='Share of the files that are copies of another one', type=float,
+                        default=0.1)
+    parser.add_argument('--no-exif', help='Share of the JPEGs without EXIF', type=float, default=0.2)
+    parser.add_argument('--layouts', help='Tree layouts to run', nargs='+', choices=['deep', 'flat'],
+                        default=['deep', 'flat'])
+    parser.add_argument('--depth', help='Folder levels of the deep layout', type=int, default=4)
+    parser.add_argument('--fanout', help='Folders per level of the deep layout', type=int, default=4)
+    parser.add_argument('--seed', help='Seed of the trees', type=int, default=0)
+    parser.add_argument('--tools', help='Tools to run', nargs='+', choices=list(TOOLS), default=list(TOOLS))
+    parser.add_argument('--workers', help='Worker counts to run each tool with', type=int, nargs='+',
+                        default=[1, 2, 4])
+    parser.add_argument('--executor', help='Executor of the tools, default: the one of each tool',
+                        choices=EXECUTORS, default=None)
+    parser.add_argument('--repeat', help='Runs per tool and worker count', type=int, default=1)
+    parser.add_argument('--work-dir', help='Where to keep the trees and the copies',
+                        default=os.path.join(tempfile.gettempdir(), "hydra_bench"))
+    parser.add_argument('--results', help='JSON lines file the results are appended to',
+                        default='bench_results.jsonl')
+    parser.add_argument('--keep', help='Keep the logs, dbs and reports of the runs', action='store_true')
+    parser.add_argument('--summary', help='Only print the results already in the results file',
+                        action='store_true')
+
+    args = parser.parse_args()
+
+    if args.summary is False:
+        run(args)
+    summary(args.results)
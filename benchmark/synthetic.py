@@ -0,0 +1,298 @@
+"""
+Synthetic image files with EXIF data, and trees of them, for the benchmarks. Only the metadata is realistic: the
+image data is random bytes.
+"""
+import json
+import os
+import random
+import struct
+import time
+
+# Field types
+ASCII, SHORT, LONG, RATIONAL, UNDEFINED = 2, 3, 4, 5, 7
+
+CAMERAS = [
+    ("Canon", "Canon EOS 5D Mark III"),
+    ("Canon", "Canon EOS R5"),
+    ("NIKON CORPORATION", "NIKON D750"),
+    ("NIKON CORPORATION", "NIKON Z 6"),
+    ("SONY", "ILCE-7M3"),
+    ("Apple", "iPhone 12"),
+]
+
+
+def pack_value(endian, field_type, value):
+    """
+    :return: (count, bytes) of a tag value
+    """
+    if field_type == ASCII:
+        data = value.encode() + b"\0"
+        return len(data), data
+    if field_type == UNDEFINED:
+        return len(value), value
+    if field_type == RATIONAL:
+        return len(value), b"".join(struct.pack(endian + "II", num, den) for num, den in value)
+    fmt = "H" if field_type == SHORT else "I"
+    return len(value), b"".join(struct.pack(endian + fmt, v) for v in value)
+
+
+def build_ifd(endian, entries, offset, next_ifd=0):
+    """
+    :param entries: list of (tag, field type, value)
+    :param offset: where the IFD will be, relative to the TIFF header
+    :return: bytes of the IFD followed by the values that do not fit in the entries
+    """
+    entries = sorted(entries)
+    data_offset = offset + 2 + 12 * len(entries) + 4
+    table = struct.pack(endian + "H", len(entries))
+    data = b""
+    for tag, field_type, value in entries:
+        count, packed = pack_value(endian, field_type, value)
+        if len(packed) <= 4:
+            table += struct.pack(endian + "HHI", tag, field_type, count) + packed.ljust(4, b"\0")
+        else:
+            table += struct.pack(endian + "HHII", tag, field_type, count, data_offset + len(data))
+            data += packed + (b"\0" if len(packed) % 2 else b"")
+    return table + struct.pack(endian + "I", next_ifd) + data
+
+
+def ifd_size(endian, entries):
+    return len(build_ifd(endian, entries, 0))
+
+
+def nikon_maker_note(lens):
+    """
+    Labeled type 2 Nikon maker note, with its own TIFF header. Offsets are relative to that header.
+    """
+    endian = ">"
+    entries = [(0x0001, UNDEFINED, b"0210"), (0x0084, RATIONAL, lens)]
+    return b"Nikon\0\x02\x10\0\0" + b"MM\0*" + struct.pack(">I", 8) + build_ifd(endian, entries, 8)
+
+
+def other_maker_note(endian, make, index):
+    """
+    Maker note of the other makers: an IFD, after the header some of them write. Only values that fit in the
+    entries, so that the offsets do not depend on where the note is.
+    """
+    entries = [(0x0001, SHORT, [index % 100]), (0x0010, LONG, [0x80000000 + index % 1000])]
+    if make == "SONY":
+        return b"SONY DSC \0\0\0" + build_ifd(endian, entries, 0)
+    if make == "Apple":
+        return b"Apple iOS\0\0\x01MM" + build_ifd(">", entries, 0)
+    return build_ifd(endian, entries, 0)
+
+
+def build_tiff(endian, index, date, camera, maker_note=True):
+    """
+    TIFF header, IFD0 and Exif IFD
+    """
+    make, model = camera
+    focal = 24 + index % 50
+    lens = [(240, 10), (700, 10), (28, 10), (28, 10)]
+    exif_entries = [
+        (0x829a, RATIONAL, [(1, 60 + index % 1000)]),
+        (0x829d, RATIONAL, [(28 + index % 60, 10)]),
+        (0x8827, SHORT, [100 * (1 + index % 64)]),
+        (0x9003, ASCII, date),
+        (0x9004, ASCII, date),
+        (0x9209, SHORT, [16]),
+        (0x920a, RATIONAL, [(focal * 10, 10)]),
+        (0xa432, RATIONAL, lens),
+    ]
+    if maker_note is True and make.startswith("NIKON"):
+        exif_entries.append((0x927c, UNDEFINED, nikon_maker_note([(focal * 10, 10)] + lens[1:])))
+    elif maker_note is True:
+        exif_entries.append((0x927c, UNDEFINED, other_maker_note(endian, make, index)))
+
+    image_entries = [(0x010f, ASCII, make), (0x0110, ASCII, model), (0x0132, ASCII, date),
+                     (0x8769, LONG, [0])]
+    exif_offset = 8 + ifd_size(endian, image_entries)
+    image_entries[-1] = (0x8769, LONG, [exif_offset])
+
+    # Nikon maker note offsets are relative to the note itself, the rest to the TIFF header
+    exif = build_ifd(endian, exif_entries, exif_offset)
+    header = (b"II*\0" if endian == "<" else b"MM\0*") + struct.pack(endian + "I", 8)
+    return header + build_ifd(endian, image_entries, 8) + exif
+
+
+def random_date(rng):
+    return "%04d:%02d:%02d %02d:%02d:%02d" % (rng.randint(2005, 2024), rng.randint(1, 12), rng.randint(1, 28),
+                                              rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59))
+
+
+def jpeg_file(index, size, rng, jfif=False):
+    camera = rng.choice(CAMERAS)
+    # Nikon writes everything big endian, the others vary
+    endian = "<" if index % 2 and not camera[0].startswith("NIKON") else ">"
+    tiff = build_tiff(endian, index, random_date(rng), camera)
+    app1 = b"Exif\0\0" + tiff
+    data = b"\xff\xd8"
+    if jfif is True:
+        data += b"\xff\xe0\x00\x10JFIF\0\x01\x01\x00\x00\x01\x00\x01\x00\x00"
+    data += b"\xff\xe1" + struct.pack(">H", len(app1) + 2) + app1
+    data += b"\xff\xdb" + struct.pack(">H", 67) + bytes(65)
+    return data + rng.randbytes(max(0, size - len(data) - 2)) + b"\xff\xd9"
+
+
+def jpeg_no_exif(index, size, rng):
+    """
+    JFIF only, like the pictures saved by an image editor or a messenger app
+    """
+    data = b"\xff\xd8\xff\xe0\x00\x10JFIF\0\x01\x01\x00\x00\x01\x00\x01\x00\x00"
+    data += b"\xff\xdb" + struct.pack(">H", 67) + bytes(65)
+    return data + rng.randbytes(max(0, size - len(data) - 2)) + b"\xff\xd9"
+
+
+def raw_file(index, size, rng, endian, make):
+    """
+    TIFF based raw file: CR2 style (little endian) or NEF style (big endian, Nikon maker note)
+    """
+    camera = rng.choice([camera for camera in CAMERAS if camera[0] == make])
+    tiff = build_tiff(endian, index, random_date(rng), camera)
+    return tiff + rng.randbytes(max(0, size - len(tiff)))
+
+
+def plain_file(index, size, rng):
+    return rng.randbytes(size)
+
+
+KINDS = {
+    "jpg": lambda index, size, rng: jpeg_file(index, size, rng),
+    "jfif.jpg": lambda index, size, rng: jpeg_file(index, size, rng, jfif=True),
+    "cr2": lambda index, size, rng: raw_file(index, size, rng, "<", "Canon"),
+    "nef": lambda index, size, rng: raw_file(index, size, rng, ">", "NIKON CORPORATION"),
+    "tif": lambda index, size, rng: raw_file(index, size, rng, "<", "SONY"),
+    "png": plain_file,
+    "noexif.jpg": jpeg_no_exif,
+}
+
+
+def make_corpus(folder, no_files, size=256 * 1024, kinds=None, seed=0):
+    """
+    Write no_files files cycling over the kinds
+    :return: list of paths
+    """
+    rng = random.Random(seed)
+    kinds = kinds or list(KINDS)
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for index in range(no_files):
+        kind = kinds[index % len(kinds)]
+        path = os.path.join(folder, "IMG_%06d.%s" % (index, kind.split(".")[-1].upper()))
+        with open(path, "wb") as f:
+            f.write(KINDS[kind](index, size, rng))
+        paths.append(path)
+    return paths
+
+
+def size_distribution(spec):
+    """
+    Parse a file size distribution:
+     - fixed:SIZE
+     - uniform:MIN:MAX
+     - lognormal:MEDIAN:SIGMA, the usual shape of a photo collection
+    Sizes take a K, M or G suffix.
+    :return: function rng -> size in bytes
+    """
+    def parse_size(text):
+        units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+        if text[-1].upper() in units:
+            return int(float(text[:-1]) * units[text[-1].upper()])
+        return int(text)
+
+    kind, *params = spec.split(":")
+    if kind == "fixed" and len(params) == 1:
+        size = parse_size(params[0])
+        return lambda rng: size
+    if kind == "uniform" and len(params) == 2:
+        low, high = parse_size(params[0]), parse_size(params[1])
+        return lambda rng: rng.randint(low, high)
+    if kind == "lognormal" and len(params) == 2:
+        median, sigma = parse_size(params[0]), float(params[1])
+        # Small enough for the JPEG headers, not more than 50 times the median
+        return lambda rng: int(min(max(rng.lognormvariate(0, sigma), 0.02), 50) * median)
+    raise ValueError("Unknown size distribution " + spec)
+
+
+def tree_folder(index, rng, layout, depth, fanout):
+    """
+    :return: relative folder of a file. flat: everything in the root. deep: depth levels of fanout folders each,
+             the first ones with year/month names like an imported camera roll.
+    """
+    if layout == "flat":
+        return ""
+    parts = []
+    for level in range(depth):
+        branch = rng.randrange(fanout)
+        if level == 0:
+            parts.append(str(2005 + branch))
+        elif level == 1:
+            parts.append("%02d" % (1 + branch % 12))
+        else:
+            parts.append("event_%02d" % branch)
+    return os.path.join(*parts)
+
+
+def make_tree(root, no_files, sizes="lognormal:2M:0.6", duplicates=0.1, no_exif=0.2, layout="deep", depth=4,
+              fanout=4, seed=0):
+    """
+    Write a deterministic photo tree: the same parameters always give the same paths, contents and mtimes.
+    Files are JPEGs with EXIF, or without it for a no_exif share of them. A duplicates share of the files are
+    copies of an earlier file, in the same folder and named like the copies of a camera import (IMG_x_1.JPG), so
+    that hydra_deleteduplicates --batch removes them.
+    The parameters and totals are written next to the tree, in <root>.json. An existing tree with the same
+    parameters is kept.
+    :param sizes: size distribution, see size_distribution
+    :param layout: deep or flat
+    :return: dict with the parameters, no_files and no_bytes
+    """
+    spec = {"no_files": no_files, "sizes": sizes, "duplicates": duplicates, "no_exif": no_exif, "layout": layout,
+            "depth": depth, "fanout": fanout, "seed": seed}
+    manifest = root.rstrip(os.sep) + ".json"
+    try:
+        with open(manifest) as f:
+            built = json.load(f)
+        if built["spec"] == spec:
+            return built
+    except (OSError, ValueError, KeyError):
+        pass
+    if os.path.exists(root) and len(os.listdir(root)) > 0:
+        raise ValueError(root + " is not empty and is not a tree with these parameters")
+
+    rng = random.Random(seed)
+    size_of = size_distribution(sizes)
+    os.makedirs(root, exist_ok=True)
+    # Spread over 2005-2024, fixed so that the file date of the pictures without EXIF is reproducible
+    start = time.mktime((2005, 1, 1, 12, 0, 0, 0, 0, -1))
+
+    originals = []
+    copies = {}
+    no_bytes = 0
+    for index in range(no_files):
+        if len(originals) > 0 and rng.random() < duplicates:
+            folder, name, mtime = rng.choice(originals)
+            copies[name] = copies.get(name, 0) + 1
+            base, ext = os.path.splitext(name)
+            path = os.path.join(root, folder, base + "_" + str(copies[name]) + ext)
+            source = os.path.join(root, folder, name)
+            with open(source, "rb") as f:
+                data = f.read()
+        else:
+            folder = tree_folder(index, rng, layout, depth, fanout)
+            name = "IMG_%06d.JPG" % index
+            mtime = start + rng.randrange(20 * 365 * 86400)
+            kind = "noexif.jpg" if rng.random() < no_exif else "jpg"
+            data = KINDS[kind](index, size_of(rng), rng)
+            originals.append((folder, name, mtime))
+            path = os.path.join(root, folder, name)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        os.utime(path, (mtime, mtime))
+        no_bytes += len(data)
+
+    built = {"spec": spec, "no_files": no_files, "no_bytes": no_bytes}
+    with open(manifest, "w") as f:
+        json.dump(built, f, indent=1)
+    return built
@@ -1,3 +1,25 @@
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
+
+
+def create_sqlite_engine(db_file):
+    """
+    Engine for a sqlite file, tuned for one process writing lots of rows
+    :param db_file: path of the database
+    :return: sqlalchemy engine
+    """
+    engine = create_engine('sqlite:///' + db_file)
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_conn, connection_record):
+        cursor = dbapi_conn.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        # WAL is safe against corruption with NORMAL, only the last commits can be lost on power failure
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA cache_size=-65536")  # KiB
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+    return engine
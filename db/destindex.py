@@ -0,0 +1,201 @@
+import hashlib
+import os
+import sqlite3
+import threading
+
+DEFAULT_FOLDER = os.path.join(os.path.expanduser("~"), ".cache", "hydra")
+
+
+class DestIndex():
+    """
+    Index of a destination folder: where each file name is, with its size. Finds where a file already went without
+    walking the destination again for every file.
+
+    Kept in a sqlite file and refreshed at each run: every folder is listed to find its subfolders, but the files of
+    a folder are read again only if its mtime changed (a file was added, removed or renamed in it).
+    With a HashFile, files are also matched by content, so renamed copies are found too. A file of the destination
+    is hashed the first time a file of its size is looked up, its hash is kept in the index until a refresh sees
+    its size or mtime change.
+    """
+    def __init__(self, destination, path=None, hash_file=None):
+        """
+        Create the index database if needed, refresh must be called before the lookups
+        :param destination: folder to index
+        :param path: sqlite file used for storage, default one per destination in the user cache folder
+        :param hash_file: optional fileinfo.HashFile, to match files by content
+        """
+        self.destination = destination
+        if path is None:
+            digest = hashlib.sha1(os.path.abspath(destination).encode("utf-8")).hexdigest()[:16]
+            path = os.path.join(DEFAULT_FOLDER, "destindex_" + digest + ".db")
+        self.path = path
+        self.hash_file = hash_file
+
+        self.local = threading.local()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = sqlite3.connect(path)
+        # WAL lets the workers read while the index is refreshed
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS folders (folder TEXT PRIMARY KEY, mtime_ns INTEGER)")
+        conn.execute("CREATE TABLE IF NOT EXISTS files (folder TEXT, name TEXT, size INTEGER, mtime_ns INTEGER, "
+                     "hash TEXT, algorithm TEXT, PRIMARY KEY (folder, name))")
+        # Index files made before the hashes were kept
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(files)")]
+        for column, kind in (("mtime_ns", "INTEGER"), ("hash", "TEXT"), ("algorithm", "TEXT")):
+            if column not in columns:
+                conn.execute("ALTER TABLE files ADD COLUMN " + column + " " + kind)
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_files_name ON files (name)")
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_files_size ON files (size)")
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_files_size_hash ON files (size, hash)")
+        conn.commit()
+        conn.close()
+
+    def __getstate__(self):
+        # Connections belong to the process/thread that opened them
+        state = self.__dict__.copy()
+        del state['local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = threading.local()
+
+    def connection(self):
+        """
+        One connection per process and thread, opened on first use. The workers only write the hashes.
+        :return: sqlite3 connection
+        """
+        conns = getattr(self.local, 'conns', None)
+        if conns is None:
+            conns = self.local.conns = {}
+        if os.getpid() not in conns:
+            conns[os.getpid()] = sqlite3.connect(self.path, timeout=60)
+        return conns[os.getpid()]
+
+    def refresh(self):
+        """
+        Bring the index up to date with the destination
+        :return: (number of folders whose files were read again, number of files in the index)
+        """
+        conn = sqlite3.connect(self.path, timeout=60)
+        known = dict(conn.execute("SELECT folder, mtime_ns FROM folders"))
+        seen = set()
+        no_listed = 0
+
+        with conn:
+            dirs = [self.destination]
+            while len(dirs) > 0:
+                current = dirs.pop()
+                folder = os.path.relpath(current, self.destination)
+                if folder == ".":
+                    folder = ""
+                try:
+                    mtime_ns = os.stat(current).st_mtime_ns
+                    with os.scandir(current) as it:
+                        entries = list(it)
+                except OSError:
+                    continue
+                seen.add(folder)
+
+                changed = known.get(folder) != mtime_ns
+                hashed = {}
+                if changed is True:
+                    # Hashes of the files that did not change are kept
+                    for name, size, file_mtime_ns, file_hash, algorithm in conn.execute(
+                            "SELECT name, size, mtime_ns, hash, algorithm FROM files "
+                            "WHERE folder=? AND hash IS NOT NULL", (folder,)):
+                        hashed[name] = (size, file_mtime_ns, file_hash, algorithm)
+                files = []
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            dirs.append(entry.path)
+                        elif changed is True and entry.is_file():
+                            fstat = entry.stat()
+                            file_hash, algorithm = None, None
+                            old = hashed.get(entry.name)
+                            if old is not None and old[:2] == (fstat.st_size, fstat.st_mtime_ns):
+                                file_hash, algorithm = old[2:]
+                            files.append((folder, entry.name, fstat.st_size, fstat.st_mtime_ns, file_hash,
+                                          algorithm))
+                    except OSError:
+                        # Removed in the meantime
+                        continue
+
+                if changed is True:
+                    no_listed += 1
+                    conn.execute("DELETE FROM files WHERE folder=?", (folder,))
+                    conn.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)", files)
+                    conn.execute("INSERT OR REPLACE INTO folders VALUES (?, ?)", (folder, mtime_ns))
+
+            for folder in set(known) - seen:
+                conn.execute("DELETE FROM files WHERE folder=?", (folder,))
+                conn.execute("DELETE FROM folders WHERE folder=?", (folder,))
+
+        no_files = conn.execute("SELECT count(*) FROM files").fetchone()[0]
+        conn.close()
+        return no_listed, no_files
+
+    def find(self, target_file, fstat=None):
+        """
+        Look for a file in the destination: same name and size first, then same content, then same name only
+        :param target_file: file to look for
+        :param fstat: its stat result, if already taken
+        :return: folder of the destination holding it, relative to the destination ('' for the top), or None
+        """
+        if fstat is None:
+            fstat = os.stat(target_file)
+        conn = self.connection()
+
+        same_name = conn.execute("SELECT folder, size FROM files WHERE name=? ORDER BY folder",
+                                 (os.path.basename(target_file),)).fetchall()
+        for folder, size in same_name:
+            if size == fstat.st_size:
+                return folder
+
+        if self.hash_file is not None and \
+                conn.execute("SELECT 1 FROM files WHERE size=? LIMIT 1", (fstat.st_size,)).fetchone() is not None:
+            target_hash = self.hash_file.computeHash(target_file, fstat)
+            algorithm = self.hash_file.algorithm
+
+            # Files of that size not hashed yet, each is hashed once for all the lookups
+            for folder, name in conn.execute("SELECT folder, name FROM files WHERE size=? AND "
+                                             "(hash IS NULL OR algorithm IS NOT ?)",
+                                             (fstat.st_size, algorithm)).fetchall():
+                self.store_hash(conn, folder, name)
+
+            for folder, name, mtime_ns in conn.execute("SELECT folder, name, mtime_ns FROM files "
+                                                       "WHERE size=? AND hash=? AND algorithm=? "
+                                                       "ORDER BY folder, name",
+                                                       (fstat.st_size, target_hash, algorithm)).fetchall():
+                # A file rewritten in place since it was hashed does not change the mtime of its folder
+                try:
+                    dest_stat = os.stat(os.path.join(self.destination, folder, name))
+                except OSError:
+                    # Moved away since the refresh
+                    continue
+                if (dest_stat.st_size, dest_stat.st_mtime_ns) == (fstat.st_size, mtime_ns) or \
+                        self.store_hash(conn, folder, name) == target_hash:
+                    return folder
+
+        if len(same_name) > 0:
+            return same_name[0][0]
+        return None
+
+    def store_hash(self, conn, folder, name):
+        """
+        Hash a file of the destination and keep its hash in the index
+        :return: the hash, None if the file could not be read
+        """
+        path = os.path.join(self.destination, folder, name)
+        try:
+            fstat = os.stat(path)
+            file_hash = self.hash_file.computeHash(path, fstat)
+        except OSError:
+            # Moved away since the refresh
+            return None
+        with conn:
+            conn.execute("UPDATE files SET size=?, mtime_ns=?, hash=?, algorithm=? WHERE folder=? AND name=?",
+                         (fstat.st_size, fstat.st_mtime_ns, file_hash, self.hash_file.algorithm, folder, name))
+        return file_hash
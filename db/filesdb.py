@@ -1,14 +1,25 @@
-from sqlalchemy import Column, Integer, String
+import sqlite3
+
+from sqlalchemy import Column, Integer, String, Boolean, LargeBinary, Index
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.schema import CreateTable, CreateIndex
 from db import Base
 
+# Stored in the sqlite user_version pragma, used to upgrade older databases
+#   1: mtime_ns, inode, missing columns
+#   2: binary hash, integer date, hash and (size, hash) indexes
+#   3: hash_algo column
+SCHEMA_VERSION = 3
+
 
 class FilesDb(Base):
     __tablename__ = 'files'
     id = Column(Integer, primary_key=True)
-    path = Column(String(100))
-    hash = Column(String(180))  # TODO: check this if changing fileinfo function
+    path = Column(String(100), index=True)
+    hash = Column(LargeBinary(64), index=True)  # raw digest, see fileinfo.HashFile
+    hash_algo = Column(String(20), server_default="sha3_512")
     size = Column(Integer)
-    date = Column(String(50))
+    date = Column(Integer)  # ctime, seconds
 
     #TODO: check length of these
     camera = Column(String(100))
@@ -19,6 +30,100 @@ class FilesDb(Base):
     focal_length = Column(String(100))
     flash = Column(String(100))
 
+    # Used to detect changed files when updating an existing database
+    mtime_ns = Column(Integer)
+    inode = Column(Integer)
+    missing = Column(Boolean, default=False)
+
+    __table_args__ = (Index('ix_files_size_hash', 'size', 'hash'), )
+
 
     def __repr__(self):
-        return "<FilesDb(Id=%d, path=%s, fileinfo=%s)>" % (self.id, self.path, self.hash)
+        return "<FilesDb(Id=%d, path=%s, fileinfo=%s)>" % (self.id, self.path, self.hash.hex())
+
+
+def schema_version(db_file):
+    """
+    :param db_file: path of a files database
+    :return: schema version of the database, 0 for databases created before versioning
+    """
+    # Read only: a mistyped path must fail, not create an empty database
+    conn = sqlite3.connect("file:" + db_file + "?mode=ro", uri=True)
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    conn.close()
+    return version
+
+
+def create_table(conn):
+    """
+    Create the files table and its indexes, as declared in FilesDb
+    :param conn: sqlite3 connection
+    """
+    table = FilesDb.__table__
+    conn.execute(str(CreateTable(table).compile(dialect=sqlite.dialect())))
+    for index in table.indexes:
+        conn.execute(str(CreateIndex(index).compile(dialect=sqlite.dialect())))
+
+
+def hash_algorithms(db_file):
+    """
+    :param db_file: path of a files database
+    :return: list of the hash algorithms used in the database
+    """
+    conn = sqlite3.connect(db_file)
+    algorithms = [row[0] for row in conn.execute('SELECT DISTINCT hash_algo FROM files')]
+    conn.close()
+    return algorithms
+
+
+def upgrade_schema(db_file):
+    """
+    Bring a files database to the current schema. Creates the table for new databases.
+    :param db_file: path of the database
+    :return: True if the database was changed
+    """
+    # Manage the transaction by hand, so the schema changes are part of it too
+    conn = sqlite3.connect(db_file, isolation_level=None)
+    conn.execute('BEGIN')
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    exists = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='files'").fetchone()
+
+    if exists is None:
+        create_table(conn)
+    elif version >= SCHEMA_VERSION:
+        conn.execute('ROLLBACK')
+        conn.close()
+        return False
+    else:
+        if version < 1:
+            # Stat columns used by the update mode
+            columns = [column[1] for column in conn.execute('PRAGMA table_info(files)')]
+            for name, sqltype in (('mtime_ns', 'INTEGER'), ('inode', 'INTEGER'), ('missing', 'BOOLEAN DEFAULT 0')):
+                if name not in columns:
+                    conn.execute('ALTER TABLE files ADD COLUMN ' + name + ' ' + sqltype)
+
+        if version < 2:
+            # Column types cannot be changed in sqlite, copy everything in a new table
+            conn.create_function('unhex', 1, lambda value: None if value is None else bytes.fromhex(value))
+            conn.execute('DROP INDEX IF EXISTS ix_files_path')
+            conn.execute('ALTER TABLE files RENAME TO files_v1')
+            create_table(conn)
+            conn.execute('INSERT INTO files (id, path, hash, size, date, camera, lens, exp_time, exp_fnum, exp_iso, '
+                         'focal_length, flash, mtime_ns, inode, missing) '
+                         'SELECT id, path, unhex(hash), size, CAST(CAST(date AS REAL) AS INTEGER), camera, lens, '
+                         'exp_time, exp_fnum, exp_iso, focal_length, flash, mtime_ns, inode, missing FROM files_v1')
+            conn.execute('DROP TABLE files_v1')
+
+        if version < 3:
+            # Digests made before the algorithm was selectable are all sha3_512
+            columns = [column[1] for column in conn.execute('PRAGMA table_info(files)')]
+            if 'hash_algo' not in columns:
+                conn.execute("ALTER TABLE files ADD COLUMN hash_algo VARCHAR(20) DEFAULT 'sha3_512'")
+
+    conn.execute('PRAGMA user_version = ' + str(SCHEMA_VERSION))
+    conn.execute('COMMIT')
+    if exists is not None:
+        # Give back the space of the old table
+        conn.execute('VACUUM')
+    conn.close()
+    return True
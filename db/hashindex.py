@@ -0,0 +1,205 @@
+import bisect
+import mmap
+import os
+import sqlite3
+import struct
+import tempfile
+
+MAGIC = b"HYDRAIDX"
+VERSION = 1
+
+# magic, version, digest size, number of entries, source db size, source db mtime_ns
+HEADER = struct.Struct("<8sIIQQQ")
+# offset of the path in the strings section, length of the path, file size
+RECORD = struct.Struct("<QIQ")
+
+
+class Digests():
+    """
+    The sorted digests of an index as a sequence, for bisect
+    """
+    def __init__(self, mapped, digest_size, count):
+        self.mapped = mapped
+        self.digest_size = digest_size
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        start = HEADER.size + i * self.digest_size
+        return self.mapped[start:start + self.digest_size]
+
+
+class HashIndex():
+    """
+    Read-only index of a files db: hash -> (path, size) of the files not missing, in a memory mapped file.
+    Layout: header, the digests (fixed width, sorted), one record per digest, then the paths. Lookups are a
+    binary search over the mapped digests, so all the processes using an index share the same pages.
+    """
+    def __init__(self, index_file):
+        """
+        :param index_file: file written by build
+        """
+        self.index_file = index_file
+        self.mapped = None
+
+    def __getstate__(self):
+        # Each process maps the file itself
+        state = self.__dict__.copy()
+        state['mapped'] = None
+        return state
+
+    def open(self):
+        with open(self.index_file, "rb") as f:
+            self.mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.digest_size, self.count, db_size, db_mtime_ns = HEADER.unpack_from(self.mapped)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(self.index_file + " is not a hash index")
+
+        self.records_offset = HEADER.size + self.count * self.digest_size
+        self.strings_offset = self.records_offset + self.count * RECORD.size
+        self.digests = Digests(self.mapped, self.digest_size, self.count)
+
+    def close(self):
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+
+    def __len__(self):
+        if self.mapped is None:
+            self.open()
+        return self.count
+
+    def lookup(self, digest):
+        """
+        :param digest: raw digest, as stored in the db
+        :return: list of (path, size) of the files with this digest
+        """
+        if self.mapped is None:
+            self.open()
+
+        found = []
+        i = bisect.bisect_left(self.digests, digest)
+        while i < self.count and self.digests[i] == digest:
+            path_offset, path_length, size = RECORD.unpack_from(self.mapped, self.records_offset + i * RECORD.size)
+            start = self.strings_offset + path_offset
+            found.append((self.mapped[start:start + path_length].decode("utf-8"), size))
+            i += 1
+        return found
+
+    @staticmethod
+    def db_stamp(db_file):
+        """
+        :return: (size, mtime_ns) identifying the content of a db, including what is still in its WAL file
+        """
+        fstat = os.stat(db_file)
+        size, mtime_ns = fstat.st_size, fstat.st_mtime_ns
+        # sqlite leaves an empty WAL file around after a checkpoint, and creates one when opening the db
+        if os.path.exists(db_file + "-wal") and os.path.getsize(db_file + "-wal") > 0:
+            wal_stat = os.stat(db_file + "-wal")
+            size += wal_stat.st_size
+            mtime_ns = max(mtime_ns, wal_stat.st_mtime_ns)
+        return size, mtime_ns
+
+    @staticmethod
+    def is_current(index_file, db_file):
+        """
+        :return: True if index_file was built from db_file as it is now
+        """
+        try:
+            with open(index_file, "rb") as f:
+                header = f.read(HEADER.size)
+        except OSError:
+            return False
+        if len(header) != HEADER.size:
+            return False
+        magic, version, digest_size, count, db_size, db_mtime_ns = HEADER.unpack(header)
+        return magic == MAGIC and version == VERSION and (db_size, db_mtime_ns) == HashIndex.db_stamp(db_file)
+
+    @staticmethod
+    def build(db_file, index_file, batch_size=10000):
+        """
+        Write the index of a files db. The rows are read in hash order and streamed to the file.
+        :param db_file: files db, schema 2 or later
+        :param index_file: where to write the index, replaced atomically
+        :param batch_size: rows read from the db at once
+        :return: number of entries
+        """
+        db_size, db_mtime_ns = HashIndex.db_stamp(db_file)
+
+        conn = sqlite3.connect("file:" + db_file + "?mode=ro", uri=True)
+        # Same snapshot for the count and the rows. Files without a hash (NULL after the migration of a v1 db)
+        # cannot be looked up.
+        conn.execute("BEGIN")
+        count, digest_size = conn.execute("SELECT count(*), max(length(hash)) FROM files "
+                                          "WHERE NOT missing AND hash IS NOT NULL").fetchone()
+        digest_size = digest_size or 0
+        cursor = conn.execute("SELECT hash, path, size FROM files WHERE NOT missing AND hash IS NOT NULL ORDER BY hash")
+
+        records_offset = HEADER.size + count * digest_size
+        strings_offset = records_offset + count * RECORD.size
+
+        folder = os.path.dirname(os.path.abspath(index_file))
+        fd, tmp_file = tempfile.mkstemp(prefix=".hashidx_", dir=folder)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(HEADER.pack(MAGIC, VERSION, digest_size, count, db_size, db_mtime_ns))
+
+                no_rows = 0
+                path_offset = 0
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if len(rows) == 0:
+                        break
+
+                    digests = []
+                    records = []
+                    paths = []
+                    paths_start = path_offset
+                    for file_hash, path, size in rows:
+                        if len(file_hash) != digest_size:
+                            raise ValueError(db_file + " mixes digests of different sizes")
+                        path = path.encode("utf-8")
+                        digests.append(file_hash)
+                        records.append(RECORD.pack(path_offset, len(path), size or 0))
+                        paths.append(path)
+                        path_offset += len(path)
+
+                    f.seek(HEADER.size + no_rows * digest_size)
+                    f.write(b"".join(digests))
+                    f.seek(records_offset + no_rows * RECORD.size)
+                    f.write(b"".join(records))
+                    f.seek(strings_offset + paths_start)
+                    f.write(b"".join(paths))
+                    no_rows += len(rows)
+
+            if no_rows != count:
+                raise ValueError(db_file + " changed while building the index")
+            os.replace(tmp_file, index_file)
+        except BaseException:
+            os.unlink(tmp_file)
+            raise
+        finally:
+            conn.close()
+
+        return count
+
+    @classmethod
+    def for_db(cls, db_file, index_file=None):
+        """
+        Index of a files db, built only if missing or older than the db. Kept next to the db (db_file.hashidx),
+        or in the temporary folder if the folder of the db is read-only.
+        :param db_file: files db
+        :param index_file: where to keep the index, if not next to the db
+        :return: HashIndex, not opened yet
+        """
+        if index_file is None:
+            index_file = db_file + ".hashidx"
+            if not os.access(os.path.dirname(os.path.abspath(db_file)), os.W_OK):
+                index_file = os.path.join(tempfile.gettempdir(),
+                                          os.path.basename(db_file) + "_" + str(os.stat(db_file).st_ino) + ".hashidx")
+
+        if cls.is_current(index_file, db_file) is False:
+            cls.build(db_file, index_file)
+        return cls(index_file)
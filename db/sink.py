@@ -0,0 +1,73 @@
+from sqlalchemy import bindparam
+
+
+class BulkSink():
+    """
+    Buffers rows for a table and writes them with executemany, in one transaction per batch.
+    A batch is written when it reaches batch_rows rows or batch_bytes bytes (roughly, values as strings).
+    Rows sqlite cannot take are refused when queued, a bad row does not fail the batch it would be in.
+    """
+    def __init__(self, engine, table, batch_rows=5000, batch_bytes=16 * 1024 * 1024):
+        """
+        :param engine: sqlalchemy engine to write to
+        :param table: sqlalchemy Table (Model.__table__ for ORM models)
+        :param batch_rows: maximum rows per transaction
+        :param batch_bytes: maximum data per transaction
+        """
+        self.engine = engine
+        self.table = table
+        self.batch_rows = batch_rows
+        self.batch_bytes = batch_bytes
+
+        self.rows = []
+        self.deletes = []
+        self.bytes = 0
+        self.no_rows_written = 0
+
+    def add(self, row):
+        """
+        Queue a row for insertion
+        :param row: dict of column name -> value
+        :raise UnicodeEncodeError: for text that is not valid UTF-8, like the file names scandir surrogate-escapes
+        """
+        self.check(row.values())
+        self.rows.append(row)
+        self.bytes += sum(len(str(value)) for value in row.values())
+        if len(self.rows) >= self.batch_rows or self.bytes >= self.batch_bytes:
+            self.flush()
+
+    def delete(self, column, value):
+        """
+        Queue deletion of the rows having column == value. Deletes are done before the inserts of the same batch.
+        :raise UnicodeEncodeError: same as add
+        """
+        self.check([value])
+        self.deletes.append((column, value))
+
+    @staticmethod
+    def check(values):
+        for value in values:
+            if isinstance(value, str):
+                value.encode("utf-8")
+
+    def flush(self):
+        """
+        Write everything buffered so far, in one transaction
+        """
+        if len(self.rows) == 0 and len(self.deletes) == 0:
+            return
+
+        with self.engine.begin() as conn:
+            by_column = {}
+            for column, value in self.deletes:
+                by_column.setdefault(column, []).append({"sink_value": value})
+            for column, values in by_column.items():
+                conn.execute(self.table.delete().where(self.table.c[column] == bindparam("sink_value")), values)
+
+            if len(self.rows) > 0:
+                conn.execute(self.table.insert(), self.rows)
+
+        self.no_rows_written += len(self.rows)
+        self.rows = []
+        self.deletes = []
+        self.bytes = 0
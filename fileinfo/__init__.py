@@ -1,2 +1,4 @@
-from .hash import HashFile
-from .exif import ExifInfo
\ No newline at end of file
+from .hash import HashFile, ALGORITHMS, DEFAULT_ALGORITHM
+from .exif import ExifInfo
+from .hashcache import HashCache
+from .headfile import HeadFile
@@ -1,7 +1,13 @@
-import exifread
+from .fastexif import exif_values
 
 class ExifInfo():
-    def __init__(self, target_file):
+    def __init__(self, target_file, fast=True):
+        """
+        Read the EXIF tags of a file
+        :param target_file: path, or file object opened in binary mode. A file object is left open.
+        :param fast: read only the needed tags from the EXIF header, exifread is used if the file is not supported.
+                     False to always use exifread.
+        """
         self.return_values = {
             "camera"        : "Image Model",
             "exp_time"      : "EXIF ExposureTime",
@@ -12,12 +18,20 @@ class ExifInfo():
             "lens"          : ["MakerNote LensMinMaxFocalMaxAperture", "EXIF LensSpecification"]
         }
 
-        self.type = target_file[-3:].lower()
+        names = []
+        for exif_name in self.return_values.values():
+            names.extend(exif_name if type(exif_name).__name__ == 'list' else [exif_name])
 
-        self.tags = exifread.process_file(open(target_file, "rb"), details=True)
+        if isinstance(target_file, str):
+            self.type = target_file[-3:].lower()
+            with open(target_file, "rb") as f:
+                found, self.tags = exif_values(f, names, True, fast)
+        else:
+            self.type = str(getattr(target_file, "name", ""))[-3:].lower()
+            found, self.tags = exif_values(target_file, names, True, fast)
 
         self.output = {}
-        if len(self.tags) == 0:
+        if found is False:
             self.return_empty()
         else:
             self.return_info()
@@ -33,14 +47,14 @@ class ExifInfo():
             if type(exif_name).__name__ == 'list':
                 for exif_elem in exif_name:
                     try:
-                        self.output[elem] = str(self.tags[exif_elem].values).strip()
+                        self.output[elem] = str(self.tags[exif_elem]).strip()
                         break
                     except KeyError:
                         self.output[elem] = "ERROR"
                         pass
             else:
                 try:
-                    self.output[elem] = str(self.tags[exif_name].values).strip()
+                    self.output[elem] = str(self.tags[exif_name]).strip()
                 except KeyError:
                     self.output[elem] = "ERROR"
 
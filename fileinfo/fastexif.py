@@ -0,0 +1,279 @@
+import struct
+
+import exifread
+from exifread.utils import Ratio
+
+# Tags this parser can decode, by IFD, named as exifread names them ("<IFD> <tag>")
+TAGS = {
+    "Image": {
+        0x010f: "Make",
+        0x0110: "Model",
+        0x0132: "DateTime",
+        0x8769: "ExifOffset",
+    },
+    "EXIF": {
+        0x829a: "ExposureTime",
+        0x829d: "FNumber",
+        0x8827: "ISOSpeedRatings",
+        0x9003: "DateTimeOriginal",
+        0x9004: "DateTimeDigitized",
+        0x9209: "Flash",
+        0x920a: "FocalLength",
+        0x927c: "MakerNote",
+        0xa432: "LensSpecification",
+    },
+    # Nikon type 2, the only maker note read here
+    "MakerNote": {
+        0x0084: "LensMinMaxFocalMaxAperture",
+    },
+}
+
+# Field type: (length, struct format), same table as the TIFF spec
+FIELD_TYPES = {
+    1: (1, "B"), 2: (1, "B"), 3: (2, "H"), 4: (4, "I"), 5: (8, None), 6: (1, "b"), 7: (1, "B"),
+    8: (2, "h"), 9: (4, "i"), 10: (8, None), 11: (4, "f"), 12: (8, "d"), 13: (4, "I"),
+}
+ASCII = 2
+RATIONALS = (5, 10)
+FLOATS = (11, 12)
+
+# Skipped by exifread unless details is True
+IGNORE_TAGS = (0x02bc, 0x927c, 0x9286)
+
+# JPEG segments exifread treats as a fake EXIF start, see exifread.core.jpeg
+FAKE_EXIF_CODES = (b"JFIF", b"JFXX", b"OLYM", b"Phot")
+
+
+class Unsupported(Exception):
+    """
+    The file is not laid out the way this parser expects: let exifread handle it
+    """
+    pass
+
+
+class Reader():
+    """
+    Reads the parts of the file the IFDs point to, in chunks, offsets relative to the TIFF header
+    """
+    def __init__(self, f, base, chunk_size):
+        self.f = f
+        self.base = base
+        self.chunk_size = chunk_size
+        self.start = 0
+        self.data = b""
+        self.endian = "<"
+
+    def get(self, offset, length):
+        if offset < 0:
+            raise Unsupported("Negative offset")
+        if offset < self.start or offset + length > self.start + len(self.data):
+            self.f.seek(self.base + offset)
+            self.start = offset
+            self.data = self.f.read(max(length, self.chunk_size))
+            if len(self.data) < length:
+                # exifread reads zeros here, do not try to match it
+                raise Unsupported("Offset past the end of the file")
+        return self.data[offset - self.start:offset - self.start + length]
+
+    def number(self, offset, fmt, length):
+        return struct.unpack(self.endian + fmt, self.get(offset, length))[0]
+
+
+def find_tiff(f, head_size):
+    """
+    Locate the TIFF header of JPEG and TIFF based files (CR2, NEF, DNG...)
+    :return: (offset of the TIFF header, fake_exif) - fake_exif as computed by exifread
+    """
+    f.seek(0)
+    data = f.read(head_size)
+    if data[0:2] in (b"II", b"MM"):
+        return 0, False
+    if data[0:2] != b"\xff\xd8":
+        raise Unsupported("Not a JPEG or TIFF file")
+
+    fake_exif = len(data) > 10 and data[2] == 0xff and data[6:10] in FAKE_EXIF_CODES
+    # exifread only looks at the segments found in the first 4000 bytes after the first one
+    limit = 4002
+    if fake_exif is True:
+        limit = 4004 + data[4] * 256 + data[5]
+
+    position = 2
+    while position + 10 <= min(len(data), limit):
+        marker = data[position:position + 2]
+        if marker[0] != 0xff or marker in (b"\xff\xdb", b"\xff\xda", b"\xff\xd9"):
+            break
+        if marker == b"\xff\xe1" and data[position + 4:position + 8] == b"Exif":
+            if data[position + 8:position + 10] != b"\0\0":
+                break
+            return position + 10, fake_exif
+        if fake_exif is True and position > 2 and data[position + 4:position + 8] in FAKE_EXIF_CODES:
+            break
+        position += 2 + data[position + 2] * 256 + data[position + 3]
+
+    raise Unsupported("No EXIF segment where exifread looks for it")
+
+
+def read_ifd(reader, ifd, ifd_name, wanted, details, relative_base=None):
+    """
+    Decode the wanted tags of an IFD, the same way as exifread.core.exif_header.ExifHeader.dump_ifd
+    :param relative_base: offsets of the values are relative to this, for Nikon maker notes
+    :return: (dict of tag name -> (values, field type, value offset), number of tags exifread would list)
+    """
+    tag_names = TAGS[ifd_name]
+    tags = {}
+    no_tags = 0
+
+    no_entries = reader.number(ifd, "H", 2)
+    table = reader.get(ifd + 2, 12 * no_entries)
+    for i, (tag, field_type, count, pointer) in enumerate(struct.iter_unpack(reader.endian + "HHII", table)):
+        if field_type not in FIELD_TYPES or (details is False and tag in IGNORE_TAGS):
+            continue
+        no_tags += 1
+
+        name = tag_names.get(tag)
+        if name is None or name not in wanted:
+            continue
+
+        type_length, fmt = FIELD_TYPES[field_type]
+        offset = ifd + 2 + 12 * i + 8
+        if count * type_length > 4:
+            offset = pointer
+            if relative_base is not None:
+                offset += relative_base
+
+        if field_type == ASCII:
+            values = ""
+            if count != 0:
+                values = reader.get(offset, count).split(b"\0", 1)[0]
+                try:
+                    values = values.decode("utf-8")
+                except UnicodeDecodeError:
+                    pass
+        elif count < 1000 or name == "MakerNote":
+            values = []
+            for position in range(offset, offset + count * type_length, type_length):
+                if field_type in RATIONALS:
+                    ratio_fmt = "i" if field_type == 10 else "I"
+                    values.append(Ratio(reader.number(position, ratio_fmt, 4),
+                                        reader.number(position + 4, ratio_fmt, 4)))
+                elif field_type in FLOATS:
+                    values.append(struct.unpack(reader.endian + fmt, reader.get(position, type_length)))
+                else:
+                    values.append(reader.number(position, fmt, type_length))
+                if name == "MakerNote" and len(values) >= 14:
+                    # Only the header is looked at
+                    break
+        else:
+            values = []
+
+        tags[name] = (values, field_type, offset)
+
+    return tags, no_tags
+
+
+def read_tags(f, names, details=True, head_size=64 * 1024):
+    """
+    Decode only the given tags, reading only the IFDs holding them. Handles EXIF in JPEG files and TIFF based
+    raw files, with the same values as exifread.
+    :param f: file opened in binary mode
+    :param names: tag names, as exifread names them ("EXIF FNumber", "Image Model"...)
+    :param details: same as the exifread parameter, maker notes are only read if True
+    :param head_size: bytes read at once from the beginning of the file, and then for each jump
+    :return: dict of tag name -> values. Raises Unsupported if the file is not laid out as expected.
+    """
+    wanted = {}
+    for name in names:
+        ifd_name, tag_name = name.split(" ", 1)
+        # The maker note itself is only read up to its header
+        if tag_name not in TAGS.get(ifd_name, {}).values() or tag_name == "MakerNote":
+            raise Unsupported("Unknown tag " + name)
+        wanted.setdefault(ifd_name, set()).add(tag_name)
+
+    base, fake_exif = find_tiff(f, head_size)
+    reader = Reader(f, base, head_size)
+    byte_order = reader.get(0, 2)
+    if byte_order not in (b"II", b"MM"):
+        raise Unsupported("Unknown byte order")
+    reader.endian = "<" if byte_order == b"II" else ">"
+
+    # IFD0: the Exif IFD and the maker note need Make and ExifOffset
+    image_wanted = wanted.get("Image", set()) | {"Make", "ExifOffset"}
+    image, no_tags = read_ifd(reader, reader.number(4, "I", 4), "Image", image_wanted, details)
+    if no_tags == 0:
+        raise Unsupported("Empty IFD0")
+
+    values = {}
+    for tag_name in wanted.get("Image", ()):
+        if tag_name in image:
+            values["Image " + tag_name] = image[tag_name][0]
+
+    exif_wanted = wanted.get("EXIF", set())
+    if details is True and "MakerNote" in wanted:
+        exif_wanted = exif_wanted | {"MakerNote"}
+    if len(exif_wanted) == 0 or "ExifOffset" not in image:
+        return values
+
+    exif_offset = image["ExifOffset"][0]
+    if type(exif_offset) is not list or len(exif_offset) == 0:
+        raise Unsupported("Bad Exif IFD pointer")
+    exif, no_tags = read_ifd(reader, exif_offset[0], "EXIF", exif_wanted, details)
+    for tag_name in wanted.get("EXIF", ()):
+        if tag_name in exif:
+            values["EXIF " + tag_name] = exif[tag_name][0]
+
+    if "MakerNote" in exif_wanted and "MakerNote" in exif and "Make" in image:
+        values.update(read_maker_note(reader, exif["MakerNote"], str(image["Make"][0]), wanted["MakerNote"],
+                                      fake_exif))
+
+    return values
+
+
+def read_maker_note(reader, note, make, wanted, fake_exif):
+    """
+    Nikon maker notes, following exifread.core.exif_header.ExifHeader.decode_maker_note
+    :return: dict of tag name -> values
+    """
+    note_values, field_type, note_offset = note
+    if "NIKON" not in make:
+        # The maker notes of the others do not have the tags this parser knows (see exifread.tags.makernote)
+        return {}
+    if field_type not in (1, 7):
+        raise Unsupported("Unexpected maker note type")
+
+    header = note_values[0:7]
+    if header == [78, 105, 107, 111, 110, 0, 1]:
+        # Type 1: none of the tags known here
+        return {}
+    if header == [78, 105, 107, 111, 110, 0, 2]:
+        if note_values[12:14] not in ([0, 42], [42, 0]):
+            # exifread gives up on these
+            return {}
+        if fake_exif is True or note_values[10:12] != list(reader.get(0, 2)):
+            # exifread shifts the offsets, or reads with the wrong byte order
+            raise Unsupported("Maker note exifread does not read as it is")
+        ifd = note_offset + 10 + 8
+        tags, no_tags = read_ifd(reader, ifd, "MakerNote", wanted, True, ifd - 8)
+    else:
+        # Unlabeled type 2
+        tags, no_tags = read_ifd(reader, note_offset, "MakerNote", wanted, True)
+
+    return {"MakerNote " + tag_name: tags[tag_name][0] for tag_name in tags}
+
+
+def exif_values(f, names, details=True, fast=True):
+    """
+    Values of some EXIF tags, as exifread would give them. Uses read_tags when it can, exifread otherwise.
+    :param f: file opened in binary mode
+    :param names: tag names, as exifread names them
+    :param details: same as the exifread parameter
+    :param fast: False to always use exifread
+    :return: (found, values) - found is True if the file has EXIF data, values is a dict of tag name -> values
+    """
+    if fast is True:
+        try:
+            return True, read_tags(f, names, details)
+        except (Unsupported, struct.error):
+            pass
+
+    tags = exifread.process_file(f, details=details)
+    return len(tags) > 0, {name: tags[name].values for name in names if name in tags}
@@ -1,18 +1,173 @@
 import hashlib
+import mmap
+import os
+import threading
+
+# Hash algorithms by name. The name is stored with each digest (files db, hash cache).
+ALGORITHMS = {
+    "sha3_512": hashlib.sha3_512,   # default, used by all the databases created before the others were added
+    "blake2b": hashlib.blake2b,
+    "sha256": hashlib.sha256,
+}
+
+# Optional, faster algorithms
+try:
+    import blake3
+    ALGORITHMS["blake3"] = blake3.blake3
+except ImportError:
+    pass
+
+try:
+    import xxhash
+    # Not cryptographic: fine to find duplicates, do not use it to check for tampering
+    ALGORITHMS["xxh3_128"] = xxhash.xxh3_128
+except ImportError:
+    pass
+
+DEFAULT_ALGORITHM = "sha3_512"
+
 
 class HashFile():
-    def __init__(self):
+    def __init__(self, cache=None, algorithm=DEFAULT_ALGORITHM, mmap_threshold=64 * 1024 * 1024):
         """
         Prepare parameters for hashing
+        :param cache: optional HashCache, checked before reading the file
+        :param algorithm: one of ALGORITHMS
+        :param mmap_threshold: files at least this big are hashed from a memory map instead of being read
         """
-        self.hash_func = hashlib.sha3_512
+        self.hash_func = ALGORITHMS[algorithm]
         self.hash_bsize = 2 * 1024 * 1024   # 8Mb?
+        self.algorithm = algorithm
+        self.mmap_threshold = mmap_threshold
+        self.cache = cache
 
-    def computeHash(self, target_file):
+        # Read buffer, reused for all files. One per thread, the duplicate search hashes from threads.
+        self.local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = threading.local()
+
+    def buffer(self):
+        """
+        :return: memoryview of the read buffer of the current thread
+        """
+        view = getattr(self.local, 'view', None)
+        if view is None:
+            view = self.local.view = memoryview(bytearray(self.hash_bsize))
+        return view
+
+    def hashStream(self, f, file_hash, size=None, head_size=0):
+        """
+        Feed a file to a hash object, without allocating memory for each block
+        :param f: file opened in binary mode, positioned where to start
+        :param file_hash: hash object to update
+        :param size: how much to read at most, None to read until the end of the file
+        :param head_size: how many of the first bytes read to keep
+        :return: the first head_size bytes read
+        """
+        view = self.buffer()
+        head = b""
+        while size is None or size > 0:
+            block = view if size is None or size >= len(view) else view[:size]
+            no_bytes = f.readinto(block)
+            if not no_bytes:
+                break
+            file_hash.update(block[:no_bytes])
+            if len(head) < head_size:
+                head += bytes(block[:min(no_bytes, head_size - len(head))])
+            if size is not None:
+                size -= no_bytes
+        return head
+
+    def hashContent(self, f, head_size=0):
+        """
+        Hash an open file from the beginning, no cache involved
+        :param f: file opened in binary mode, unbuffered
+        :param head_size: how many bytes to keep from the beginning of the file
+        :return: (hexdigest, head)
+        """
         file_hash = self.hash_func()
 
-        with open(target_file, "rb") as f:
-            for block in iter(lambda: f.read(self.hash_bsize), b""):
-                file_hash.update(block)
+        f.seek(0)
+        size = os.fstat(f.fileno()).st_size
+        if size >= self.mmap_threshold:
+            # Big files: let the kernel page it in, no copy at all
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                file_hash.update(mapped)
+                head = mapped[:head_size]
+        else:
+            # Do not trust the size for the end of the file, it could still be growing
+            head = self.hashStream(f, file_hash, head_size=head_size)
+
+        return file_hash.hexdigest(), head
+
+    def hashOpenFile(self, f, fstat=None, head_size=0):
+        """
+        Same as computeHash, for a file the caller already opened and keeps using afterwards
+        :param f: file opened in binary mode, unbuffered
+        :param fstat: stat result of the file, if already known
+        :param head_size: how many bytes to keep from the beginning of the file
+        :return: (hexdigest, head) - head is empty if the hash came from the cache
+        """
+        if self.cache is not None:
+            if fstat is None:
+                fstat = os.fstat(f.fileno())
+            digest = self.cache.lookup(fstat, self.algorithm)
+            if digest is not None:
+                return digest, b""
+
+        digest, head = self.hashContent(f, head_size)
+        if self.cache is not None:
+            self.cache.remember(fstat, self.algorithm, digest)
+        return digest, head
+
+    def computeHash(self, target_file, fstat=None):
+        """
+        Hash the entire file, or take the hash from the cache if the file did not change since then
+        :param target_file: file to hash
+        :param fstat: stat result of the file, if already known
+        :return: hexdigest
+        """
+        if self.cache is not None:
+            if fstat is None:
+                fstat = os.stat(target_file)
+            digest = self.cache.lookup(fstat, self.algorithm)
+            if digest is not None:
+                return digest
+
+        with open(target_file, "rb", buffering=0) as f:
+            digest, head = self.hashContent(f)
+
+        if self.cache is not None:
+            self.cache.remember(fstat, self.algorithm, digest)
+        return digest
+
+    def computeEdgeHash(self, target_file, edge_size):
+        """
+        Cheap pre-filter for duplicate searches: hash only the first and the last edge_size bytes of a file.
+        The file size is hashed as well, so files of different sizes never share a digest.
+        :param target_file: file to hash
+        :param edge_size: how many bytes to read from each end of the file
+        :return: (hexdigest, complete) - complete is True if the whole file was read, so the digest can be trusted
+        """
+        file_hash = self.hash_func()
+
+        with open(target_file, "rb", buffering=0) as f:
+            size = os.fstat(f.fileno()).st_size
+            file_hash.update(size.to_bytes(8, 'little'))
+
+            if size <= 2 * edge_size:
+                self.hashStream(f, file_hash)
+                return file_hash.hexdigest(), True
+
+            self.hashStream(f, file_hash, edge_size)
+            f.seek(size - edge_size)
+            self.hashStream(f, file_hash, edge_size)
 
-        return file_hash.hexdigest()
+        return file_hash.hexdigest(), False
@@ -0,0 +1,167 @@
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".cache", "hydra", "hashes.db")
+
+
+class HashCache():
+    """
+    Persistent cache of file hashes, shared by all the tools. Entries are keyed on the file identity and state
+    (device, inode, size, mtime) and on the hash algorithm, so a changed file is never matched.
+
+    Workers only read the cache. Everything they find or compute is kept in a pending list that travels with the
+    results to the librarian, which is the only one writing to the database. With threads the list is shared, a
+    lock keeps entries from being lost while it is swapped.
+    """
+    def __init__(self, path=DEFAULT_PATH, max_entries=1000000):
+        """
+        Create the cache database if needed
+        :param path: sqlite file used for storage
+        :param max_entries: the least recently used entries over this limit are evicted
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.flush_size = 1000      # pending entries
+        self.pending = []
+
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = sqlite3.connect(path)
+        # WAL lets the workers read while the librarian writes
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS hashes ("
+                     "dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, algorithm TEXT, "
+                     "digest TEXT, last_used REAL, "
+                     "PRIMARY KEY (dev, ino, size, mtime_ns, algorithm))")
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_hashes_last_used ON hashes (last_used)")
+        conn.commit()
+        conn.close()
+
+    def __getstate__(self):
+        # Connections belong to the process/thread that opened them
+        state = self.__dict__.copy()
+        del state['local']
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def connection(self, read_only=True):
+        """
+        One connection per process and thread, opened on first use
+        :param read_only: workers must not write to the cache
+        :return: sqlite3 connection
+        """
+        key = (os.getpid(), read_only)
+        conns = getattr(self.local, 'conns', None)
+        if conns is None:
+            conns = self.local.conns = {}
+        if key not in conns:
+            if read_only is True:
+                conns[key] = sqlite3.connect("file:" + self.path + "?mode=ro", uri=True)
+            else:
+                conns[key] = sqlite3.connect(self.path, timeout=60)
+        return conns[key]
+
+    @staticmethod
+    def key(fstat, algorithm):
+        return fstat.st_dev, fstat.st_ino, fstat.st_size, fstat.st_mtime_ns, algorithm
+
+    def lookup(self, fstat, algorithm):
+        """
+        Look for the hash of a file
+        :param fstat: stat result of the file
+        :param algorithm: name of the hash algorithm
+        :return: hexdigest if found, None otherwise
+        """
+        found = self.connection().execute("SELECT digest FROM hashes WHERE dev=? AND ino=? AND size=? AND "
+                                          "mtime_ns=? AND algorithm=?", self.key(fstat, algorithm)).fetchone()
+        if found is None:
+            return None
+
+        # Also refreshes the LRU time stamp when stored
+        self.remember(fstat, algorithm, found[0])
+        return found[0]
+
+    def remember(self, fstat, algorithm, digest):
+        """
+        Keep a hash for storing. Does not write anything, see store/flush.
+        """
+        with self.lock:
+            self.pending.append(self.key(fstat, algorithm) + (digest,))
+
+    def drain(self):
+        """
+        Take the pending entries, to send them to the librarian
+        :return: list of entries
+        """
+        with self.lock:
+            entries = self.pending
+            self.pending = []
+        return entries
+
+    def store(self, entries):
+        """
+        Librarian side: add entries received from the workers, write them when enough are gathered
+        :param entries: what drain returned in the worker
+        """
+        with self.lock:
+            self.pending.extend(entries)
+            full = len(self.pending) >= self.flush_size
+        if full is True:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the pending entries and evict the least recently used ones over the size limit
+        """
+        entries = self.drain()
+        if len(entries) == 0:
+            return
+
+        now = time.time()
+        conn = self.connection(read_only=False)
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             [entry + (now,) for entry in entries])
+        self.evict()
+
+    def evict(self):
+        """
+        Drop the least recently used entries over the size limit
+        """
+        conn = self.connection(read_only=False)
+        with conn:
+            no_entries = conn.execute("SELECT count(*) FROM hashes").fetchone()[0]
+            if no_entries > self.max_entries:
+                conn.execute("DELETE FROM hashes WHERE rowid IN "
+                             "(SELECT rowid FROM hashes ORDER BY last_used LIMIT ?)",
+                             (no_entries - self.max_entries,))
+
+    def invalidate(self, fstat=None):
+        """
+        Forget the hashes of a file, for all algorithms. Forgets everything if no file is given.
+        :param fstat: stat result of the file or None
+        """
+        with self.lock:
+            self.pending = []
+        conn = self.connection(read_only=False)
+        with conn:
+            if fstat is None:
+                conn.execute("DELETE FROM hashes")
+            else:
+                conn.execute("DELETE FROM hashes WHERE dev=? AND ino=?", (fstat.st_dev, fstat.st_ino))
+
+    def stats(self):
+        """
+        :return: (number of entries, size of the database file in bytes)
+        """
+        no_entries = self.connection().execute("SELECT count(*) FROM hashes").fetchone()[0]
+        return no_entries, os.path.getsize(self.path)
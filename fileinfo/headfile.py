@@ -0,0 +1,58 @@
+import os
+
+
+class HeadFile():
+    """
+    Read-only file object over an already open descriptor. Reads are served from a copy of the beginning of the
+    file when possible (kept while hashing), anything past it is read with os.pread. Metadata parsers only read
+    the header of a file, so most of the time the file is not read a second time.
+    Does not own the descriptor: closing it is left to whoever opened it.
+    """
+    def __init__(self, fd, head=b"", name=""):
+        """
+        :param fd: descriptor of the file, opened for reading
+        :param head: bytes from the beginning of the file, can be empty
+        :param name: path of the file, for the parsers looking at the extension
+        """
+        self.fd = fd
+        self.head = head
+        self.name = name
+        self.position = 0
+        self.no_bytes_read = 0      # read from the disk, not served from the head
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = max(0, os.fstat(self.fd).st_size - self.position)
+
+        end = self.position + size
+        if end <= len(self.head):
+            data = self.head[self.position:end]
+        elif self.position < len(self.head):
+            data = self.head[self.position:] + os.pread(self.fd, end - len(self.head), len(self.head))
+            self.no_bytes_read += len(data) - (len(self.head) - self.position)
+        else:
+            data = os.pread(self.fd, size, self.position)
+            self.no_bytes_read += len(data)
+
+        self.position += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            self.position = offset
+        elif whence == os.SEEK_CUR:
+            self.position += offset
+        else:
+            self.position = os.fstat(self.fd).st_size + offset
+        if self.position < 0:
+            raise ValueError("Negative seek position " + str(self.position))
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
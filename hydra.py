@@ -1,104 +1,409 @@
+import asyncio
 import os
 import stat
 import datetime
 import time
-import multiprocessing
 import logging
 import argparse
 import sys
+import threading
+import queue
+import pickle
+import contextlib
+
+from utils.walker import walk_tree, count_files, FileEntry
+from utils.metrics import Metrics
+from utils import profiling
+from utils.executors import EXECUTORS, create_executor
+from utils.autoscale import Autoscaler
+from utils.journal import Journal
+from utils.resultchannel import ResultChannel
+from utils.distributed import Coordinator
+from utils import layout
+from utils.lanes import DeviceLanes
 
 
 class Hydra:
     """
     Framework for processing lots of files or other stuff.
     """
-    def __init__(self, path, no_workers, log_name='hydra', log_level = logging.INFO):
+    # Optional fileinfo.HashCache. Hashes found/computed by the workers are stored by the librarian.
+    hash_cache = None
+
+    # Walk the files in name order. Tools that sort their results anyway should turn it off, it lets the
+    # walker threads send files as soon as they are found.
+    walk_ordered = True
+
+    # How the walker, the workers and the librarian run, one of utils.executors.EXECUTORS. Tools whose work()
+    # mostly waits on I/O or releases the GIL can default to threads, --executor overrides it.
+    default_executor = 'process'
+
+    # Results can be journaled and replayed through db_insert to resume an interrupted run. Only for tools where
+    # replaying a result is safe: not for the ones moving files as they go.
+    resumable = False
+    # What else must match to resume a run (hash algorithm...), set by the tool before calling Hydra.__init__
+    journal_params = {}
+
+    # Targets with at most this many files run inline, without processes or threads, unless an executor is given.
+    # 0 to never do it.
+    inline_max_files = 64
+
+    # What the tool sets before calling Hydra.__init__ is sent to the remote workers of a distributed run, except
+    # these attributes: what only the walker or the librarian use (database connections, big lookups...)
+    coordinator_only = ()
+
+    # Order the files as they are on the disk before sending them, one of utils.layout.LAYOUTS. auto does it only
+    # on spinning disks. For tools that do not need the name order, --layout overrides it.
+    default_layout = 'off'
+    # Files from this size are read by at most readers_per_device workers at once on a spinning disk, more
+    # would make it seek between them
+    large_file_size = 8 * 1024 * 1024
+
+    # The files of each device go through their own queue, up to this many devices, see utils.lanes
+    max_devices = 8
+
+    def __init__(self, path, no_workers, log_name='hydra', log_level = logging.INFO, batch_size=0, walkers=4,
+                 metrics_file=None, profile=None, executor=None, autoscale=None, journal='auto', resume=False,
+                 serve=None, authkey=None, wait_hosts=0, layout_mode=None, readers_per_device=2,
+                 workers_per_device=0):
+        # Everything work() can need, for the remote workers
+        tool_state = dict(self.__dict__)
 
         self.target_path = path
-        self.main_data = []
 
         # Init logging
         current_time = datetime.datetime.now().strftime("%Y%m%d_%H%M")
         self.init_logging(log_level, log_name + "_" + current_time + ".log")
 
         # Init config stuff
-        self.no_workers = no_workers
-        self.pqueue_maxsize = 2048          # elems
+        self.no_workers = no_workers        # workers at start, they stay if not autoscaling
+        self.no_walkers = walkers           # threads walking the top level folders in parallel
+        self.pqueue_maxsize = 2048          # messages, a message is a batch of elems
         self.print_timeout = 5              # second(s)
 
-        # Init statistics that come from worker processes
-        self.no_elems_indexed = multiprocessing.Value('i', lock=False)
-        self.no_elems_skipped = multiprocessing.Value('i', lock=False)
-        self.no_elems_processed = multiprocessing.Array('i', self.no_workers, lock=False)
-        self.no_elems_logged = multiprocessing.Value('i', lock=False)
+        # Elems are sent in batches, to cut the queue overhead. With batch_size 0, the size of the batches is
+        # adapted so that one batch is about batch_target_time of work.
+        self.batch_size = batch_size
+        self.batch_max = 256                # elems
+        self.batch_target_time = 0.1        # second(s)
+        self.batch_max_delay = 0.5          # second(s), do not keep the workers waiting on a slow walker
+        self.batch = []
+        self.batch_start = 0
+
+        # Elems held back by the walker to send them in disk order
+        self.layout = None
+        if (layout_mode or self.default_layout) != 'off':
+            self.layout = layout.LayoutOrder(layout_mode or self.default_layout)
+
+        # Small job: starting the stages would take longer than the work
+        if executor is None and autoscale is None and serve is None and self.inline_max_files > 0 and \
+                asyncio.iscoroutinefunction(self.work) is False and \
+                count_files(path, self.inline_max_files) <= self.inline_max_files:
+            executor = 'inline'
+        if executor == 'inline':
+            if autoscale is not None:
+                raise ValueError("Cannot autoscale inline, there is one worker")
+            self.no_workers = 1
+
+        # Start and retire workers during the run, between the (min, max) bounds of autoscale
+        self.autoscaler = None
+        self.no_slots = no_workers          # workers that can run at the same time, each has its counters
+        if autoscale is not None:
+            min_workers, max_workers = autoscale
+            if min_workers < 1 or max_workers < min_workers:
+                raise ValueError("Bad autoscale bounds " + str(min_workers) + ":" + str(max_workers))
+            self.autoscaler = Autoscaler(min_workers, max_workers)
+            self.no_workers = min(max(no_workers, min_workers), max_workers)
+            self.no_slots = max_workers
+
+        # Processes, threads or coroutines. Gives the counters and the queues that work with them.
+        self.executor = create_executor(executor or self.default_executor, self.no_slots)
+        if serve is not None:
+            if self.executor.name not in ('process', 'thread'):
+                raise ValueError("Remote workers need the process or thread executor, not " + self.executor.name)
+            if authkey is None:
+                raise ValueError("Remote workers need an authkey")
+        # One queue per device, a slow disk only holds the workers it is allowed. A distributed run splits the
+        # batches on the hosts instead, the asyncio and inline executors keep a single queue.
+        no_devices = 0
+        if serve is None and self.executor.name in ('process', 'thread'):
+            no_devices = self.max_devices
 
-        # Init queues
-        self.queue_elems = multiprocessing.Queue(maxsize=self.pqueue_maxsize)
-        self.queue_data = multiprocessing.Queue(maxsize=self.pqueue_maxsize)
-        # TODO: maybe better way?
-        self.queue_to_main = multiprocessing.Queue(maxsize=self.pqueue_maxsize)
+        # Init statistics that come from worker processes
+        self.no_elems_indexed = self.executor.value('i')
+        self.no_elems_skipped = self.executor.value('i')
+        self.no_elems_processed = self.executor.array('i', self.no_slots)
+        self.no_elems_logged = self.executor.value('i')
+        # Average time of work() for one elem, measured by the workers
+        self.work_time = self.executor.value('d')
+        # Throughput, latency and queue depth of each stage. Snapshots are written to metrics_file, if given.
+        self.metrics = Metrics(self.no_slots, executor=self.executor, no_devices=no_devices)
+        # Workers started so far, for the librarian to know when they are all done, and the slots to retire
+        self.no_workers_started = self.executor.value('i')
+        self.retire = self.executor.array('b', self.no_slots)
+        self.metrics_file = metrics_file
+        # Big files on spinning disks: one semaphore per device, devices beyond the number of semaphores share them
+        self.reader_slots = None
+        if readers_per_device > 0:
+            self.reader_slots = [self.executor.semaphore(readers_per_device) for i in range(0, 16)]
+
+        # Run the walker, the workers and the librarian under a profiler (mode from utils.profiling.MODES)
+        self.profile = profile
+        self.profile_dir = None
+        if profile is not None:
+            self.profile_dir = os.path.join(self.target_path, "profile_" + current_time)
+            os.makedirs(self.profile_dir, exist_ok=True)
+            if profile == "sampling" and profiling.pyinstrument is None:
+                self.logger.warning("pyinstrument is not installed, using cProfile")
+            if self.executor.coroutines is True:
+                self.logger.warning("The asyncio workers are not profiled, only the walker and the librarian")
+
+        # Journal of the stored results: 'auto' for the default file of the tool and target, None for none
+        self.journal = None
+        self.journaled = set()
+        self.no_elems_resumed = self.executor.value('i')
+        # Set if a worker was stopped by the user, or when the librarian is done: a complete run needs no journal
+        self.interrupted = self.executor.value('b')
+        self.librarian_done = self.executor.value('b')
+        if journal is not None and self.resumable is True:
+            if journal == 'auto':
+                journal = Journal.default_path(log_name, path)
+            header = {'tool': type(self).__name__, 'target': os.path.abspath(path), 'params': self.journal_params}
+            self.journal = Journal(journal, header)
+            self.journaled = self.journal.start(resume)
+            if resume is True:
+                self.logger.info("Resuming from " + journal + ", " + str(len(self.journaled)) + " elems already done")
+        elif resume is True:
+            raise ValueError(type(self).__name__ + " cannot resume, it needs a journal")
+
+        # Init queues. In a distributed run they are served to the remote workers, the batches go to the hosts
+        # that have their files locally.
+        self.coordinator = None
+        self.lanes = None
+        if serve is not None:
+            self.coordinator = Coordinator(serve, authkey, self.pqueue_maxsize, self.remote_state(tool_state))
+            self.queue_elems = self.coordinator.dispatcher
+            self.queue_data = self.coordinator.results
+            self.logger.info("Serving remote workers on " + str(self.coordinator.address[0]) + ":" +
+                             str(self.coordinator.address[1]))
+            if wait_hosts > 0:
+                self.logger.info("Waiting for " + str(wait_hosts) + " remote host(s)")
+                self.queue_elems.wait_hosts(wait_hosts)
+        else:
+            if no_devices > 0:
+                self.lanes = DeviceLanes(self.executor, no_devices, self.pqueue_maxsize, workers_per_device,
+                                         self.metrics)
+                self.queue_elems = self.lanes
+            else:
+                self.queue_elems = self.executor.queue(self.pqueue_maxsize)
+            self.queue_data = self.executor.queue(self.pqueue_maxsize)
+        # The librarian puts None in it when it is done
+        self.queue_done = self.executor.queue(1)
+        # What the stages send to the main process (results.put), read with iter(results) or results.sorted()
+        # once the run is done
+        self.results = ResultChannel()
 
-        self.logger.info("Started working on " + path)
+        self.logger.info("Started working on " + path + " with the " + self.executor.name + " executor")
 
         # Init processes
-        self.procs = {'walker': multiprocessing.Process(target=self.walk)}
+        self.procs = {'walker': self.new_process(self.walk, 'walker')}
         self.procs['walker'].start()
 
         for i in range(0, self.no_workers):
-            self.procs[str(i)] = multiprocessing.Process(target=self.worker, args=(i,))
-            self.procs[str(i)].start()
+            self.start_worker()
 
-        self.procs['librarian'] = multiprocessing.Process(target=self.librarian)
+        self.procs['librarian'] = self.new_process(self.run_librarian, 'librarian')
         self.procs['librarian'].start()
 
-        # Display statistics
-        while True:
+        # Progress, metrics and autoscaling on the side, the main thread only waits for the results
+        stop = threading.Event()
+        monitor = threading.Thread(target=self.monitor, args=(stop,), daemon=True)
+        monitor.start()
+
+        self.wait_librarian()
+        stop.set()
+        monitor.join()
+
+        self.logger.debug("Clean-up started!")
+        for name in list(self.procs):
+            self.procs.pop(name).join()
+        self.queue_data.close()
+        self.queue_elems.close()
+        self.queue_done.close()
+        self.executor.shutdown()
+        if self.journal is not None and self.librarian_done.value == 1 and self.interrupted.value == 0:
+            self.journal.remove()
+        if self.no_elems_resumed.value > 0:
+            self.logger.info('Resumed: ' + str(self.no_elems_resumed.value) + ' elems done by the interrupted run')
+        self.log_metrics(self.take_snapshot())
+        if self.coordinator is not None:
+            self.coordinator.shutdown()
+        if self.profile_dir is not None:
+            self.logger.info('Profile report: ' + profiling.merge_profiles(self.profile_dir))
+        self.logger.debug('ALL DONE!')
+
+    def monitor(self, stop):
+        """
+        Every print_timeout: display the progress, write the metrics and autoscale. Runs in a thread of the main
+        process until stop is set.
+        :param stop: threading.Event
+        :return:
+        """
+        while stop.wait(self.print_timeout) is False:
+            snapshot = self.take_snapshot()
             print('Indexed:', self.no_elems_indexed.value, end='')
             print('Skipped:', self.no_elems_skipped.value, end='')
             print(' - PROCESSED ', end='')
-            for i in range(0, self.no_workers):
+            for i in range(0, self.no_slots):
                 print(self.no_elems_processed[i], end='; ')
             print('- Logged: ', self.no_elems_logged.value, end='')
+            print(Metrics.status(snapshot), end='')
             print('', end='\r')
+            sys.stdout.flush()
 
-            while self.queue_to_main.empty() is False:
-                self.main_data.append(self.queue_to_main.get(block=False))
-
-            done = True
-            for i in range(0, self.no_workers):
-                if self.procs[str(i)].is_alive() is True:
-                    done = False
-                else:
-                    self.procs[str(i)].join()
-                    self.logger.debug('Joined with worker ' + str(i))
-
-            if done is True:
-                self.logger.debug("Clean-up started!")
-                self.queue_data.close()
-                self.queue_elems.close()
-                self.procs['walker'].join()
-                break
+            if self.autoscaler is not None and self.librarian_done.value == 0:
+                self.autoscale(snapshot)
 
-            time.sleep(self.print_timeout)
-            sys.stdout.flush()
+    def remote_state(self, tool_state):
+        """
+        What a remote host needs to build the workers of this tool, see hydra_worker.py
+        :param tool_state: attributes set by the tool before calling Hydra.__init__
+        :return: pickled dict with the module, the class and the attributes
+        """
+        module = type(self).__module__
+        if module == "__main__":
+            # Started as a script, the host imports it by its file name
+            module = os.path.splitext(os.path.basename(sys.modules['__main__'].__file__))[0]
+
+        state = {}
+        for name, value in tool_state.items():
+            if name in self.coordinator_only:
+                continue
+            try:
+                pickle.dumps(value)
+            except Exception as e:
+                self.logger.warning("Not sent to the remote workers: " + name + ", " + str(e))
+                continue
+            state[name] = value
+        return pickle.dumps({'module': module, 'class': type(self).__name__, 'state': state})
+
+    def workers_started(self):
+        """
+        :return: workers started so far, the ones of the remote hosts included
+        """
+        if self.coordinator is None:
+            return self.no_workers_started.value
+        return self.no_workers_started.value + self.queue_elems.remote_started()
 
-        # NOTE: librarian might be still processing data (example: heavy processing in
-        # db_commit), so we wait for it separately
+    def wait_librarian(self):
+        """
+        Wait until the librarian says it is done. The results it put are all written by then.
+        :return:
+        """
         while True:
-            # Get all remaining data
-            while self.queue_to_main.empty() is False:
-                print(self.queue_to_main.qsize())
-                self.main_data.append(self.queue_to_main.get(block=False))
-
-            # See it it is done, non-blocking
-            if self.procs['librarian'].is_alive() is False:
-                self.procs['librarian'].join()
-                break
+            try:
+                self.queue_done.get(timeout=self.print_timeout)
+                return
+            except queue.Empty:
+                # Killed before saying it
+                if self.procs['librarian'].is_alive() is False:
+                    self.logger.error('The librarian died')
+                    return
+
+    def start_worker(self):
+        """
+        Start a worker in the first free slot
+        :return: index of the worker, None if every slot still has a worker running
+        """
+        free = [i for i in range(0, self.no_slots)
+                if str(i) not in self.procs or self.procs[str(i)].is_alive() is False]
+        if len(free) == 0:
+            return None
+        index = free[0]
+        if str(index) in self.procs:
+            self.procs.pop(str(index)).join()
+            self.logger.debug('Joined with worker ' + str(index))
+        self.retire[index] = 0
+        self.no_workers_started.value += 1
+        if self.lanes is not None:
+            self.lanes.worker_started()
+        worker = self.worker_async if self.executor.coroutines is True else self.worker
+        self.procs[str(index)] = self.new_process(worker, 'worker', (index,))
+        self.procs[str(index)].start()
+        return index
+
+    def autoscale(self, snapshot):
+        """
+        Start or retire workers, as the autoscaler decides from the last interval. A retired worker finishes
+        its current batch first.
+        :param snapshot: metrics of the last interval
+        :return:
+        """
+        running = [i for i in range(0, self.no_slots)
+                   if str(i) in self.procs and self.procs[str(i)].is_alive() is True and self.retire[i] == 0]
+        wanted, reason = self.autoscaler.decide(len(running), snapshot)
+        if reason is None:
+            return
+
+        self.logger.info('Autoscale: ' + str(len(running)) + ' -> ' + str(wanted) + ' workers, ' + reason)
+        if wanted > len(running):
+            # Retired workers still on their last batch (or waiting for one) are kept instead, their slot is not
+            # free yet
+            retiring = [i for i in range(0, self.no_slots)
+                        if str(i) in self.procs and self.procs[str(i)].is_alive() is True and self.retire[i] == 1]
+            kept = retiring[:wanted - len(running)]
+            for i in kept:
+                self.retire[i] = 0
+            for i in range(len(running) + len(kept), wanted):
+                if self.start_worker() is None:
+                    break
+        else:
+            for i in sorted(running, reverse=True)[:len(running) - wanted]:
+                self.retire[i] = 1
+
+    def new_process(self, target, stage, args=()):
+        """
+        :param target: function run by the process
+        :param stage: name of the stage, for the profile report
+        :param args: arguments for target
+        :return: process, thread or task depending on the executor, not started
+        """
+        if self.profile is None or asyncio.iscoroutinefunction(target):
+            return self.executor.process(target, args)
+        return self.executor.process(profiling.Profiled(target, stage, self.profile_dir, self.profile, args))
 
-            time.sleep(1.0)
+    def take_snapshot(self):
+        """
+        Collect the metrics and write them to the metrics file, if any
+        :return: snapshot, see utils.metrics.Metrics.snapshot
+        """
+        snapshot = self.metrics.snapshot({'elems': self.queue_elems, 'data': self.queue_data})
+        if self.metrics_file is not None:
+            try:
+                Metrics.write(snapshot, self.metrics_file)
+            except OSError as e:
+                self.logger.warning("Could not write metrics to " + self.metrics_file + ": " + str(e))
+        return snapshot
 
-        self.queue_to_main.close()
-        self.logger.debug('ALL DONE!')
+    def log_metrics(self, snapshot):
+        """
+        Summary of the run: speed of each stage, to see which one held the others back
+        :param snapshot: final snapshot
+        :return:
+        """
+        for name, stage in snapshot['stages'].items():
+            busy = ''
+            if stage['busy_seconds'] is not None:
+                busy = ', busy ' + '%.1f' % stage['busy_seconds'] + 's'
+            self.logger.info('Stage ' + name + ': ' + str(stage['elems']) + ' elems, ' +
+                             '%.1f' % stage['elems_per_sec'] + ' elems/s, ' +
+                             '%.2f' % (stage['bytes_per_sec'] / 1e6) + ' MB/s' + busy)
+        for device in snapshot['devices']:
+            self.logger.info('Device ' + device['device'] + ': ' + str(device['elems']) + ' elems, ' +
+                             '%.2f' % (device['bytes_per_sec'] / 1e6) + ' MB/s, busy ' +
+                             '%.1f' % device['busy_seconds'] + 's')
+        for elem in snapshot['slowest']:
+            self.logger.debug('Slow: ' + elem['path'] + ' took ' + '%.3f' % elem['seconds'] + 's')
 
     def init_logging(self, level, file):
         """
@@ -130,6 +435,85 @@ class Hydra:
 
         self.logger.debug('Logging configured')
 
+    @staticmethod
+    def add_arguments(parser):
+        """
+        Command line options common to all the tools
+        :param parser: argparse parser of the tool
+        :return:
+        """
+        parser.add_argument('--batch-size', help='Elems sent to the workers at once, 0 to adapt it to the work time',
+                            type=int, default=0)
+        parser.add_argument('--walkers', help='Threads walking the folders in parallel', type=int, default=4)
+        parser.add_argument('--metrics', help='Write throughput, queue depths and latency histograms to this file '
+                                              'while running: Prometheus text format if it ends with .prom, JSON '
+                                              'otherwise', default=None, metavar='FILE')
+        parser.add_argument('--profile', help='Profile the walker, the workers and the librarian, the merged report '
+                                              'is written in a profile_* folder in the target. sampling needs '
+                                              'pyinstrument', nargs='?', const='cprofile', choices=profiling.MODES,
+                            default=None)
+        parser.add_argument('--autoscale', help='Start and retire workers while running, between MIN and MAX. '
+                                                '--workers is the number to start with',
+                            type=Hydra.parse_bounds, default=None, metavar='MIN:MAX')
+        parser.add_argument('--journal', help='Journal of the results, to resume an interrupted run. Default: one '
+                                              'per tool and target in ~/.cache/hydra/journals', default='auto',
+                            metavar='FILE')
+        parser.add_argument('--no-journal', help='Do not keep a journal', action='store_const', const=None,
+                            dest='journal')
+        parser.add_argument('--resume', help='Skip what the journal of an interrupted run has, and use its results',
+                            action='store_true')
+        parser.add_argument('--executor', help='Run the stages as processes, threads or asyncio tasks. Default: '
+                                               'what suits the tool', choices=EXECUTORS, default=None)
+        parser.add_argument('--serve', help='Let workers on other hosts (hydra_worker.py) connect to this address '
+                                            'and take part, the walker and the librarian stay here. Port 0 for any '
+                                            'free port', default=None, metavar='HOST:PORT')
+        parser.add_argument('--authkey', help='Shared secret of the remote workers. Default: $HYDRA_AUTHKEY',
+                            default=os.environ.get('HYDRA_AUTHKEY'))
+        parser.add_argument('--layout', help='Send the files in the order they are on the disk: sorted on their '
+                                             'first extent (FIEMAP) or their inode. auto sorts on the extent on '
+                                             'spinning disks only. Default: what suits the tool',
+                            choices=layout.LAYOUTS, default=None)
+        parser.add_argument('--readers-per-device', help='Workers reading big files at once on each spinning '
+                                                         'disk, 0 for no limit', type=int, default=2)
+        parser.add_argument('--workers-per-device', help='Workers on the files of one device at once. Default: as '
+                                                         'many as possible while leaving one to each other device '
+                                                         'with files waiting', type=int, default=0, metavar='N')
+        parser.add_argument('--wait-hosts', help='Wait for this many remote hosts before walking', type=int,
+                            default=0, metavar='N')
+
+    @staticmethod
+    def options(args):
+        """
+        :param args: parsed command line, see add_arguments
+        :return: dict of keyword arguments for Hydra.__init__
+        """
+        return {'batch_size': args.batch_size,
+                'walkers': args.walkers,
+                'metrics_file': args.metrics,
+                'profile': args.profile,
+                'executor': args.executor,
+                'autoscale': args.autoscale,
+                'journal': args.journal,
+                'resume': args.resume,
+                'serve': args.serve,
+                'authkey': args.authkey,
+                'wait_hosts': args.wait_hosts,
+                'layout_mode': args.layout,
+                'readers_per_device': args.readers_per_device,
+                'workers_per_device': args.workers_per_device}
+
+    @staticmethod
+    def parse_bounds(text):
+        """
+        :param text: MIN:MAX, from the command line
+        :return: (min, max)
+        """
+        try:
+            min_workers, max_workers = [int(bound) for bound in text.split(':')]
+        except ValueError:
+            raise argparse.ArgumentTypeError("Expected MIN:MAX, got " + text)
+        return min_workers, max_workers
+
     def get_user_approval(self, message):
         """
         Make the user take a decision, log and return
@@ -145,6 +529,35 @@ class Hydra:
                 self.logger.warning("USER APPROVED!")
                 return True
 
+    def walk_files(self):
+        """
+        Look for files on in the given location. Keeps only regular files (an symlinks) that are not empty.
+        Counts the skipped files, the caller decides what to do with the rest.
+        :return: Generator of (FileEntry, stat result) for each usable file. FileEntry is the full path, with the
+                 stat result attached so the workers do not need to stat the file again.
+        """
+        errors = []
+        for f, fstat in walk_tree(self.target_path, self.no_walkers, self.walk_ordered, errors):
+            if fstat is None:
+                self.logger.warning("Skipped " + f + ", cannot stat it!")
+                self.no_elems_skipped.value += 1
+                continue
+            if stat.S_ISREG(fstat.st_mode) is False:
+                self.logger.info("Skipped" + f + ", not a regular file!")
+                self.no_elems_skipped.value += 1
+                continue
+            if fstat.st_size == 0:
+                # Skip files of size 0, cannot do anything with them
+                self.logger.info("Skipped " + f + ", size 0")
+                self.no_elems_skipped.value += 1
+                continue
+
+            self.logger.debug("FOUND " + f)
+            yield FileEntry(f, fstat), fstat
+
+        for path, error in errors:
+            self.logger.warning("Could not read " + path + ": " + str(error))
+
     def walk(self):
         """
         Look for files on in the given location. Keeps only regular files (an symlinks).
@@ -153,37 +566,83 @@ class Hydra:
         """
         self.logger.debug('Walker init for ' + self.target_path)
 
-        for root, dirs, files in os.walk(self.target_path):
-            for file in sorted(files):
-                f = os.path.join(root, file)
-                fstat = os.stat(f)
-                if stat.S_ISREG(fstat.st_mode) is False:
-                    self.logger.info("Skipped" + f + ", not a regular file!")
-                    self.no_elems_skipped.value += 1
-                    continue
-                if fstat.st_size == 0:
-                    self.logger.info("Skipped " + f + ", size 0")
-                    self.no_elems_skipped.value += 1
-                    continue
-
-                # Skip files of size 0, cannot do anything with them
-
-                self.logger.debug("FOUND " + f)
-                self.no_elems_indexed.value += 1
-                self.queue_elems.put(f)
+        for f, fstat in self.walk_files():
+            self.no_elems_indexed.value += 1
+            self.put_elem(f)
 
         self.logger.info('Processed ' + str(self.no_elems_indexed.value) + ' files')
         self.worker_signal_done()
 
+    def current_batch_size(self):
+        """
+        :return: how many elems to send in one batch
+        """
+        if self.batch_size > 0:
+            return self.batch_size
+        if self.work_time.value == 0:
+            # Nothing measured yet, get the workers going
+            return 1
+        return max(1, min(self.batch_max, int(self.batch_target_time / self.work_time.value)))
+
+    def put_elem(self, elem):
+        """
+        Send an elem to the workers, in batches and in disk order if layout is on. Use this in walk().
+        :param elem: what to send to work()
+        :return:
+        """
+        if str(elem) in self.journaled:
+            # Done by the interrupted run, the librarian replays its result
+            self.no_elems_resumed.value += 1
+            return
+
+        if self.layout is None:
+            self.add_to_batch(elem)
+            return
+        for ready in self.layout.add(elem):
+            self.add_to_batch(ready)
+
+    def add_to_batch(self, elem):
+        """
+        Add an elem to the current batch, send the batch to the workers when complete
+        :param elem: what to send to work()
+        :return:
+        """
+        if len(self.batch) == 0:
+            self.batch_start = time.monotonic()
+        self.batch.append(elem)
+        self.metrics.walked(elem)
+
+        if len(self.batch) >= self.current_batch_size() or \
+                time.monotonic() - self.batch_start > self.batch_max_delay:
+            self.flush_elems()
+
+    def flush_elems(self):
+        """
+        Send the current batch to the workers, even if not complete
+        :return:
+        """
+        if len(self.batch) > 0:
+            self.queue_elems.put(self.batch)
+            self.batch = []
+
     def worker_signal_done(self):
         """
         Signal to the workers that there is no more data to process and that they should close
         :return:
         """
+        if self.layout is not None:
+            for elem in self.layout.flush():
+                self.add_to_batch(elem)
+            if self.layout.no_sorted > 0:
+                self.logger.info('Sent ' + str(self.layout.no_sorted) + ' files in disk order (' +
+                                 self.layout.mode + ')')
+        self.flush_elems()
+        # Before the workers can end, so that all is written when the librarian is done
+        self.results.flush()
+        self.metrics.walk_done()
         self.logger.debug('No more work, closing workers')
-        # Signal that the list of files is done. Do it for each worker
-        for i in range(0, self.no_workers):
-            self.queue_elems.put(None)
+        # Signal that the list of files is done. Each worker puts it back for the next one, however many are running.
+        self.queue_elems.put(None)
 
     def work(self, index, input_data):
         """
@@ -214,44 +673,156 @@ class Hydra:
         self.init(index)
         self.logger.debug('Worker ' + str(index) + ' init done!')
 
-        while True:
-            target_data = self.queue_elems.get()
-            s_targetdata = str(target_data) #Used for logging stuff, making sure it is a string
-            if target_data is None:
+        while self.retire[index] == 0:
+            lane = None
+            if self.lanes is not None:
+                batch, lane = self.lanes.take(index)
+            else:
+                batch = self.queue_elems.get()
+            if batch is None:
+                self.queue_elems.put(None)
                 break
 
+            start = time.monotonic()
             try:
-                self.logger.debug("Worker " + str(index) + " working on " + s_targetdata)
-                result = self.work(index, target_data)
-                if result is None:
-                    #NOTE: worker should log the info why something is wrong!
-                    continue
-
-                self.no_elems_processed[index] += 1
-                self.logger.debug("Worker " + str(index) + " working on " + s_targetdata + " came up with" + str(result))
-
-                data = {"path": target_data,
-                        "result": result}
-                self.queue_data.put(data)
-            except PermissionError:
-                self.logger.warning('Permission denied for data ' + s_targetdata)
-            except OSError:
-                self.logger.error('ERROR READING FILE ' + s_targetdata)
-            except FileNotFoundError:
-                self.logger.warning('File ' + s_targetdata + ' not found! Maybe symlink?')
-            except KeyboardInterrupt:
-                self.logger.info("STOPPED BY USER")
+                results, stop = self.work_batch(index, batch)
+            finally:
+                if lane is not None:
+                    self.lanes.release(lane)
+            if lane is not None:
+                self.metrics.device_worked(index, lane, batch, time.monotonic() - start)
+            if len(results) > 0:
+                self.queue_data.put(results)
+            if stop is True:
                 break
-            except:
-                self.logger.error('ERROR FOR FILE' + s_targetdata)
-                self.logger.exception('This is the exception')
 
+        if self.lanes is not None:
+            self.lanes.worker_stopped()
         self.logger.info('Worker ' + str(index) + ' finished, processing ' +
                           str(self.no_elems_processed[index]) + ' elems')
 
         # Signal to the librarian that this worker is done
         self.queue_data.put(None)
 
+    async def worker_async(self, index):
+        """
+        Same as worker, as a task on the loop of the asyncio executor. If work() is a coroutine it is awaited for
+        each elem, otherwise whole batches are run in the thread pool of the loop.
+        :param index: Used to identify individual workers.
+        :return: Nothing. Puts results in another queue.
+        """
+        loop = asyncio.get_running_loop()
+        self.logger.debug('Worker ' + str(index) + ' started')
+        await loop.run_in_executor(None, self.init, index)
+        self.logger.debug('Worker ' + str(index) + ' init done!')
+
+        while self.retire[index] == 0:
+            batch = await self.queue_elems.aget()
+            if batch is None:
+                await self.queue_elems.aput(None)
+                break
+
+            if asyncio.iscoroutinefunction(self.work):
+                results, stop = await self.work_batch_async(index, batch)
+            else:
+                results, stop = await loop.run_in_executor(None, self.work_batch, index, batch)
+            if len(results) > 0:
+                await self.queue_data.aput(results)
+            if stop is True:
+                break
+
+        self.logger.info('Worker ' + str(index) + ' finished, processing ' +
+                          str(self.no_elems_processed[index]) + ' elems')
+
+        # Signal to the librarian that this worker is done
+        await self.queue_data.aput(None)
+
+    def work_batch(self, index, batch):
+        """
+        Call work() for each elem of a batch
+        :param index: Index of the worker
+        :param batch: elems from the walker
+        :return: (list of results for the librarian, True if the user stopped the worker)
+        """
+        results = []
+        for target_data in batch:
+            start = time.monotonic()
+            try:
+                self.logger.debug("Worker " + str(index) + " working on " + str(target_data))
+                with self.reader_slot(target_data):
+                    result = self.work(index, target_data)
+                self.work_done(index, target_data, result, time.monotonic() - start, results)
+            except BaseException as e:
+                if self.work_failed(target_data, e) is True:
+                    return results, True
+        return results, False
+
+    def reader_slot(self, elem):
+        """
+        :param elem: elem about to be worked on
+        :return: semaphore of its device if it is a big file on a spinning disk, a no-op context otherwise
+        """
+        if self.reader_slots is None or isinstance(elem, FileEntry) is False or \
+                elem.stat.st_size < self.large_file_size or layout.rotational(elem.stat.st_dev) is not True:
+            return contextlib.nullcontext()
+        return self.reader_slots[elem.stat.st_dev % len(self.reader_slots)]
+
+    async def work_batch_async(self, index, batch):
+        """
+        Same as work_batch, for a coroutine work()
+        """
+        results = []
+        for target_data in batch:
+            start = time.monotonic()
+            try:
+                self.logger.debug("Worker " + str(index) + " working on " + str(target_data))
+                result = await self.work(index, target_data)
+                self.work_done(index, target_data, result, time.monotonic() - start, results)
+            except BaseException as e:
+                if self.work_failed(target_data, e) is True:
+                    return results, True
+        return results, False
+
+    def work_done(self, index, target_data, result, elapsed, results):
+        """
+        Account for one call of work() and keep its result for the librarian
+        :param results: where to add the result
+        """
+        # Moving average, used by the walker to size the batches
+        self.work_time.value = 0.9 * self.work_time.value + 0.1 * elapsed
+        self.metrics.worked(index, target_data, elapsed)
+        if result is None:
+            #NOTE: worker should log the info why something is wrong!
+            return
+
+        self.no_elems_processed[index] += 1
+        self.logger.debug("Worker " + str(index) + " working on " + str(target_data) + " came up with" + str(result))
+
+        data = {"path": target_data,
+                "result": result}
+        if self.hash_cache is not None:
+            data["cache"] = self.hash_cache.drain()
+        results.append(data)
+
+    def work_failed(self, target_data, error):
+        """
+        Log why work() failed. Called while handling the exception.
+        :return: True if the worker must stop
+        """
+        s_targetdata = str(target_data) #Used for logging stuff, making sure it is a string
+        if isinstance(error, PermissionError):
+            self.logger.warning('Permission denied for data ' + s_targetdata)
+        elif isinstance(error, OSError):
+            self.logger.error('ERROR READING FILE ' + s_targetdata)
+        elif isinstance(error, KeyboardInterrupt):
+            self.logger.info("STOPPED BY USER")
+            self.interrupted.value = 1
+            return True
+        else:
+            self.logger.error('ERROR FOR FILE' + s_targetdata)
+            self.logger.exception('This is the exception')
+        return False
+
     def db_insert(self, data):
         """
         Insert information in a database. Can and should be overridden.
@@ -269,34 +840,72 @@ class Hydra:
         """
         print("COMMIT!")
 
+    def run_librarian(self):
+        """
+        Librarian stage: tell the main process when it is done, even if it failed
+        :return:
+        """
+        try:
+            self.librarian()
+        finally:
+            self.results.flush()
+            self.queue_done.put(None)
+
     def librarian(self):
         """
-        Logs results to a database. The results are taken from a queue.
+        Logs results to a database. The results are taken from a queue, in batches.
         The processes terminates after processing all the data and after seeing that all the workers are done. This is
-        done by counting the None values in the queue.
+        done by counting the None values in the queue, one per worker started, retired workers included.
         :return:
         """
         self.logger.debug('Librarian started!')
 
+        # Results of the interrupted run first, as if the workers had sent them again
+        if self.journal is not None:
+            for elem in self.journal.replay():
+                self.db_insert(elem)
+                self.no_elems_logged.value += 1
+            self.logger.info('Replayed ' + str(self.no_elems_logged.value) + ' results from the journal')
+
         workers_done = 0
 
-        while True:
-            data = self.queue_data.get()
-            if data is None:
-                workers_done += 1
-                # All workers are done, no need to wait anymore
-                if workers_done == self.no_workers:
-                    break
-                continue
+        try:
+            while True:
+                data = self.queue_data.get()
+                if data is None:
+                    workers_done += 1
+                    # All workers are done and no more will start, no need to wait anymore
+                    if workers_done == self.workers_started() and self.metrics.walker_done.value == 1:
+                        break
+                    continue
 
-            if data == 'COMMIT':
-                self.db_commit()
-            else:
-                self.db_insert(data)
-                self.no_elems_logged.value += 1
+                if data == 'COMMIT':
+                    start = time.monotonic()
+                    self.db_commit()
+                    self.metrics.librarian_seconds.value += time.monotonic() - start
+                    continue
+
+                for elem in data:
+                    start = time.monotonic()
+                    if "cache" in elem:
+                        self.hash_cache.store(elem["cache"])
+                    self.db_insert(elem)
+                    if self.journal is not None:
+                        self.journal.add(elem)
+                    self.no_elems_logged.value += 1
+                    self.metrics.stored(elem["path"], time.monotonic() - start)
+        finally:
+            # Even on Ctrl+C: what was stored is what a resumed run skips
+            if self.journal is not None:
+                self.journal.close()
 
         self.logger.info('FINAL COMMIT!')
+        start = time.monotonic()
         self.db_commit()
+        self.metrics.librarian_seconds.value += time.monotonic() - start
+        if self.hash_cache is not None:
+            self.hash_cache.flush()
+        self.librarian_done.value = 1
         self.logger.info('Librarian finished processing ' + str(self.no_elems_logged.value) + '!')
 
 
@@ -306,10 +915,11 @@ if __name__ == "__main__":
     parser.add_argument('target', help='Path to index')
     parser.add_argument('--workers', help='Number of workers to spawn',
             type=int, default=4)
+    Hydra.add_arguments(parser)
 
     args = parser.parse_args()
 
     start = datetime.datetime.now()
-    h = Hydra(args.target, args.workers)
+    h = Hydra(args.target, args.workers, **Hydra.options(args))
     stop = datetime.datetime.now()
     print("This took ", stop - start)
@@ -1,87 +1,272 @@
 #!/usr/bin/python3
 import argparse
+import csv
 import datetime
+import json
+import logging
 import os
 import sqlite3
+import sys
 
-from hydra import Hydra
+from db.filesdb import schema_version, hash_algorithms, SCHEMA_VERSION
+from utils import profiling
+from utils.distributed import under
 
 
-class CompareDb(Hydra):
-    def __init__(self, sourcedb, targetdb, no_workers):
+class ReportWriter():
+    """
+    Streams compare results to a CSV or JSON lines file
+    """
+    fields = ["kind", "path", "hash", "size", "other"]
+
+    def __init__(self, output, report_format):
+        self.output = output
+        self.report_format = report_format
+        if report_format == "csv":
+            self.writer = csv.writer(output)
+            self.writer.writerow(self.fields)
+
+    def write(self, rows):
+        """
+        :param rows: list of (kind, path, hash, size, other) tuples
+        """
+        for row in rows:
+            row = (row[0], row[1], row[2].hex(), row[3], row[4])
+            if self.report_format == "csv":
+                self.writer.writerow(row)
+            else:
+                self.output.write(json.dumps(dict(zip(self.fields, row))) + "\n")
+
+
+class CompareDb():
+    """
+    Compare two files databases as sets of hashes:
+     - source_only: files of the source not found (by hash) in the target
+     - target_only: files of the target not found in the source
+     - path_mismatch: files found in both, but with a different path
+    Paths are compared relative to the given roots, or by file name if no root is given.
+    """
+    def __init__(self, sourcedb, targetdb, report, report_format="csv", source_root=None, target_root=None,
+                 mode="auto", merge_threshold=5000000, batch_size=10000):
+        for db in (sourcedb, targetdb):
+            if schema_version(db) < SCHEMA_VERSION:
+                raise ValueError(db + " uses an old schema, update it with hydra_migratedb.py")
+
+        # Hashes made with different algorithms never match
+        algorithms = set(hash_algorithms(sourcedb)) | set(hash_algorithms(targetdb))
+        if len(algorithms) > 1:
+            raise ValueError("The databases use different hash algorithms: " + ", ".join(sorted(algorithms)))
+
         self.sourcedb = sourcedb
         self.targetdb = targetdb
+        self.source_root = source_root
+        self.target_root = target_root
+        self.batch_size = batch_size
+        self.counts = {"source_only": 0, "target_only": 0, "path_mismatch": 0}
+
+        current_time = datetime.datetime.now().strftime("%Y%m%d_%H%M")
+        self.init_logging(logging.INFO, "compare_dbs_" + current_time + ".log")
+
+        no_rows = max(self.count_rows(sourcedb), self.count_rows(targetdb))
+        if mode == "auto":
+            mode = "merge" if no_rows > merge_threshold else "join"
+        self.logger.info("Comparing " + sourcedb + " with " + targetdb + ", " + mode + " mode")
 
-        # Store the db in memory for each worker
-        self.mem_dbs = list(range(no_workers))
+        self.report = ReportWriter(report, report_format)
+        if mode == "join":
+            self.compare_join()
+        else:
+            self.compare_merge()
 
-        # Init hydra stuff - this starts all the workers
-        super().__init__(os.getcwd(), no_workers, 'compare_dbs')
+        for kind in self.counts:
+            self.logger.warning(kind + ": " + str(self.counts[kind]) + " files")
 
-    def walk(self):
+    def init_logging(self, level, file):
         """
-        Override the walk function to walk the source database
-        :return:
+        Same setup as the Hydra tools: log file in the current folder, info on the console
         """
-        self.logger.debug('Walker init for ' + self.sourcedb)
-        source_conn = sqlite3.connect(self.sourcedb)
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(logging.DEBUG)
+
+        if not len(self.logger.handlers):
+            handler = logging.FileHandler(os.path.join(os.getcwd(), file))
+            handler.setLevel(level)
+
+            chandler = logging.StreamHandler()
+            chandler.setLevel(logging.INFO)
+
+            formatter = logging.Formatter('%(asctime)s - %(funcName)s - %(levelname)s - %(message)s')
+            handler.setFormatter(formatter)
+            chandler.setFormatter(formatter)
+
+            self.logger.addHandler(handler)
+            self.logger.addHandler(chandler)
 
-        source_curs = source_conn.cursor()
-        source_curs.execute('SELECT * FROM {}'.format("files"))
+    @staticmethod
+    def count_rows(db_file):
+        conn = sqlite3.connect(db_file)
+        # max(id) is instant and close enough to count(*) for choosing the mode
+        no_rows = conn.execute("SELECT max(id) FROM files").fetchone()[0]
+        conn.close()
+        return no_rows or 0
 
+    @staticmethod
+    def relative(path, root):
+        """
+        Part of the path used for comparing: relative to root, or just the file name
+        """
+        if root is None:
+            return os.path.basename(path)
+        if under(path, root):
+            return path[len(root):].lstrip(os.sep)
+        return path
+
+    def emit(self, cursor):
+        """
+        Stream the rows of a result set to the report, in batches
+        """
         while True:
-            elem = source_curs.fetchone()
-            if elem is None:
+            rows = cursor.fetchmany(self.batch_size)
+            if len(rows) == 0:
                 break
+            self.write_rows(rows)
 
-            self.no_elems_indexed.value += 1
-            self.queue_elems.put(elem) # Put entire element - easier to print stuff
+    def compare_join(self):
+        """
+        Both databases in the same connection, the differences are computed by sqlite using the hash indexes
+        """
+        conn = sqlite3.connect(self.sourcedb)
+        conn.execute("ATTACH DATABASE ? AS target", (self.targetdb,))
+        conn.create_function("rel_source", 1, lambda path: self.relative(path, self.source_root), deterministic=True)
+        conn.create_function("rel_target", 1, lambda path: self.relative(path, self.target_root), deterministic=True)
+
+        # Files without a hash (NULL after the migration of a v1 db) cannot be compared
+        self.logger.info("Looking for files only in the source")
+        self.emit(conn.execute(
+            "SELECT 'source_only', s.path, s.hash, s.size, NULL FROM main.files s "
+            "WHERE NOT s.missing AND s.hash IS NOT NULL AND "
+            "NOT EXISTS (SELECT 1 FROM target.files t WHERE t.hash = s.hash AND NOT t.missing)"))
+
+        self.logger.info("Looking for files only in the target")
+        self.emit(conn.execute(
+            "SELECT 'target_only', t.path, t.hash, t.size, NULL FROM target.files t "
+            "WHERE NOT t.missing AND t.hash IS NOT NULL AND "
+            "NOT EXISTS (SELECT 1 FROM main.files s WHERE s.hash = t.hash AND NOT s.missing)"))
+
+        self.logger.info("Looking for files with a different path")
+        self.emit(conn.execute(
+            "SELECT 'path_mismatch', s.path, s.hash, s.size, min(t.path) FROM main.files s "
+            "JOIN target.files t ON t.hash = s.hash AND NOT t.missing WHERE NOT s.missing AND s.hash IS NOT NULL "
+            "GROUP BY s.id HAVING sum(rel_source(s.path) = rel_target(t.path)) = 0"))
 
-        self.logger.debug('Processed ' + str(self.no_elems_indexed.value) + ' files')
-        self.worker_signal_done()
+        conn.close()
 
-    def init(self, index):
+    def read_sorted(self, db_file):
         """
-        For each worker, create a memory db and save cursors
-        :param index:
-        :return:
+        :return: generator of (hash, [(path, size), ...]) in hash order
         """
-        self.logger.debug("Creating mem db for worker " + str(index))
-        target_conn = sqlite3.connect(self.targetdb)
-        tmp = sqlite3.connect(':memory:')
-        self.mem_dbs[index] = tmp.cursor()
-        target_conn.backup(tmp)
-        target_conn.close()
-        self.logger.debug("Done creating mem db for worker " + str(index))
+        conn = sqlite3.connect(db_file)
+        # Files without a hash cannot be compared
+        cursor = conn.execute("SELECT hash, path, size FROM files WHERE NOT missing AND hash IS NOT NULL ORDER BY hash")
 
-    def work(self, index, input_data):
-        filename = input_data[1]
-        hash = input_data[2]
-        self.mem_dbs[index].execute('SELECT path FROM files WHERE hash=?', (hash,))
+        group_hash = None
+        group = []
+        while True:
+            rows = cursor.fetchmany(self.batch_size)
+            if len(rows) == 0:
+                break
+            for file_hash, path, size in rows:
+                if file_hash != group_hash and len(group) > 0:
+                    yield group_hash, group
+                    group = []
+                group_hash = file_hash
+                group.append((path, size))
 
-        found = self.mem_dbs[index].fetchone()
-        self.logger.debug("For "+ filename + "(" + hash + ") found " + str(found))
-        if found is not None:
-            return True
-        else:
-            return False
+        if len(group) > 0:
+            yield group_hash, group
+        conn.close()
+
+    def compare_merge(self):
+        """
+        Walk both databases in hash order at the same time. Memory use does not depend on the size of the
+        databases, only on the number of files sharing a hash.
+        """
+        source = self.read_sorted(self.sourcedb)
+        target = self.read_sorted(self.targetdb)
+        s = next(source, None)
+        t = next(target, None)
+
+        rows = []
+        while s is not None or t is not None:
+            if t is None or (s is not None and s[0] < t[0]):
+                rows.extend(("source_only", path, s[0], size, None) for path, size in s[1])
+                s = next(source, None)
+            elif s is None or t[0] < s[0]:
+                rows.extend(("target_only", path, t[0], size, None) for path, size in t[1])
+                t = next(target, None)
+            else:
+                target_paths = set(self.relative(path, self.target_root) for path, size in t[1])
+                other = min(path for path, size in t[1])
+                for path, size in s[1]:
+                    if self.relative(path, self.source_root) not in target_paths:
+                        rows.append(("path_mismatch", path, s[0], size, other))
+                s = next(source, None)
+                t = next(target, None)
+
+            if len(rows) >= self.batch_size:
+                self.write_rows(rows)
+                rows = []
+
+        self.write_rows(rows)
+
+    def write_rows(self, rows):
+        """
+        Send rows to the report and keep statistics
+        """
+        self.report.write(rows)
+        for row in rows:
+            self.counts[row[0]] += 1
 
-    def db_insert(self, data):
-        if data['result'] is not True:
-            file = data['path'][1]
-            self.logger.warning(file + " not found in " + self.targetdb)
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Multiprocess file indexer")
+    parser = argparse.ArgumentParser(description="Compare two files databases")
 
     parser.add_argument('source', help='Path to database 1')
     parser.add_argument('target', help='Path to database 2')
-    parser.add_argument('--workers', help='Number of workers to spawn',
-                        type=int, default=4)
+    parser.add_argument('--report', help='Where to write the differences, - for stdout', default=None)
+    parser.add_argument('--format', help='Report format', choices=['csv', 'json'], default='csv')
+    parser.add_argument('--source-root', help='Compare paths relative to this root (default: file names only)')
+    parser.add_argument('--target-root', help='Compare paths relative to this root (default: file names only)')
+    parser.add_argument('--mode', help='join: ATTACH and indexed joins, merge: sorted merge over hash order '
+                                       '(constant memory), auto: merge for large databases',
+                        choices=['auto', 'join', 'merge'], default='auto')
+    parser.add_argument('--merge-threshold', help='Rows above which auto uses the merge mode',
+                        type=int, default=5000000)
+    parser.add_argument('--workers', help='Ignored, kept for compatibility', type=int, default=4)
+    parser.add_argument('--profile', help='Profile the comparison, the report is written in a profile_* folder',
+                        nargs='?', const='cprofile', choices=profiling.MODES, default=None)
 
     args = parser.parse_args()
 
+    report_file = args.report
+    if report_file is None:
+        report_file = "compare_" + datetime.datetime.now().strftime("%Y%m%d_%H%M") + "." + args.format
+
+    def compare():
+        if report_file == "-":
+            return CompareDb(args.source, args.target, sys.stdout, args.format, args.source_root, args.target_root,
+                             args.mode, args.merge_threshold)
+        with open(report_file, "w", newline="") as report:
+            return CompareDb(args.source, args.target, report, args.format, args.source_root, args.target_root,
+                             args.mode, args.merge_threshold)
+
     start = datetime.datetime.now()
-    h = CompareDb(args.source, args.target, args.workers)
+    if args.profile is None:
+        h = compare()
+    else:
+        profile_dir = "profile_" + start.strftime("%Y%m%d_%H%M")
+        os.makedirs(profile_dir, exist_ok=True)
+        h = profiling.profile_call(compare, profile_dir, "compare", args.profile)
+        print("Profile report:", profiling.merge_profiles(profile_dir))
     stop = datetime.datetime.now()
     print("This took ", stop - start)
@@ -3,6 +3,9 @@
 import argparse
 import datetime
 
+from hydra import Hydra
+from fileinfo import HashCache
+from fileinfo.hashcache import DEFAULT_PATH
 from hydra_movetodatefolder import ToDateFolder
 
 if __name__ == "__main__":
@@ -12,10 +15,21 @@ if __name__ == "__main__":
     parser.add_argument('destination', help='Where to move the files. NOTE: it will create subfolders YYYYMMDD in here.')
     parser.add_argument('--workers', help='Number of workers to spawn', type=int, default=4)
     parser.add_argument('--similar', help='Look for similar files in the destination folder', action='store_true')
+    parser.add_argument('--batch', help='Batch mode. Takes the first date when unsure and does not ask for approval',
+                        action='store_true')
+    parser.add_argument('--hash-cache', help='Use a persistent hash cache, shared with the other tools. Speeds up '
+                                             'finding renamed copies with --similar',
+                        nargs='?', const=DEFAULT_PATH, default=None, metavar='PATH')
+    Hydra.add_arguments(parser)
 
     args = parser.parse_args()
 
+    hash_cache = None
+    if args.hash_cache is not None:
+        hash_cache = HashCache(args.hash_cache)
+
     start = datetime.datetime.now()
-    h = ToDateFolder(args.source, args.destination, args.workers, True, args.similar)
+    h = ToDateFolder(args.source, args.destination, args.workers, True, args.similar, args.batch, hash_cache,
+                     **Hydra.options(args))
     stop = datetime.datetime.now()
     print("This took ", stop - start)
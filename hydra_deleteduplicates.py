@@ -5,33 +5,51 @@ import argparse
 import re
 import os
 import multiprocessing
-from collections import OrderedDict
-from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
 
 from hydra import Hydra
-from fileinfo import HashFile
+from fileinfo import HashFile, HashCache, ALGORITHMS, DEFAULT_ALGORITHM
+from fileinfo.hashcache import DEFAULT_PATH
+from utils.walker import file_stat
+from utils.fileops import FileOps, Operation, DELETE
 
 
 class DeleteDuplicates(Hydra):
-    def __init__(self, path, no_workers, batch_mode = False, reverse = False):
+    # Results are sorted before looking for duplicates
+    walk_ordered = False
+    # work() only hashes the edges of the files, which releases the GIL
+    default_executor = 'thread'
+    # Nothing is deleted before all the hashes are there
+    resumable = True
+    # Filled by the librarian
+    coordinator_only = ('file_hashes',)
+    default_layout = 'auto'
+
+    def __init__(self, path, no_workers, batch_mode = False, reverse = False, hash_cache = None,
+                 algorithm = DEFAULT_ALGORITHM, **kwargs):
         self.reverse_order = reverse
 
         # Init hash function
-        self.hash = HashFile()
+        self.hash_cache = hash_cache
+        self.hash = HashFile(hash_cache, algorithm)
         self.file_hashes = {}
+        self.edge_size = 1024 * 1024    # bytes hashed at each end of a file before doing a full hash
+        self.journal_params = {'algorithm': algorithm, 'edge_size': self.edge_size}
 
         # Init hydra stuff - this starts all the workers
-        super().__init__(path, no_workers, 'delete_duplicates')
+        super().__init__(path, no_workers, 'delete_duplicates', **kwargs)
 
-        duplicates = self.main_data
+        # Read from disk at each pass, sorted on the path
+        duplicates = self.results.sorted(reverse=self.reverse_order)
+        no_duplicates = len(self.results)
 
-        if len(duplicates) == 0:
+        if no_duplicates == 0:
             self.logger.info("NO DUPLICATES!")
             return
 
         # Ask an opinion
         warnings = 0
-        self.logger.warning("FOUND " + str(len(duplicates)) + " duplicate files")
+        self.logger.warning("FOUND " + str(no_duplicates) + " duplicate files")
         for elem in duplicates:
             # Just a useless check (maybe)
             # NOTE: also check "name (x).xxx" patterns
@@ -56,38 +74,96 @@ class DeleteDuplicates(Hydra):
             else:
                 self.logger.warning("BATCH MODE - no warnings, continuing")
 
-        for elem in duplicates:
-            self.logger.warning("DELETED file " + elem)
-            os.remove(elem)
+        planned = (Operation(DELETE, elem) for elem in self.results.sorted(reverse=self.reverse_order))
+        for operation in FileOps().run_batches(planned):
+            if operation.error is not None:
+                self.logger.error("Could not delete " + operation.source + ": " + str(operation.error))
+            else:
+                self.logger.warning("DELETED file " + operation.source)
+
+    def walk(self):
+        """
+        First stage: group the files by size. A file with an unique size cannot have a duplicate, so only files
+        sharing their size with at least another one are sent to the workers.
+        :return: Nothing. Puts the candidates in the queue for processing.
+        """
+        self.logger.debug('Walker init for ' + self.target_path)
+
+        sizes = {}
+        for f, fstat in self.walk_files():
+            sizes.setdefault(fstat.st_size, []).append(f)
+
+        for size in sizes:
+            if len(sizes[size]) < 2:
+                self.no_elems_skipped.value += 1
+                continue
+
+            for f in sizes[size]:
+                self.no_elems_indexed.value += 1
+                self.put_elem(f)
+
+        self.logger.info('Processed ' + str(self.no_elems_indexed.value) + ' candidate files')
+        self.worker_signal_done()
 
     def work(self, index, input_file):
-        return self.hash.computeHash(input_file)
+        # Second stage: only the edges of the file, the full hash is computed later only if needed
+        return self.hash.computeEdgeHash(input_file, self.edge_size)
 
     def db_insert(self, data):
         self.file_hashes[data['path']] = data['result']
 
+    def full_hash(self, path):
+        """
+        :return: hash of the whole file, None if it could not be read
+        """
+        try:
+            return self.hash.computeHash(path, file_stat(path))
+        except OSError as e:
+            self.logger.error("ERROR READING FILE " + str(path) + ": " + str(e))
+            return None
+
     def db_commit(self):
         no_files = len(self.file_hashes)
-        # Sort files, since multiple workers can add them in a different order
-        checksum = OrderedDict(sorted(self.file_hashes.items(), key=itemgetter(0), reverse = self.reverse_order))
-        duplicates = []
-
         self.logger.info("FOUND " + str(no_files) + " files. Looking for duplicates")
 
-        # Then look for duplicates - quick and dirty
-        for index in range(0, no_files - 1):
-            target = list(checksum.keys())[index]
-            target_hash = checksum[target]
-
-            # Compare n with [n+1, ... ]
-            search = list(checksum.keys())[index + 1:]
-            for elem in search:
-                if target_hash == checksum[elem] and elem not in duplicates:
-                    self.logger.info(target + " and " + elem + " are duplicate!")
-                    duplicates.append(elem)
-
-                    # Pass elements to main process, to get use approval
-                    self.queue_to_main.put(elem)
+        # Files with the same edge hash might be duplicates
+        buckets = {}
+        for path, (edge_hash, complete) in self.file_hashes.items():
+            buckets.setdefault(edge_hash, []).append(path)
+
+        # Third stage: files that still collide get a full hash, unless the edges already covered the whole file
+        checksum = {}
+        to_hash = []
+        for edge_hash, paths in buckets.items():
+            if len(paths) < 2:
+                continue
+            if self.file_hashes[paths[0]][1] is True:
+                for path in paths:
+                    checksum[path] = edge_hash
+            else:
+                to_hash.extend(paths)
+
+        self.logger.info("Full hash needed for " + str(len(to_hash)) + " files")
+        # Hashing releases the GIL, threads are enough to keep the disks busy
+        with ThreadPoolExecutor(max_workers=self.no_workers) as executor:
+            for path, file_hash in zip(to_hash, executor.map(self.full_hash, to_hash)):
+                # Not readable anymore: cannot be told a duplicate, it is kept
+                if file_hash is not None:
+                    checksum[path] = file_hash
+
+        groups = {}
+        for path, file_hash in checksum.items():
+            groups.setdefault(file_hash, []).append(path)
+
+        # Sort files, since multiple workers can add them in a different order. Keep the first one of each group.
+        # The main process gets them sorted, to get user approval.
+        for paths in groups.values():
+            if len(paths) < 2:
+                continue
+            paths.sort(reverse=self.reverse_order)
+            for elem in paths[1:]:
+                self.logger.info(paths[0] + " and " + elem + " are duplicate!")
+                self.results.put(elem, key=elem)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Delete duplicate files in a path")
@@ -97,6 +173,11 @@ if __name__ == "__main__":
     parser.add_argument('--batch', help='Batch mode. Stops on warnings automatically', action='store_true')
     parser.add_argument('--reverse', help='Reverse ordering. Useful for " (1).xxx" stuff ', action='store_true')
     parser.add_argument('--recursive', help='Run for all files in folder', action='store_true')
+    parser.add_argument('--hash-cache', help='Use a persistent hash cache, shared with the other tools',
+                        nargs='?', const=DEFAULT_PATH, default=None, metavar='PATH')
+    parser.add_argument('--hash', help='Hash algorithm. Only used to compare files, any will do',
+                        choices=sorted(ALGORITHMS), default=DEFAULT_ALGORITHM)
+    Hydra.add_arguments(parser)
 
     args = parser.parse_args()
 
@@ -109,10 +190,15 @@ if __name__ == "__main__":
     else:
         targets = [args.target]
 
+    hash_cache = None
+    if args.hash_cache is not None:
+        hash_cache = HashCache(args.hash_cache)
+
     start = datetime.datetime.now()
     for target in sorted(targets):
         print(target)
-        h = DeleteDuplicates(target, args.workers, args.batch, args.reverse)
+        h = DeleteDuplicates(target, args.workers, args.batch, args.reverse, hash_cache, args.hash,
+                             **Hydra.options(args))
         del h
     stop = datetime.datetime.now()
     print("This took ", stop - start)
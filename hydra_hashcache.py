@@ -0,0 +1,24 @@
+#!/usr/bin/python3
+
+import argparse
+
+from fileinfo import HashCache
+from fileinfo.hashcache import DEFAULT_PATH
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or invalidate the persistent hash cache")
+
+    parser.add_argument('action', help='What to do with the cache', choices=['stats', 'clear', 'trim'])
+    parser.add_argument('--path', help='Cache file to use', default=DEFAULT_PATH)
+    parser.add_argument('--max-entries', help='Size limit used by trim', type=int, default=1000000)
+
+    args = parser.parse_args()
+
+    cache = HashCache(args.path, args.max_entries)
+    if args.action == 'clear':
+        cache.invalidate()
+    elif args.action == 'trim':
+        cache.evict()
+
+    no_entries, size = cache.stats()
+    print(args.path + ": " + str(no_entries) + " entries, " + str(size) + " bytes")
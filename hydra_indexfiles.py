@@ -3,91 +3,184 @@
 import datetime
 import stat
 import argparse
-import threading
 import os.path
+import sqlite3
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import update, bindparam
 
 from hydra import Hydra
-from db import Base
-from db.filesdb import FilesDb
-from fileinfo import HashFile
-from fileinfo import ExifInfo
+from db import create_sqlite_engine
+from db.filesdb import FilesDb, upgrade_schema, hash_algorithms
+from db.sink import BulkSink
+from fileinfo import HashFile, HashCache, ALGORITHMS, DEFAULT_ALGORITHM
+from fileinfo.hashcache import DEFAULT_PATH
+from fileinfo import ExifInfo, HeadFile
+from utils.journal import Journal
+from utils.walker import file_stat
 
 
 class IndexFiles(Hydra):
-    def __init__(self, path, no_workers):
+    # Replaying a result only writes its row again
+    resumable = True
+    # The librarian writes the rows, the walker looks up the files already indexed
+    coordinator_only = ('sink', 'known_files')
+    # The rows do not need to be in name order
+    default_layout = 'auto'
+
+    def __init__(self, path, no_workers, update_db=None, hash_cache=None, batch_rows=5000,
+                 algorithm=DEFAULT_ALGORITHM, **kwargs):
         # Init hash function
-        self.hash = HashFile()
+        self.hash_cache = hash_cache
+        self.hash = HashFile(hash_cache, algorithm)
+        # Beginning of each file kept while hashing, for the EXIF parser. Enough for the JPEG APP1 segment and
+        # the TIFF/raw IFDs of most cameras, the rest is read on demand.
+        self.head_size = 256 * 1024
 
         # Init db stuff
-        index = datetime.datetime.now().strftime("%Y%m%d_%H%M")
-        self.db_engine = 'sqlite:///' + os.path.join(path, "files_" + index + ".db")
-        self.db_commit_timeout = 5  # seconds
+        db_file = update_db
+        resume = kwargs.get('resume', False)
+        journal = kwargs.get('journal', 'auto')
+        if db_file is None and resume is True and journal is not None:
+            # The interrupted run goes on in its own db, a new one would hold only the files it did not do
+            if journal == 'auto':
+                journal = Journal.default_path('index_files', path)
+            header = Journal.read_header(journal)
+            if header is not None:
+                db_file = header['params'].get('db_file')
+        if db_file is None:
+            index = datetime.datetime.now().strftime("%Y%m%d_%H%M")
+            db_file = os.path.join(path, "files_" + index + ".db")
+        self.update_mode = update_db is not None
+        # Rows the interrupted run wrote are there already, replaying them must not add them twice
+        self.replace_rows = self.update_mode is True or resume is True
 
         # Connect to the database
-        # TODO: improve this, does not look that good
-        engine = create_engine(self.db_engine)
-        Base.metadata.create_all(engine)
-        session_maker = sessionmaker(bind=engine)
-        self.session = session_maker()
-
-        # Init autocommit
-        self.timer_db = threading.Timer(self.db_commit_timeout, self.timer_librarian_commit)
-        self.timer_db.start()
+        if upgrade_schema(db_file) is True and self.update_mode is True:
+            print("Upgraded " + db_file + " to the current schema")
+        if self.update_mode is True:
+            # Hashes from another algorithm cannot go in the same db, nothing would match them
+            other = [name for name in hash_algorithms(db_file) if name != algorithm]
+            if len(other) > 0:
+                raise ValueError(db_file + " was indexed with " + ", ".join(other) + ", not " + algorithm +
+                                 ". Use --hash " + other[0])
+        # Connections are opened by the librarian, when needed
+        engine = create_sqlite_engine(db_file)
+
+        # Rows are written in batches by the librarian
+        self.sink = BulkSink(engine, FilesDb.__table__, batch_rows)
+
+        # Files already in the database, used by the walker to skip the ones that did not change
+        self.known_files = {}
+        if self.update_mode is True:
+            conn = sqlite3.connect(db_file)
+            for path_db, size, mtime_ns, inode in conn.execute(
+                    'SELECT path, size, mtime_ns, inode FROM files WHERE NOT missing'):
+                self.known_files[path_db] = (size, mtime_ns, inode)
+            conn.close()
+
+        # Hashes from another algorithm cannot go in the same db, a resumed run writes in the db it started
+        self.journal_params = {'algorithm': algorithm, 'db_file': os.path.abspath(db_file)}
 
         # Init hydra stuff - this starts all the workers
-        super().__init__(path, no_workers, 'index_files')
-
-        # Cleanup
-        self.timer_db.cancel()
-
-    def timer_librarian_commit(self):
+        super().__init__(path, no_workers, 'index_files', **kwargs)
+
+        # Files that are in the database, but not on disk anymore
+        no_missing = len(self.results)
+        if no_missing > 0:
+            self.logger.warning("Marking " + str(no_missing) + " files as missing")
+            with engine.begin() as conn:
+                conn.execute(update(FilesDb).where(FilesDb.path == bindparam('missing_path')).values(missing=True),
+                             [{'missing_path': path_db} for path_db in self.results])
+
+        # Move everything from the WAL file into the database, so it can be copied around alone
+        with engine.connect() as conn:
+            conn.exec_driver_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+        engine.dispose()
+
+    def walk(self):
         """
-        Used to trigger periodic commits. The timer recreates itself until it is canceled at the end.
-        :return:
+        In update mode, only files that are new or changed since the last run are sent to the workers.
+        :return: Nothing. Puts the full path of the files in a queue for processing.
         """
-        self.queue_data.put('COMMIT')
-        self.logger.debug("TRIGGERING COMMIT!")
+        if self.update_mode is False:
+            return super().walk()
+
+        self.logger.debug('Walker init for ' + self.target_path + ', update mode')
+
+        unchanged = 0
+        for f, fstat in self.walk_files():
+            if self.known_files.pop(f, None) == (fstat.st_size, fstat.st_mtime_ns, fstat.st_ino):
+                unchanged += 1
+                self.no_elems_skipped.value += 1
+                continue
 
-        # Restart timer
-        self.timer_db = threading.Timer(self.db_commit_timeout, self.timer_librarian_commit)
-        self.timer_db.start()
+            self.no_elems_indexed.value += 1
+            self.put_elem(f)
+
+        self.logger.info('Processed ' + str(self.no_elems_indexed.value) + ' new or changed files, ' +
+                         str(unchanged) + ' unchanged')
+
+        # Whatever was not found on disk is gone, main marks them in the db at the end
+        for path_db in self.known_files:
+            self.results.put(path_db)
+        self.worker_signal_done()
 
     def work(self, index, input_file):
-        exif = ExifInfo(input_file)
+        fstat = file_stat(input_file)
+
+        # One open per file: the EXIF parser reads what the hash already read, and the file is closed right away
+        with open(input_file, "rb", buffering=0) as f:
+            file_hash, head = self.hash.hashOpenFile(f, fstat, self.head_size)
+            exif = ExifInfo(HeadFile(f.fileno(), head, str(input_file)))
         infodict = exif.getinfo()
 
         # Add hash to db
-        infodict["hash"] = self.hash.computeHash(input_file)
+        infodict["hash"] = file_hash
 
         # Add file size and file time to db
-        fstat = os.stat(input_file)
         infodict["size"] = fstat.st_size
-        infodict["date"] = fstat.st_ctime
+        infodict["date"] = int(fstat.st_ctime)
+        infodict["mtime_ns"] = fstat.st_mtime_ns
+        infodict["inode"] = fstat.st_ino
 
         return infodict
 
     def db_insert(self, data):
-        self.session.add(FilesDb(
-            path = data['path'],
+        try:
+            self.store(data)
+        except UnicodeEncodeError:
+            # Name that is not UTF-8: the db only takes text paths
+            path = str(data['path']).encode("utf-8", "backslashreplace").decode("utf-8")
+            self.logger.error("Cannot store " + path + ", its name is not UTF-8")
+
+    def store(self, data):
+        if self.replace_rows is True:
+            # Replace the old entry of a changed file, or the one written before the run was interrupted
+            self.sink.delete('path', str(data['path']))
+
+        self.sink.add(dict(
+            path = str(data['path']),
             size = data['result']['size'],
             date = data['result']['date'],
 
-            hash    = data['result']['hash'],
+            hash    = bytes.fromhex(data['result']['hash']),
+            hash_algo = self.hash.algorithm,
             camera  = data['result']['camera'],
             lens    = data['result']['lens'],
             exp_time    = data['result']['exp_time'],
             exp_fnum    = data['result']['exp_fnum'],
             exp_iso     = data['result']['exp_iso'],
             focal_length = data['result']['focal_length'],
-            flash   = data['result']['flash']
+            flash   = data['result']['flash'],
+
+            mtime_ns = data['result']['mtime_ns'],
+            inode   = data['result']['inode'],
+            missing = False
         ))
 
     def db_commit(self):
-        self.session.commit()
-        self.logger.debug('COMMIT')
+        self.sink.flush()
+        self.logger.debug('COMMIT, ' + str(self.sink.no_rows_written) + ' rows written')
 
 
 if __name__ == "__main__":
@@ -96,10 +189,24 @@ if __name__ == "__main__":
     parser.add_argument('target', help='Path to index')
     parser.add_argument('--workers', help='Number of workers to spawn',
                         type=int, default=4)
+    parser.add_argument('--update', help='Update an existing files db, only new or changed files are indexed. '
+                                         'Use the same target path as the run that created it',
+                        metavar='DB', default=None)
+    parser.add_argument('--hash-cache', help='Use a persistent hash cache, shared with the other tools',
+                        nargs='?', const=DEFAULT_PATH, default=None, metavar='PATH')
+    parser.add_argument('--db-batch', help='Rows written to the db per transaction', type=int, default=5000)
+    parser.add_argument('--hash', help='Hash algorithm. An updated db must keep the algorithm it was created with',
+                        choices=sorted(ALGORITHMS), default=DEFAULT_ALGORITHM)
+    Hydra.add_arguments(parser)
 
     args = parser.parse_args()
 
+    hash_cache = None
+    if args.hash_cache is not None:
+        hash_cache = HashCache(args.hash_cache)
+
     start = datetime.datetime.now()
-    h = IndexFiles(args.target, args.workers)
+    h = IndexFiles(args.target, args.workers, args.update, hash_cache, args.db_batch, args.hash,
+                   **Hydra.options(args))
     stop = datetime.datetime.now()
     print("This took ", stop - start)
@@ -0,0 +1,26 @@
+#!/usr/bin/python3
+
+import argparse
+import datetime
+import os
+
+from db.filesdb import upgrade_schema, schema_version, SCHEMA_VERSION
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Upgrade files databases to the current schema, in place")
+
+    parser.add_argument('databases', help='files_*.db to upgrade', nargs='+')
+
+    args = parser.parse_args()
+
+    start = datetime.datetime.now()
+    for db_file in args.databases:
+        size_before = os.path.getsize(db_file)
+        version = schema_version(db_file)
+        if upgrade_schema(db_file) is False:
+            print(db_file + ": already at version " + str(version))
+            continue
+        print(db_file + ": version " + str(version) + " -> " + str(SCHEMA_VERSION) + ", " +
+              str(size_before) + " -> " + str(os.path.getsize(db_file)) + " bytes")
+    stop = datetime.datetime.now()
+    print("This took ", stop - start)
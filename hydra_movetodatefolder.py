@@ -4,68 +4,82 @@
 
 import argparse
 import multiprocessing
-from collections import OrderedDict
-from operator import itemgetter
 import datetime
 import os
-import shutil
-import exifread
-
 from hydra import Hydra
+from db.destindex import DestIndex
+from fileinfo import HashFile, HashCache
+from fileinfo.fastexif import exif_values
+from fileinfo.hashcache import DEFAULT_PATH
+from utils.walker import file_stat
+from utils.fileops import FileOps, Operation, MOVE, COPY
 
 class ToDateFolder(Hydra):
-    def __init__(self, source, destination, no_workers, copy=False, look_for_similar=False):
+    # Results are sorted when read from the result channel
+    walk_ordered = False
+
+    def __init__(self, source, destination, no_workers, copy=False, look_for_similar=False, batch_mode=False,
+                 hash_cache=None, **kwargs):
         self.source = source
         self.destination = destination
 
         self.copy = copy  # If true, copy, else MOVE to date folder
 
-        # Init hash function
-        self.exif_dates = {}
         self.look_for_similar = look_for_similar
         self.last_exif_date = None
 
-        # Init hydra stuff - this starts all the workers
-        super().__init__(source, no_workers, 'move_to_date_folder')
+        # Where the files of the destination are, by name and by content. Refreshed by the walker.
+        self.dest_index = None
+        if look_for_similar is True:
+            self.hash_cache = hash_cache
+            self.dest_index = DestIndex(destination, hash_file=HashFile(hash_cache))
 
-        # Get results from librarian
-        exifdates = OrderedDict()
-        for elem in self.main_data:
-            exifdates[elem[0]] = elem[1]
+        # Init hydra stuff - this starts all the workers
+        super().__init__(source, no_workers, 'move_to_date_folder', **kwargs)
 
         # Exit if nothing to do
-        if len(exifdates) == 0:
+        if len(self.results) == 0:
             self.logger.warning("NO FILES FOUND!")
             return
 
-        # Look through the results...
-        for elem in exifdates:
+        # Look through the results, sorted by the librarian. Only the dates chosen by the user are kept in memory,
+        # the results are read again from disk to move the files.
+        chosen = {}
+        for elem, date in self.results.sorted():
             # ...and if we have a list, then the user must choose something
-            if type(exifdates[elem]).__name__ == 'list':
-                choice = exifdates[elem]
+            if type(date).__name__ == 'list':
+                choice = date
                 self.logger.warning("------- WARNING!")
-                while True:
-                    self.logger.warning("\tFor " + elem + str(exifdates[elem]))
+                if batch_mode is True:
+                    # Same as pressing ENTER
+                    chosen[elem] = choice[0]
+                    self.logger.warning("BATCH MODE - chose " + choice[0] + " for " + elem + str(choice))
+                while batch_mode is False:
+                    self.logger.warning("\tFor " + elem + str(date))
                     print("\nchoice: Press ENTER for 1, Press 2 for second, enter other date manually")
                     user = input(">")
                     if user == "" or user == "1":
-                        exifdates[elem] = choice[0]
+                        chosen[elem] = choice[0]
                         self.logger.warning("User chose 1")
                         break
                     elif user == "2":
-                        exifdates[elem] = choice[1]
+                        chosen[elem] = choice[1]
                         self.logger.warning("User chose 2")
                         break
                     else:
-                        exifdates[elem] = user # just overwrite directly - not safe, but user!
+                        chosen[elem] = user # just overwrite directly - not safe, but user!
                         self.logger.warning("User input date " + user)
                         break
+                date = chosen[elem]
 
             # Print elem, either detected or chosen by the user
-            self.logger.info(elem + " " + str(exifdates[elem]))
+            self.logger.info(elem + " " + str(date))
 
         self.logger.warning("Chosen destination " + destination)
-        if self.copy is False:
+        if batch_mode is True:
+            resp = True
+            self.logger.warning("BATCH MODE - continuing")
+        elif self.copy is False:
             resp = self.get_user_approval("!! MOVE? !!")
         else:
             resp = self.get_user_approval("COPY?")
@@ -73,57 +87,48 @@ class ToDateFolder(Hydra):
         if resp is False:
             return
 
-        # NOTE: exifdates contains full path filename (fpfile)
-        for fpfile in exifdates:
-            dest_folder = os.path.join(destination, exifdates[fpfile])
-            try:
-                # Make sure destination exists
-                os.mkdir(dest_folder)
-                self.logger.debug("Created " + dest_folder)
-            except FileExistsError:
-                # Skip if already created
-                pass
-
-            file = os.path.basename(fpfile) # extract just the file name
-            dest_file = os.path.join(dest_folder, file) # and create the destination full path filename
-
-            # If we already have a file with the same name, append _x to not overwrite
-            if os.path.isfile(dest_file) is True:
-                index = 1
-                self.logger.info(dest_file + " exists, trying other name")
-                while os.path.isfile(dest_file) is True:
-                    split_name = os.path.splitext(file)
-                    dest_file = os.path.join(dest_folder, split_name[0] + "_" + str(index) + split_name[1])
-                    index += 1
-                self.logger.info("==> came up with " + dest_file)
-
-            if self.copy is False:
-                self.logger.info("Moving " + fpfile + " to " + dest_file)
-                shutil.move(fpfile, dest_file)
+        # NOTE: the results contain full path filename (fpfile)
+        # If we already have a file with the same name, _x is appended to not overwrite
+        def planned():
+            for fpfile, date in self.results.sorted():
+                dest_file = os.path.join(destination, chosen.get(fpfile, date), os.path.basename(fpfile))
+                yield Operation(MOVE if self.copy is False else COPY, fpfile, dest_file, unique=True)
+
+        for operation in FileOps().run_batches(planned()):
+            if operation.error is not None:
+                self.logger.error("Could not " + operation.kind + " " + operation.source + ": " + str(operation.error))
+            elif self.copy is False:
+                self.logger.info("Moving " + operation.source + " to " + operation.destination)
             else:
-                self.logger.info("Copying " + fpfile + " to " + dest_file)
-                shutil.copy(fpfile, dest_file)
+                self.logger.info("Copying " + operation.source + " to " + operation.destination)
+
+    def walk(self):
+        if self.dest_index is not None:
+            # Before sending anything, the workers look files up in it
+            no_listed, no_files = self.dest_index.refresh()
+            self.logger.info("Destination index: " + str(no_files) + " files, " + str(no_listed) +
+                             " folder(s) read again")
+        super().walk()
 
     def work(self, index, input_file):
-        tags = exifread.process_file(open(input_file, "rb"), details=False)
+        with open(input_file, "rb") as f:
+            found, tags = exif_values(f, ["EXIF DateTimeDigitized"], details=False)
 
         try:
-            date = tags["EXIF DateTimeDigitized"].values.split()[0]
+            date = tags["EXIF DateTimeDigitized"].split()[0]
             date = str(date)
             date = date.replace(":", "")
             self.last_exif_date = date
         except KeyError:
-            ts_epoch = os.path.getmtime(input_file)
+            ts_epoch = file_stat(input_file).st_mtime
             date_mod = datetime.datetime.fromtimestamp(ts_epoch).strftime('%Y%m%d')
 
             # Look for similar files in the destination folder - useful for lots of duplicates
             if self.look_for_similar is True:
                 date_sim = "00000000"
-                for rf, df, ff in os.walk(self.destination):
-                    if input_file in ff:
-                        dest_file = os.path.join(rf, input_file)
-                        date_sim = dest_file.split("/")[-2] #TODO: not portable
-                        break
+                folder = self.dest_index.find(input_file, file_stat(input_file))
+                if folder:
+                    date_sim = os.path.basename(folder)
 
                 # In this case get user input
                 if date_mod == date_sim:
@@ -143,16 +148,12 @@ class ToDateFolder(Hydra):
         return date
 
     def db_insert(self, data):
-        # This is called in same process as commit, so we can create the list to pass on to main
-        self.exif_dates[data['path']] = data['result']
+        # Need to pass the list to main to get approval from the user. Sorted there, since multiple workers can add
+        # them in a different order.
+        self.results.put([str(data['path']), data['result']], key=str(data['path']))
 
     def db_commit(self):
-        # Sort files, since multiple workers can add them in a different order
-        exifdates = OrderedDict(sorted(self.exif_dates.items(), key=itemgetter(0)))
-
-        # Need to pass the list to main to get approval from the user
-        for elem in exifdates:
-            self.queue_to_main.put([elem, exifdates[elem]])
+        pass
 
 
 if __name__ == "__main__":
@@ -162,10 +163,21 @@ if __name__ == "__main__":
     parser.add_argument('destination', help='Where to move the files. NOTE: it will create subfolders YYYYMMDD in here.')
     parser.add_argument('--workers', help='Number of workers to spawn', type=int, default=4)
     parser.add_argument('--similar', help='Look for similar files in the destination folder', action='store_true')
+    parser.add_argument('--batch', help='Batch mode. Takes the first date when unsure and does not ask for approval',
+                        action='store_true')
+    parser.add_argument('--hash-cache', help='Use a persistent hash cache, shared with the other tools. Speeds up '
+                                             'finding renamed copies with --similar',
+                        nargs='?', const=DEFAULT_PATH, default=None, metavar='PATH')
+    Hydra.add_arguments(parser)
 
     args = parser.parse_args()
 
+    hash_cache = None
+    if args.hash_cache is not None:
+        hash_cache = HashCache(args.hash_cache)
+
     start = datetime.datetime.now()
-    h = ToDateFolder(args.source, args.destination, args.workers, False, args.similar)
+    h = ToDateFolder(args.source, args.destination, args.workers, False, args.similar, args.batch, hash_cache,
+                     **Hydra.options(args))
     stop = datetime.datetime.now()
     print("This took ", stop - start)
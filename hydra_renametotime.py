@@ -2,61 +2,55 @@
 
 import argparse
 import multiprocessing
-from collections import OrderedDict
-from operator import itemgetter
 import datetime
 import os
 import shutil
-import exifread
-
 from hydra import Hydra
+from fileinfo.fastexif import exif_values
 
 class RenameToTime(Hydra):
-    def __init__(self, source, no_workers):
+    # Results are sorted when read from the result channel
+    walk_ordered = False
+
+    def __init__(self, source, no_workers, **kwargs):
         self.source = source
 
-        # Init hash function
-        self.exif_dates = {}
         self.last_exif_date = None
 
         # Init hydra stuff - this starts all the workers
-        super().__init__(source, no_workers, 'move_to_date_folder')
-
-        # Get results from librarian
-        exifdates = OrderedDict()
-        for elem in self.main_data:
-            exifdates[elem[0]] = elem[1]
+        super().__init__(source, no_workers, 'move_to_date_folder', **kwargs)
 
         # Exit if nothing to do
-        if len(exifdates) == 0:
+        if len(self.results) == 0:
             self.logger.info("NO FILES FOUND!")
             exit(0)
 
         # Look through the results...
-        for elem in exifdates:
-            if "000000" in exifdates[elem]:
+        for elem, name in self.results.sorted():
+            if "000000" in name:
                 self.logger.warning("Warning for " + elem + " no date found! Skipping!")
             else:
-                self.logger.info("Renaming " + elem + " to " + exifdates[elem])
+                self.logger.info("Renaming " + elem + " to " + name)
 
         input("> RENAME?")
 
-        # NOTE: exifdates contains full path filename (fpfile)
-        for fpfile in exifdates:
-            if "000000" not in exifdates[fpfile]:
+        # NOTE: the results contain full path filename (fpfile)
+        for fpfile, name in self.results.sorted():
+            if "000000" not in name:
                 dest_folder = os.path.dirname(fpfile)
-                dest_file = os.path.join(dest_folder, exifdates[fpfile])
+                dest_file = os.path.join(dest_folder, name)
 
                 print("renaming", fpfile, "to", dest_file)
 
                 #shutil.move(fpfile, dest_file)
 
     def work(self, index, input_file):
-        tags = exifread.process_file(open(input_file, "rb"), details=False)
+        with open(input_file, "rb") as f:
+            found, tags = exif_values(f, ["EXIF DateTimeDigitized"], details=False)
         ext = os.path.basename(input_file).split(".")[1]
 
         try:
-            date = tags["EXIF DateTimeDigitized"].values.split()[1]
+            date = tags["EXIF DateTimeDigitized"].split()[1]
             date = str(date)
             date = date.replace(":", "")
             self.last_exif_date = date
@@ -66,16 +60,12 @@ class RenameToTime(Hydra):
         return date + "." + ext
 
     def db_insert(self, data):
-        # This is called in same process as commit, so we can create the list to pass on to main
-        self.exif_dates[data['path']] = data['result']
+        # Need to pass the list to main to get approval from the user. Sorted there, since multiple workers can add
+        # them in a different order.
+        self.results.put([str(data['path']), data['result']], key=str(data['path']))
 
     def db_commit(self):
-        # Sort files, since multiple workers can add them in a different order
-        exifdates = OrderedDict(sorted(self.exif_dates.items(), key=itemgetter(0)))
-
-        # Need to pass the list to main to get approval from the user
-        for elem in exifdates:
-            self.queue_to_main.put([elem, exifdates[elem]])
+        pass
 
 
 if __name__ == "__main__":
@@ -83,10 +73,11 @@ if __name__ == "__main__":
 
     parser.add_argument('source', help='Where to look for the files to move')
     parser.add_argument('--workers', help='Number of workers to spawn', type=int, default=4)
+    Hydra.add_arguments(parser)
 
     args = parser.parse_args()
 
     start = datetime.datetime.now()
-    h = RenameToTime(args.source, args.workers)
+    h = RenameToTime(args.source, args.workers, **Hydra.options(args))
     stop = datetime.datetime.now()
     print("This took ", stop - start)
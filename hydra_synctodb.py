@@ -1,68 +1,78 @@
 #!/usr/bin/python3
-import shutil
 import datetime
 import stat
 import argparse
 import os.path
-import sqlite3
 import logging
 import multiprocessing
 
 from hydra import Hydra
-from fileinfo import HashFile
+from fileinfo import HashFile, HashCache, DEFAULT_ALGORITHM
+from fileinfo.hashcache import DEFAULT_PATH
 from utils.pathsplitall import pathsplitall
+from utils.walker import file_stat
+from utils.fileops import FileOps
+from db.filesdb import schema_version, hash_algorithms, SCHEMA_VERSION
+from db.hashindex import HashIndex
 
 
 class SyncToDb(Hydra):
-    def __init__(self, path, targetdb, strippath, no_workers, dry_run=False):
-        # Init hash function
-        self.hash = HashFile()
-
+    # Hashing releases the GIL and the hash index is mapped once for all the workers
+    default_executor = 'thread'
+    # The librarian plans and counts the moves
+    coordinator_only = ('file_ops', 'files_skipped', 'files_moved')
+    # The moves are run together at the end, the order of the files does not matter
+    default_layout = 'auto'
+
+    def __init__(self, path, targetdb, strippath, no_workers, dry_run=False, hash_cache=None, **kwargs):
         # Init db stuff
+        if schema_version(targetdb) < SCHEMA_VERSION:
+            raise ValueError(targetdb + " uses an old schema, update it with hydra_migratedb.py")
+
+        # Init hash function, with the algorithm the db was indexed with
+        algorithms = hash_algorithms(targetdb)
+        if len(algorithms) > 1:
+            raise ValueError(targetdb + " mixes hash algorithms: " + ", ".join(algorithms))
+        self.hash_cache = hash_cache
+        self.hash = HashFile(hash_cache, algorithms[0] if len(algorithms) > 0 else DEFAULT_ALGORITHM)
         self.targetdb = targetdb
         self.strippath = strippath
 
-        # Store the db in memory for each worker
-        self.mem_dbs = list(range(no_workers))
+        # Built once, mapped read-only by every worker
+        self.hash_index = HashIndex.for_db(targetdb)
 
         self.dry_run = dry_run
+        # Moves planned by the librarian, run all together at the end
+        self.file_ops = FileOps()
         self.files_skipped = multiprocessing.Value('i', lock=False)
         self.files_moved = multiprocessing.Value('i', lock=False)
 
         # Init hydra stuff - this starts all the workers
-        super().__init__(path, no_workers, 'sync_to_db', log_level=logging.DEBUG)
+        super().__init__(path, no_workers, 'sync_to_db', log_level=logging.DEBUG, **kwargs)
 
     def init(self, index):
         """
-        For each worker, create a memory db and save cursors
+        Map the hash index in each worker
         :param index:
         :return:
         """
-        self.logger.debug("Creating mem db for worker " + str(index))
-        target_conn = sqlite3.connect(self.targetdb)
-        tmp = sqlite3.connect(':memory:')
-        self.mem_dbs[index] = tmp.cursor()
-        target_conn.backup(tmp)
-        target_conn.close()
-        self.logger.debug("Done creating mem db for worker " + str(index))
+        self.logger.debug("Worker " + str(index) + " using " + str(len(self.hash_index)) + " hashes from " +
+                          self.hash_index.index_file)
 
     def work(self, index, input_file):
         # Get file info
-        file_hash = self.hash.computeHash(input_file)
-        fstat = os.stat(input_file)
+        fstat = file_stat(input_file)
+        file_hash = self.hash.computeHash(input_file, fstat)
         file_size = fstat.st_size
         #TIME IS TOO DIFFERENT
 
         file_name = os.path.basename(input_file)
 
         # Look file up in database
-        self.mem_dbs[index].execute('SELECT path,size,date FROM files WHERE hash=?', (file_hash,))
-
-        while True:
-            found = self.mem_dbs[index].fetchone()
-            if found is None:
-                break
-            if os.path.basename(found[0]) == file_name:
+        found = None
+        for path_db, size_db in self.hash_index.lookup(bytes.fromhex(file_hash)):
+            if os.path.basename(path_db) == file_name:
+                found = (path_db, size_db)
                 break
 
         self.logger.debug("For "+ input_file+ "(" + file_hash + ") found " + str(found))
@@ -100,21 +110,20 @@ class SyncToDb(Hydra):
             self.files_skipped.value += 1
             return
 
-        target_folder = os.path.dirname(data['result'])
-        try:
-            if self.dry_run is False:
-                os.makedirs(target_folder, exist_ok=True)
-            self.logger.warning("Created folder " + target_folder)
-        except FileExistsError:
-            #Skip if already created
-            pass
-
         if self.dry_run is False:
-            shutil.move(data['path'], data['result'])
+            self.file_ops.move(data['path'], data['result'])
         self.logger.warning("Moving " + data['path'] + " to " + data['result'])
         self.files_moved.value += 1
 
     def db_commit(self):
+        operations, created = self.file_ops.run()
+        for folder in created:
+            self.logger.warning("Created folder " + folder)
+        for operation in operations:
+            if operation.error is not None:
+                self.logger.error("Could not move " + operation.source + ": " + str(operation.error))
+                self.files_moved.value -= 1
+
         self.logger.warning("FINAL STATS: " + str(self.files_moved.value) + "moved / " + \
                             str(self.files_skipped.value) + " skipped")
 
@@ -128,10 +137,18 @@ if __name__ == "__main__":
     parser.add_argument('--dryrun', help='Do not actually move files or create folders', action='store_true')
     parser.add_argument('--workers', help='Number of workers to spawn',
                         type=int, default=4)
+    parser.add_argument('--hash-cache', help='Use a persistent hash cache, shared with the other tools',
+                        nargs='?', const=DEFAULT_PATH, default=None, metavar='PATH')
+    Hydra.add_arguments(parser)
 
     args = parser.parse_args()
 
+    hash_cache = None
+    if args.hash_cache is not None:
+        hash_cache = HashCache(args.hash_cache)
+
     start = datetime.datetime.now()
-    h = SyncToDb(args.target, args.targetdb, args.strippath, args.workers, args.dryrun)
+    h = SyncToDb(args.target, args.targetdb, args.strippath, args.workers, args.dryrun, hash_cache,
+                 **Hydra.options(args))
     stop = datetime.datetime.now()
     print("This took ", stop - start)
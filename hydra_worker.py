@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+
+import argparse
+import datetime
+import importlib
+import logging
+import os
+import pickle
+
+from fileinfo import HashFile, HashCache
+from fileinfo.hashcache import DEFAULT_PATH
+from utils.distributed import connect, PathMap, RemoteElems, RemoteResults
+from utils.executors import create_executor
+from utils.metrics import Metrics
+
+
+class RemoteWorkers():
+    """
+    Workers of a distributed Hydra run, on another host than the walker and the librarian (see the --serve option
+    of the tools). The tool is built from what the coordinator sends, its work() runs here on the files this host
+    has locally, the results go back to the librarian of the coordinator.
+    """
+    def __init__(self, address, authkey, no_workers, local=(), hash_cache=None, executor=None, connect_timeout=60):
+        """
+        Connect, work until the coordinator has nothing left for this host
+        :param address: HOST:PORT of the coordinator
+        :param authkey: shared secret of the coordinator
+        :param no_workers: workers to run here
+        :param local: folders of the coordinator this host has, PREFIX or PREFIX=LOCAL if mounted elsewhere
+        :param hash_cache: optional HashCache of this host
+        :param executor: 'process' or 'thread', default what suits the tool
+        :param connect_timeout: second(s) to wait for the coordinator
+        """
+        self.init_logging()
+
+        manager = connect(address, authkey, connect_timeout)
+        dispatcher = manager.dispatcher()
+        path_map = PathMap(local)
+        prefixes = path_map.prefixes()
+        self.logger.info("Connected to " + address + ", local folders: " + (", ".join(prefixes) or "none"))
+
+        tool = self.build_tool(pickle.loads(dispatcher.get_tool()), hash_cache)
+        executor = create_executor(executor or tool.default_executor, no_workers)
+        if executor.name not in ('process', 'thread'):
+            raise ValueError("Remote workers need the process or thread executor, not " + executor.name)
+
+        # What Hydra.worker needs, as Hydra.__init__ sets it on the coordinator
+        tool.logger = self.logger
+        tool.executor = executor
+        tool.no_slots = no_workers
+        tool.work_time = executor.value('d')
+        tool.metrics = Metrics(no_workers, executor=executor)
+        tool.retire = executor.array('b', no_workers)
+        tool.no_elems_processed = executor.array('i', no_workers)
+        tool.interrupted = executor.value('b')
+        # The stat results come from the coordinator, their devices mean nothing here
+        tool.reader_slots = None
+        # The coordinator already split the batches on the hosts
+        tool.lanes = None
+        tool.queue_elems = RemoteElems(dispatcher, path_map)
+        tool.queue_data = RemoteResults(manager.results(), path_map, hash_cache,
+                                        forward_cache=tool.hash_cache is not None)
+        # Hashes are computed here, the entries go to the caches of both sides
+        tool.hash_cache = hash_cache
+
+        # From now on, the batches of the local folders come here
+        dispatcher.register(prefixes)
+        procs = []
+        for index in range(0, no_workers):
+            # Each counts for the librarian, none must start once there is nothing left
+            if dispatcher.worker_started(prefixes) is False:
+                break
+            procs.append(executor.process(tool.worker, (index,)))
+            procs[-1].start()
+        for proc in procs:
+            proc.join()
+        executor.shutdown()
+
+        self.logger.info("Done, " + str(sum(tool.no_elems_processed)) + " elems processed by " +
+                         str(len(procs)) + " worker(s)")
+
+    def build_tool(self, remote, hash_cache):
+        """
+        :param remote: what Hydra.remote_state sent
+        :param hash_cache: HashCache of this host, replaces the one of the coordinator
+        :return: the tool, with its attributes but without anything Hydra.__init__ starts
+        """
+        cls = getattr(importlib.import_module(remote['module']), remote['class'])
+        tool = cls.__new__(cls)
+        tool.__dict__.update(remote['state'])
+        for value in tool.__dict__.values():
+            if isinstance(value, HashFile):
+                value.cache = hash_cache
+        self.logger.info("Working for " + remote['class'])
+        return tool
+
+    def init_logging(self):
+        # Same logger and format as the stages of the coordinator
+        self.logger = logging.getLogger('hydra')
+        self.logger.setLevel(logging.INFO)
+        if not len(self.logger.handlers):
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter('%(asctime)s - %(funcName)s - %(levelname)s - %(message)s'))
+            self.logger.addHandler(handler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Workers for a Hydra tool running with --serve on another host")
+
+    parser.add_argument('coordinator', help='Address given to --serve on the coordinator', metavar='HOST:PORT')
+    parser.add_argument('--workers', help='Number of workers to spawn',
+                        type=int, default=4)
+    parser.add_argument('--local', help='Folder of the coordinator this host has on its own disks, files in it are '
+                                        'sent here. PREFIX=LOCAL if it is mounted elsewhere. Can be repeated',
+                        action='append', default=[], metavar='PREFIX')
+    parser.add_argument('--authkey', help='Shared secret of the coordinator. Default: $HYDRA_AUTHKEY',
+                        default=os.environ.get('HYDRA_AUTHKEY'))
+    parser.add_argument('--hash-cache', help='Use a persistent hash cache, shared with the other tools',
+                        nargs='?', const=DEFAULT_PATH, default=None, metavar='PATH')
+    parser.add_argument('--executor', help='Run the workers as processes or threads. Default: what suits the tool',
+                        choices=['process', 'thread'], default=None)
+    parser.add_argument('--connect-timeout', help='Second(s) to wait for the coordinator to be up', type=float,
+                        default=60)
+
+    args = parser.parse_args()
+    if args.authkey is None:
+        parser.error("--authkey or $HYDRA_AUTHKEY is needed")
+
+    hash_cache = None
+    if args.hash_cache is not None:
+        hash_cache = HashCache(args.hash_cache)
+
+    start = datetime.datetime.now()
+    RemoteWorkers(args.coordinator, args.authkey, args.workers, args.local, hash_cache, args.executor,
+                  args.connect_timeout)
+    stop = datetime.datetime.now()
+    print("This took ", stop - start)
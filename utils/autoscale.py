@@ -0,0 +1,133 @@
+class CpuStat():
+    """
+    System wide CPU use from /proc/stat, between two calls of sample
+    """
+    def __init__(self, stat_file="/proc/stat"):
+        self.stat_file = stat_file
+        self.previous = self.read()
+
+    def read(self):
+        """
+        :return: (total, idle, iowait) jiffies since boot, None if not available (not Linux)
+        """
+        try:
+            with open(self.stat_file) as f:
+                fields = [int(field) for field in f.readline().split()[1:]]
+        except (OSError, ValueError):
+            return None
+        # user nice system idle iowait irq softirq steal, guest time is already in user
+        total = sum(fields[:8])
+        return total, fields[3], fields[4]
+
+    def sample(self):
+        """
+        :return: (busy, iowait) as fractions of the CPU time since the last sample, (None, None) if not available
+        """
+        current = self.read()
+        previous, self.previous = self.previous, current
+        if current is None or previous is None or current[0] <= previous[0]:
+            return None, None
+        total = current[0] - previous[0]
+        idle = current[1] - previous[1]
+        iowait = current[2] - previous[2]
+        return 1 - (idle + iowait) / total, iowait / total
+
+
+class Autoscaler():
+    """
+    Number of workers by hill climbing on their throughput. Every interval it looks at the last step:
+     - a step up is kept if the throughput grew, a step down if the throughput did not drop, and the next step goes
+       the same way
+     - otherwise the step is undone, nothing moves for a few intervals and the next probe goes the other way
+    More workers are not tried when the CPUs are saturated, and the probes go down when the disks are (high iowait,
+    too many workers make a spinning disk seek). When the walker cannot keep the queue filled, workers are retired.
+    """
+    def __init__(self, min_workers, max_workers, gain=0.05, hold=6, cpu_limit=0.9, iowait_limit=0.3):
+        """
+        :param min_workers: never less workers
+        :param max_workers: never more workers
+        :param gain: relative throughput change that counts as better or worse
+        :param hold: intervals without changes after undoing a step
+        :param cpu_limit: busy fraction of all the CPUs above which no workers are added
+        :param iowait_limit: iowait fraction of the CPU time above which workers are removed first
+        """
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.gain = gain
+        self.hold = hold
+        self.cpu_limit = cpu_limit
+        self.iowait_limit = iowait_limit
+
+        self.cpu = CpuStat()
+        self.direction = 1
+        self.hold_left = 0
+        # (workers, throughput) of the last interval
+        self.previous = None
+
+    @staticmethod
+    def throughput(snapshot):
+        """
+        :return: recent worker throughput in bytes/s, elems/s if the elems are not files
+        """
+        workers = snapshot["stages"]["workers"]
+        if workers["bytes"] > 0:
+            return workers.get("recent_bytes_per_sec", workers["bytes_per_sec"])
+        return workers.get("recent_elems_per_sec", workers["elems_per_sec"])
+
+    def decide(self, workers, snapshot):
+        """
+        :param workers: number of workers running now
+        :param snapshot: utils.metrics snapshot of the last interval
+        :return: (number of workers to run, reason to log or None if unchanged)
+        """
+        rate = self.throughput(snapshot)
+        busy, iowait = self.cpu.sample()
+        backlog = snapshot["queues"].get("elems")
+        walker_done = snapshot["stages"]["walker"]["done"]
+
+        previous, self.previous = self.previous, (workers, rate)
+
+        # Appended to the reasons, for the log
+        if snapshot["stages"]["workers"]["bytes"] > 0:
+            load = " (%.1f MB/s per worker" % (rate / max(workers, 1) / 1e6)
+        else:
+            load = " (%.1f elems/s per worker" % (rate / max(workers, 1))
+        if busy is not None:
+            load += ", CPU %.0f%%, iowait %.0f%%" % (100 * busy, 100 * iowait)
+        load += ")"
+
+        # Nothing measured yet, or only the end of the queue is left: the workers that are there will finish it
+        if rate <= 0 or (walker_done is True and backlog is not None and backlog < workers):
+            return workers, None
+
+        # Batches are sent as soon as the walker has them, so an empty queue means the workers are waiting on it
+        if backlog == 0 and walker_done is False:
+            if workers > self.min_workers:
+                return workers - 1, "the queue is empty, the walker is the bottleneck" + load
+            return workers, None
+
+        if self.hold_left > 0:
+            self.hold_left -= 1
+            return workers, None
+
+        if previous is not None and previous[0] != workers:
+            step_up = workers > previous[0]
+            if step_up is True:
+                better = rate > previous[1] * (1 + self.gain)
+            else:
+                better = rate >= previous[1] * (1 - self.gain)
+            if better is False:
+                self.hold_left = self.hold
+                self.direction = -1 if step_up is True else 1
+                return previous[0], "going back, " + str(workers) + " workers did no better" + load
+
+        if iowait is not None and iowait > self.iowait_limit and self.direction > 0:
+            self.direction = -1
+        if self.direction > 0:
+            if workers >= self.max_workers or (busy is not None and busy > self.cpu_limit):
+                return workers, None
+            return workers + 1, "trying one more worker" + load
+        if workers <= self.min_workers:
+            self.direction = 1
+            return workers, None
+        return workers - 1, "trying one worker less" + load
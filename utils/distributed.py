@@ -0,0 +1,352 @@
+import collections
+import os
+import queue
+import signal
+import threading
+import time
+from multiprocessing.managers import BaseManager
+
+from utils.executors import ThreadQueue
+from utils.walker import FileEntry
+
+
+def parse_address(text):
+    """
+    :param text: HOST:PORT
+    :return: (host, port)
+    """
+    host, sep, port = text.rpartition(':')
+    if sep == "" or port.isdigit() is False:
+        raise ValueError("Expected HOST:PORT, got " + text)
+    return host or "0.0.0.0", int(port)
+
+
+def under(path, prefix):
+    """
+    :return: True if path is prefix or in it
+    """
+    return path == prefix or path.startswith(prefix.rstrip(os.sep) + os.sep)
+
+
+def normalize(prefix):
+    return prefix.rstrip(os.sep) or os.sep
+
+
+class Dispatcher():
+    """
+    Queue of batches between the walker and the workers, local and remote. Each remote host registers the folders
+    of the coordinator it has on its own mounts, the batches are split on them as they are put: a file goes to the
+    host that has it locally, the files no host has go to a shared queue any worker takes from.
+    The workers of the coordinator can read everything: they take from the shared queue first, then help the hosts
+    that are behind.
+    Lives in the manager process of the coordinator, the stages use it through proxies.
+    """
+    def __init__(self, maxsize, tool):
+        """
+        :param maxsize: batches queued at most, the walker waits past it
+        :param tool: the pickled tool, for the remote hosts to build their workers (see Hydra.remote_state)
+        """
+        self.maxsize = maxsize
+        self.tool = tool
+
+        # Prefix -> batches, '' for the shared ones
+        self.batches = {"": collections.deque()}
+        self.size = 0
+        self.closed = False
+        self.no_hosts = 0
+        self.no_remote_workers = 0
+        self.cond = threading.Condition()
+
+    def get_tool(self):
+        """
+        :return: the pickled tool
+        """
+        return self.tool
+
+    def register(self, prefixes):
+        """
+        Remote host side, once its workers are ready to start
+        :param prefixes: folders of the coordinator the host has locally
+        """
+        with self.cond:
+            for prefix in prefixes:
+                self.batches.setdefault(normalize(prefix), collections.deque())
+            self.no_hosts += 1
+            self.cond.notify_all()
+
+    def wait_hosts(self, no_hosts):
+        """
+        Block until that many remote hosts registered, so that the first batches already go to them
+        """
+        with self.cond:
+            while self.no_hosts < no_hosts:
+                self.cond.wait()
+
+    def worker_started(self, prefixes):
+        """
+        Remote host side, before starting a worker: it counts for the librarian from then on
+        :param prefixes: folders of the coordinator the host has locally
+        :return: False if there is nothing left for it, the worker must not start
+        """
+        with self.cond:
+            if self.closed is True and self.next_prefix(prefixes) is None:
+                return False
+            self.no_remote_workers += 1
+            return True
+
+    def remote_started(self):
+        """
+        :return: remote workers started so far, each puts a None in the results when done
+        """
+        return self.no_remote_workers
+
+    def locality(self, path):
+        """
+        :return: longest registered prefix holding path, '' if none
+        """
+        best = ""
+        for prefix in self.batches:
+            if len(prefix) > len(best) and under(path, prefix):
+                best = prefix
+        return best
+
+    def put(self, batch, block=True, timeout=None):
+        """
+        Split a batch on the hosts that have its files. None closes the queue: the workers get None once
+        there is nothing left for them.
+        """
+        with self.cond:
+            if batch is None:
+                self.closed = True
+                self.cond.notify_all()
+                return
+            while self.size >= self.maxsize:
+                self.cond.wait()
+
+            split = {}
+            for elem in batch:
+                split.setdefault(self.locality(str(elem)), []).append(elem)
+            for prefix, elems in split.items():
+                self.batches[prefix].append(elems)
+                self.size += 1
+            self.cond.notify_all()
+
+    def next_prefix(self, prefixes):
+        """
+        :param prefixes: folders of a remote host, None for a worker of the coordinator
+        :return: queue to take the next batch from, None if nothing is there for the caller
+        """
+        if prefixes is None:
+            # Shared first, then the host with the most left
+            order = [""] + sorted(self.batches, key=lambda prefix: len(self.batches[prefix]), reverse=True)
+        else:
+            order = [normalize(prefix) for prefix in prefixes] + [""]
+        for prefix in order:
+            if len(self.batches.get(prefix, ())) > 0:
+                return prefix
+        return None
+
+    def get(self, block=True, timeout=None, prefixes=None):
+        """
+        :param prefixes: folders of a remote host, None for a worker of the coordinator
+        :return: next batch for the caller, None when the queue is closed and nothing is left for it
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while True:
+                prefix = self.next_prefix(prefixes)
+                if prefix is not None:
+                    self.size -= 1
+                    self.cond.notify_all()
+                    return self.batches[prefix].popleft()
+                if self.closed is True:
+                    return None
+                if block is False or (deadline is not None and deadline <= time.monotonic()):
+                    raise queue.Empty
+                self.cond.wait(None if deadline is None else deadline - time.monotonic())
+
+    def qsize(self):
+        return self.size
+
+    def empty(self):
+        return self.size == 0
+
+    def close(self):
+        pass
+
+
+class HydraManager(BaseManager):
+    pass
+
+
+# Set in the manager process, by serve
+dispatcher = None
+results = None
+
+
+def serve(maxsize, tool):
+    """
+    Manager process init
+    """
+    global dispatcher, results
+    # Ctrl+C is for the stages, the manager is shut down after them
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    dispatcher = Dispatcher(maxsize, tool)
+    results = ThreadQueue(maxsize)
+
+
+def get_dispatcher():
+    return dispatcher
+
+
+def get_results():
+    return results
+
+
+HydraManager.register('dispatcher', callable=get_dispatcher)
+HydraManager.register('results', callable=get_results)
+
+
+class Coordinator():
+    """
+    Side of the walker and the librarian in a distributed run: serves the queue of batches (a Dispatcher) and the
+    queue of results over TCP, for hydra_worker.py on the other hosts.
+    """
+    def __init__(self, address, authkey, maxsize, tool):
+        """
+        Start the manager process
+        :param address: HOST:PORT to listen on, port 0 for any free port
+        :param authkey: shared secret, the remote hosts need the same one
+        :param maxsize: of the queues, in batches
+        :param tool: the pickled tool
+        """
+        self.manager = HydraManager(parse_address(address), authkey.encode("utf-8"))
+        self.manager.start(serve, (maxsize, tool))
+        self.address = self.manager.address
+        # Proxies, they can be used from any stage
+        self.dispatcher = self.manager.dispatcher()
+        self.results = self.manager.results()
+
+    def shutdown(self):
+        """
+        Stop the manager, once all the stages are joined
+        """
+        self.manager.shutdown()
+
+
+def connect(address, authkey, timeout=60):
+    """
+    Remote host side: connect to a coordinator, waiting for it to be up
+    :param address: HOST:PORT of the coordinator
+    :param authkey: its shared secret
+    :param timeout: second(s) to keep trying
+    :return: connected HydraManager
+    """
+    manager = HydraManager(parse_address(address), authkey.encode("utf-8"))
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            manager.connect()
+            return manager
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.5)
+
+
+class PathMap():
+    """
+    Folders of the coordinator and where they are mounted on a remote host
+    """
+    def __init__(self, specs):
+        """
+        :param specs: list of PREFIX (same path on both sides) or PREFIX=LOCAL
+        """
+        self.pairs = []
+        for spec in specs:
+            coordinator, sep, local = spec.partition("=")
+            self.pairs.append((normalize(coordinator), normalize(local or coordinator)))
+
+    def prefixes(self):
+        """
+        :return: folders of the coordinator that are local here
+        """
+        return [pair[0] for pair in self.pairs]
+
+    def to_local(self, elem):
+        return self.translate(elem, 0, 1)
+
+    def to_coordinator(self, elem):
+        return self.translate(elem, 1, 0)
+
+    def translate(self, elem, source, destination):
+        """
+        Swap the prefix of a path, the stat result of a FileEntry is kept. Elems that are not paths are left as is.
+        """
+        if isinstance(elem, str) is False:
+            return elem
+        for pair in sorted(self.pairs, key=lambda pair: len(pair[source]), reverse=True):
+            if under(elem, pair[source]):
+                rest = elem[len(pair[source]):].lstrip(os.sep)
+                path = os.path.join(pair[destination], rest) if rest != "" else pair[destination]
+                if isinstance(elem, FileEntry):
+                    return FileEntry(path, elem.stat)
+                return path
+        return elem
+
+
+class RemoteElems():
+    """
+    queue_elems of the workers of a remote host: the batches for it, with local paths
+    """
+    def __init__(self, dispatcher, path_map):
+        self.dispatcher = dispatcher
+        self.path_map = path_map
+        self.prefixes = path_map.prefixes()
+
+    def get(self):
+        batch = self.dispatcher.get(prefixes=self.prefixes)
+        if batch is None:
+            return None
+        return [self.path_map.to_local(elem) for elem in batch]
+
+    def put(self, item):
+        # Workers put back the None they got, the end of the queue is for the walker to say
+        pass
+
+    def close(self):
+        pass
+
+
+class RemoteResults():
+    """
+    queue_data of the workers of a remote host: the results go back with the paths of the coordinator. Hashes are
+    keyed on the stat taken by the walker of the coordinator, the cache entries are valid on both sides: they are
+    kept in the cache of the host too, if it has one.
+    """
+    def __init__(self, results, path_map, hash_cache=None, forward_cache=True):
+        """
+        :param results: proxy of the results queue of the coordinator
+        :param hash_cache: HashCache of the host, or None
+        :param forward_cache: False if the coordinator has no hash cache for the entries
+        """
+        self.results = results
+        self.path_map = path_map
+        self.hash_cache = hash_cache
+        self.forward_cache = forward_cache
+
+    def put(self, item):
+        if item is not None:
+            for data in item:
+                data["path"] = self.path_map.to_coordinator(data["path"])
+                if "cache" in data:
+                    self.hash_cache.store(data["cache"])
+                    if self.forward_cache is False:
+                        del data["cache"]
+        elif self.hash_cache is not None:
+            # This worker is done
+            self.hash_cache.flush()
+        self.results.put(item)
+
+    def close(self):
+        pass
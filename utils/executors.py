@@ -0,0 +1,257 @@
+import asyncio
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+EXECUTORS = ["process", "thread", "asyncio", "inline"]
+
+
+class ProcessExecutor():
+    """
+    Each stage in its own process. Counters live in shared memory, elems and results are pickled through
+    multiprocessing queues. The only choice for CPU bound work in Python code, like parsing EXIF.
+    """
+    name = "process"
+    # work() is called in the stage threads or processes, no event loop
+    coroutines = False
+
+    def value(self, typecode):
+        """
+        :param typecode: ctypes type code, as for multiprocessing.Value
+        :return: counter with a .value attribute, shared by all the stages
+        """
+        return multiprocessing.Value(typecode, lock=False)
+
+    def array(self, typecode, size):
+        """
+        :return: fixed size sequence shared by all the stages, zeroed. 'c' gives bytes.
+        """
+        return multiprocessing.Array(typecode, size, lock=False)
+
+    def queue(self, maxsize):
+        """
+        :return: queue with put, get, empty, qsize and close
+        """
+        return multiprocessing.Queue(maxsize=maxsize)
+
+    def semaphore(self, value):
+        """
+        :return: semaphore shared by all the stages, usable with 'with'
+        """
+        return multiprocessing.Semaphore(value)
+
+    def condition(self):
+        """
+        :return: condition shared by all the stages, its lock guards the counters it waits on
+        """
+        return multiprocessing.Condition()
+
+    def process(self, target, args=()):
+        """
+        :return: stage running target(*args), with start, is_alive and join, not started
+        """
+        return multiprocessing.Process(target=target, args=args)
+
+    def shutdown(self):
+        """
+        Release what the executor holds, once all the stages are joined
+        """
+        pass
+
+
+class Counter():
+    """
+    Plain value with the interface of multiprocessing.Value, for stages sharing the memory of one process
+    """
+    def __init__(self, typecode):
+        self.value = 0.0 if typecode in ('f', 'd') else 0
+
+
+class ThreadQueue(queue.Queue):
+    """
+    queue.Queue with the interface of multiprocessing.Queue
+    """
+    def close(self):
+        pass
+
+
+class ThreadExecutor(ProcessExecutor):
+    """
+    Each stage in a thread of the main process: no pickling, no process start and one copy of everything in memory.
+    For I/O bound work, or work that releases the GIL like hashing big files.
+    Each counter slot still has a single writer, so += on them is safe without locks, as with processes.
+    """
+    name = "thread"
+
+    def value(self, typecode):
+        return Counter(typecode)
+
+    def array(self, typecode, size):
+        if typecode == 'c':
+            return bytearray(size)
+        return [0.0 if typecode in ('f', 'd') else 0] * size
+
+    def queue(self, maxsize):
+        return ThreadQueue(maxsize=maxsize)
+
+    def semaphore(self, value):
+        return threading.Semaphore(value)
+
+    def condition(self):
+        return threading.Condition()
+
+    def process(self, target, args=()):
+        # Daemon: a worker stuck on a dead mount must not keep the tool from exiting on Ctrl+C
+        return threading.Thread(target=target, args=args, daemon=True)
+
+
+class AsyncQueue():
+    """
+    Bounded queue between the event loop and the threads. Coroutines use aput/aget, threads use put/get, which
+    block the calling thread, never the loop.
+    """
+    def __init__(self, loop, maxsize):
+        self.loop = loop
+
+        async def create():
+            return asyncio.Queue(maxsize=maxsize)
+        self.queue = asyncio.run_coroutine_threadsafe(create(), loop).result()
+
+    async def aput(self, item):
+        await self.queue.put(item)
+
+    async def aget(self):
+        return await self.queue.get()
+
+    def put(self, item):
+        asyncio.run_coroutine_threadsafe(self.queue.put(item), self.loop).result()
+
+    def get(self, block=True, timeout=None):
+        if block is True:
+            # wait_for cancels the get on the loop, so that a timed out get does not take an item later
+            try:
+                return asyncio.run_coroutine_threadsafe(asyncio.wait_for(self.queue.get(), timeout),
+                                                        self.loop).result()
+            except asyncio.TimeoutError:
+                raise queue.Empty
+
+        async def get_nowait():
+            return self.queue.get_nowait()
+        try:
+            return asyncio.run_coroutine_threadsafe(get_nowait(), self.loop).result()
+        except asyncio.QueueEmpty:
+            raise queue.Empty
+
+    def empty(self):
+        return self.queue.empty()
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def close(self):
+        pass
+
+
+class Task():
+    """
+    Coroutine run on the loop of an AsyncioExecutor, with the interface of a process
+    """
+    def __init__(self, loop, target, args):
+        self.loop = loop
+        self.target = target
+        self.args = args
+        self.future = None
+
+    def start(self):
+        self.future = asyncio.run_coroutine_threadsafe(self.target(*self.args), self.loop)
+
+    def is_alive(self):
+        return self.future is not None and self.future.done() is False
+
+    def join(self):
+        self.future.result()
+
+
+class AsyncioExecutor(ThreadExecutor):
+    """
+    The workers are coroutines on one event loop, in its own thread. A coroutine work() runs on the loop, so one
+    thread can keep many slow requests in flight. A plain work() is handed to the thread pool of the loop.
+    The walker and the librarian are threads, as with ThreadExecutor.
+    """
+    name = "asyncio"
+    coroutines = True
+
+    def __init__(self, no_workers):
+        """
+        :param no_workers: threads running the plain work() calls
+        """
+        self.pool = ThreadPoolExecutor(max_workers=no_workers)
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(self.pool)
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def queue(self, maxsize):
+        return AsyncQueue(self.loop, maxsize)
+
+    def process(self, target, args=()):
+        if asyncio.iscoroutinefunction(target):
+            return Task(self.loop, target, args)
+        return super().process(target, args)
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.pool.shutdown()
+
+
+class InlineStage():
+    """
+    Stage run to the end by start(), in the calling thread, with the interface of a process
+    """
+    def __init__(self, target, args):
+        self.target = target
+        self.args = args
+
+    def start(self):
+        self.target(*self.args)
+
+    def is_alive(self):
+        return False
+
+    def join(self):
+        pass
+
+
+class InlineExecutor(ThreadExecutor):
+    """
+    No concurrency: the walker, then one worker, then the librarian, one after the other in the main thread. The
+    queues are unbounded, so each stage can put everything before the next one starts. For small jobs, where
+    starting processes or threads takes longer than the work.
+    """
+    name = "inline"
+
+    def queue(self, maxsize):
+        return ThreadQueue()
+
+    def process(self, target, args=()):
+        return InlineStage(target, args)
+
+
+def create_executor(name, no_workers):
+    """
+    :param name: one of EXECUTORS
+    :param no_workers: number of workers of the tool
+    :return: executor instance
+    """
+    if name == "process":
+        return ProcessExecutor()
+    if name == "thread":
+        return ThreadExecutor()
+    if name == "asyncio":
+        return AsyncioExecutor(no_workers)
+    if name == "inline":
+        return InlineExecutor()
+    raise ValueError("Unknown executor " + name + ", use one of " + ", ".join(EXECUTORS))
@@ -0,0 +1,244 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+# Reflinks (copy on write clones) on btrfs, XFS... Linux only
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+FICLONE = 0x40049409
+
+MOVE = "move"
+COPY = "copy"
+DELETE = "delete"
+
+
+class Operation():
+    """
+    One planned file operation. After FileOps.run: the destination actually used, how the data was copied and the
+    error if it failed.
+    """
+    def __init__(self, kind, source, destination=None, unique=False):
+        """
+        :param kind: MOVE, COPY or DELETE
+        :param source: file to move, copy or delete
+        :param destination: full path of the new file, None for DELETE
+        :param unique: if the destination exists, add _1, _2... to the name instead of replacing it
+        """
+        self.kind = kind
+        self.source = source
+        self.destination = destination
+        self.unique = unique
+        self.method = None
+        self.error = None
+
+
+def copy_data(source, destination):
+    """
+    Copy the content of a file, with the fastest way the filesystems allow: a reflink, then copy_file_range (in
+    the kernel, server side on NFS 4.2), then sendfile, then read/write. Each one goes on where the previous
+    one stopped.
+    :return: name of the last method used
+    """
+    with open(source, "rb") as fsrc, open(destination, "wb") as fdst:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return "reflink"
+            except OSError:
+                pass
+
+        size = os.fstat(fsrc.fileno()).st_size
+        copied = 0
+        method = "copy_file_range"
+        if hasattr(os, "copy_file_range"):
+            try:
+                while copied < size:
+                    sent = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied, copied, copied)
+                    if sent == 0:
+                        break
+                    copied += sent
+            except OSError:
+                # Not supported between these filesystems, or by this kernel
+                pass
+
+        if copied < size and hasattr(os, "sendfile"):
+            method = "sendfile"
+            fdst.seek(copied)
+            try:
+                while copied < size:
+                    sent = os.sendfile(fdst.fileno(), fsrc.fileno(), copied, size - copied)
+                    if sent == 0:
+                        break
+                    copied += sent
+            except OSError:
+                pass
+
+        if copied < size:
+            method = "read/write"
+            fsrc.seek(copied)
+            fdst.seek(copied)
+            shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+    return method
+
+
+class FileOps():
+    """
+    Runs a planned list of moves, copies and deletes. The operations of each destination device run in their own
+    thread pool, so a slow USB disk does not hold back the moves on the local disk.
+    Before anything runs, the destination folders are created in one go, and the names of the unique destinations
+    are chosen from one listing of each folder instead of probing each name with a stat.
+    A move is a rename when the source is on the same filesystem, a copy (see copy_data) and a delete otherwise.
+    """
+    def __init__(self, threads_per_device=4):
+        """
+        :param threads_per_device: operations running at the same time on each device, keep it low for spinning
+                                   disks
+        """
+        self.threads_per_device = threads_per_device
+        self.operations = []
+
+    def __len__(self):
+        return len(self.operations)
+
+    def move(self, source, destination, unique=False):
+        self.operations.append(Operation(MOVE, source, destination, unique))
+
+    def copy(self, source, destination, unique=False):
+        self.operations.append(Operation(COPY, source, destination, unique))
+
+    def delete(self, path):
+        self.operations.append(Operation(DELETE, path))
+
+    def prepare(self, operations):
+        """
+        Create the destination folders and pick the names of the unique destinations. The operations whose
+        folder cannot be created get their error.
+        :param operations: list of Operation
+        :return: folders created
+        """
+        created = []
+        listings = {}
+        for operation in operations:
+            if operation.destination is None:
+                continue
+            folder = os.path.dirname(operation.destination)
+            if folder not in listings:
+                try:
+                    if folder != "" and os.path.isdir(folder) is False:
+                        os.makedirs(folder, exist_ok=True)
+                        created.append(folder)
+                    listings[folder] = set(os.listdir(folder or "."))
+                except OSError as e:
+                    listings[folder] = e
+            if isinstance(listings[folder], OSError):
+                operation.error = listings[folder]
+                continue
+
+            if operation.unique is True:
+                name = os.path.basename(operation.destination)
+                split_name = os.path.splitext(name)
+                index = 1
+                while name in listings[folder]:
+                    name = split_name[0] + "_" + str(index) + split_name[1]
+                    index += 1
+                operation.destination = os.path.join(folder, name)
+            # Taken by this operation, for the next ones
+            listings[folder].add(os.path.basename(operation.destination))
+        return created
+
+    def device(self, operation):
+        """
+        :return: device the operation writes to, the device of the file for a delete
+        """
+        if operation.destination is None:
+            return os.lstat(operation.source).st_dev
+        return os.stat(os.path.dirname(operation.destination) or ".").st_dev
+
+    def execute(self, operation, device):
+        """
+        Run one operation, in a thread of the pool of its device
+        :param device: destination device
+        """
+        try:
+            if operation.kind == DELETE:
+                os.remove(operation.source)
+                operation.method = "remove"
+            elif operation.kind == MOVE and os.lstat(operation.source).st_dev == device:
+                os.rename(operation.source, operation.destination)
+                operation.method = "rename"
+            else:
+                operation.method = copy_data(operation.source, operation.destination)
+                if operation.kind == MOVE:
+                    # As shutil.move: keep the times, then drop the source
+                    shutil.copystat(operation.source, operation.destination)
+                    os.remove(operation.source)
+                else:
+                    # As shutil.copy
+                    shutil.copymode(operation.source, operation.destination)
+        except OSError as e:
+            operation.error = e
+
+    @staticmethod
+    def waves(operations):
+        """
+        Order the operations in waves: an operation writing over the source of another one runs in a later wave,
+        once that file is out of the way. Operations in a cycle get an error.
+        :param operations: list of Operation, the ones already failed are left out
+        :return: list of lists of Operation
+        """
+        waves = []
+        pending = [operation for operation in operations if operation.error is None]
+        while len(pending) > 0:
+            sources = {os.path.abspath(operation.source): operation for operation in pending}
+            wave = [operation for operation in pending if operation.destination is None or
+                    sources.get(os.path.abspath(operation.destination), operation) is operation]
+            if len(wave) == 0:
+                for operation in pending:
+                    operation.error = OSError("Circular moves, " + operation.destination + " is moved too")
+                break
+            waves.append(wave)
+            in_wave = set(id(operation) for operation in wave)
+            pending = [operation for operation in pending if id(operation) not in in_wave]
+        return waves
+
+    def run(self):
+        """
+        Run all the planned operations, then forget them
+        :return: (list of Operation in the planned order, with their error if they failed, folders created)
+        """
+        operations, self.operations = self.operations, []
+        created = self.prepare(operations)
+
+        for wave in self.waves(operations):
+            devices = {}
+            for operation in wave:
+                try:
+                    devices.setdefault(self.device(operation), []).append(operation)
+                except OSError as e:
+                    operation.error = e
+
+            pools = [ThreadPoolExecutor(max_workers=self.threads_per_device) for device in devices]
+            try:
+                for pool, (device, planned) in zip(pools, devices.items()):
+                    for operation in planned:
+                        pool.submit(self.execute, operation, device)
+            finally:
+                for pool in pools:
+                    pool.shutdown(wait=True)
+        return operations, created
+
+    def run_batches(self, operations, batch_size=10000):
+        """
+        Run operations as they come, batch_size at a time, so that a huge plan is never all in memory. The folder
+        listings are taken again for each batch, so unique names stay unique.
+        :param operations: iterable of Operation
+        :return: generator of the Operation, once run
+        """
+        for operation in operations:
+            self.operations.append(operation)
+            if len(self.operations) >= batch_size:
+                yield from self.run()[0]
+        yield from self.run()[0]
@@ -0,0 +1,165 @@
+import hashlib
+import os
+import pickle
+import struct
+import time
+import zlib
+
+MAGIC = b"HYDRAJNL"
+VERSION = 1
+
+# Every record: size of the compressed pickle that follows
+RECORD = struct.Struct("<I")
+
+DEFAULT_FOLDER = os.path.join(os.path.expanduser("~"), ".cache", "hydra", "journals")
+
+
+class Journal():
+    """
+    Append-only journal of the results stored by the librarian, to resume an interrupted run. The first record
+    describes the run (tool, target, parameters), the others are batches of (path, result), each a compressed pickle.
+    A record cut by a crash is dropped when the journal is read again.
+    """
+    def __init__(self, path, header, flush_size=1000, flush_interval=5):
+        """
+        :param path: journal file
+        :param header: dict describing the run, resuming needs the same one
+        :param flush_size: results kept in memory before writing them
+        :param flush_interval: second(s), results are written at least this often
+        """
+        self.path = path
+        self.header = header
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+
+        self.file = None
+        self.pending = []
+        self.last_flush = 0
+        # Where the last complete record ends, the rest is cut when appending
+        self.end = 0
+
+    def __getstate__(self):
+        # The file is opened by the librarian
+        state = self.__dict__.copy()
+        state['file'] = None
+        return state
+
+    @staticmethod
+    def default_path(name, target):
+        """
+        :param name: name of the tool
+        :param target: folder the tool works on
+        :return: journal file of this tool on this target, in the user cache folder so that it is not walked
+        """
+        digest = hashlib.sha1(os.path.abspath(target).encode("utf-8")).hexdigest()[:16]
+        return os.path.join(DEFAULT_FOLDER, name + "_" + digest + ".journal")
+
+    @staticmethod
+    def read_header(path):
+        """
+        :param path: journal file
+        :return: header of the run that wrote it, None if there is no journal
+        """
+        if os.path.exists(path) is False:
+            return None
+        return next(Journal(path, None).records(), None)
+
+    def records(self):
+        """
+        Read the journal, sets end
+        :return: generator of the records, the header first
+        """
+        self.end = 0
+        with open(self.path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(self.path + " is not a journal")
+            self.end = len(MAGIC)
+            while True:
+                size = f.read(RECORD.size)
+                if len(size) < RECORD.size:
+                    break
+                data = f.read(RECORD.unpack(size)[0])
+                try:
+                    record = pickle.loads(zlib.decompress(data))
+                except (zlib.error, pickle.UnpicklingError, EOFError):
+                    # Cut while written
+                    break
+                self.end = f.tell()
+                yield record
+
+    def start(self, resume=False):
+        """
+        Main side, before the run: start a new journal, or check the existing one
+        :param resume: keep what the journal has
+        :return: set of the paths already done
+        """
+        if resume is True and os.path.exists(self.path):
+            records = self.records()
+            header = next(records, None)
+            if header != dict(self.header, version=VERSION):
+                raise ValueError(self.path + " is the journal of another run: " + str(header))
+            return set(path for batch in records for path, result in batch)
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "wb") as f:
+            f.write(MAGIC)
+            f.write(self.pack(dict(self.header, version=VERSION)))
+            self.end = f.tell()
+        return set()
+
+    def replay(self):
+        """
+        Librarian side: the results already in the journal
+        :return: generator of dicts like the ones the workers send, {"path": ..., "result": ...}
+        """
+        records = self.records()
+        next(records, None)
+        for batch in records:
+            for path, result in batch:
+                yield {"path": path, "result": result}
+
+    @staticmethod
+    def pack(record):
+        data = zlib.compress(pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL), 1)
+        return RECORD.pack(len(data)) + data
+
+    def add(self, data):
+        """
+        Librarian side: journal a stored result, written in batches
+        :param data: what the worker sent
+        """
+        self.pending.append((str(data["path"]), data["result"]))
+        if len(self.pending) >= self.flush_size or time.monotonic() - self.last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the pending results and sync them to disk
+        """
+        self.last_flush = time.monotonic()
+        if len(self.pending) == 0:
+            return
+        if self.file is None:
+            self.file = open(self.path, "r+b")
+            # Drop what a crash left half written
+            self.file.truncate(self.end)
+            self.file.seek(self.end)
+        self.file.write(self.pack(self.pending))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def remove(self):
+        """
+        The run is complete, nothing to resume
+        """
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,147 @@
+from utils.walker import FileEntry
+
+
+class DeviceLanes():
+    """
+    queue_elems split on the devices of the files: one queue (lane) per device, so that a slow USB disk under the
+    target does not hold all the workers while the other disks wait.
+    The workers are not bound to a lane. Each has a home lane it takes from first, then it takes from the lane
+    with the most batches waiting. A lane is worked on by at most per_device workers at once; by default as many
+    as possible while leaving one worker to each other device that has work.
+    Devices past no_lanes share lanes.
+    """
+    def __init__(self, executor, no_lanes, maxsize, per_device=0, metrics=None):
+        """
+        :param executor: utils.executors executor of the stages
+        :param no_lanes: most lanes, one per device
+        :param maxsize: of each lane, in batches
+        :param per_device: workers on a lane at most, 0 to adapt it to the devices that have work
+        :param metrics: utils.metrics.Metrics with no_devices set, for the counters per device
+        """
+        self.no_lanes = no_lanes
+        self.per_device = per_device
+        self.metrics = metrics
+
+        self.queues = [executor.queue(maxsize) for i in range(0, no_lanes)]
+        # Guarded by cond: batches waiting and workers busy on each lane, lanes in use, workers running (they
+        # change when autoscaling)
+        self.cond = executor.condition()
+        self.no_workers = executor.value('i')
+        self.queued = executor.array('i', no_lanes)
+        self.busy = executor.array('i', no_lanes)
+        self.no_used = executor.value('i')
+        self.closed = executor.value('b')
+
+        # Walker side: device -> lane
+        self.lanes = {}
+
+    def worker_started(self):
+        """
+        Main side, when a worker is started
+        """
+        with self.cond:
+            self.no_workers.value += 1
+            self.cond.notify_all()
+
+    def worker_stopped(self):
+        """
+        Worker side, when it ends: retired or nothing left
+        """
+        with self.cond:
+            self.no_workers.value -= 1
+            self.cond.notify_all()
+
+    def lane_of(self, elem):
+        """
+        Walker side
+        :return: lane of the device of elem, a new one for a new device
+        """
+        device = elem.stat.st_dev if isinstance(elem, FileEntry) else None
+        if device not in self.lanes:
+            if self.no_used.value < self.no_lanes:
+                lane = self.no_used.value
+                with self.cond:
+                    self.no_used.value += 1
+            else:
+                lane = hash(device) % self.no_lanes
+            self.lanes[device] = lane
+            if self.metrics is not None:
+                self.metrics.device_seen(lane, device)
+        return self.lanes[device]
+
+    def put(self, batch):
+        """
+        Walker side: send the elems of a batch to the lanes of their devices. None closes all the lanes.
+        """
+        if batch is None:
+            with self.cond:
+                self.closed.value = 1
+                self.cond.notify_all()
+            return
+
+        split = {}
+        for elem in batch:
+            split.setdefault(self.lane_of(elem), []).append(elem)
+        for lane, elems in split.items():
+            if self.metrics is not None:
+                self.metrics.device_walked(lane, elems)
+            self.queues[lane].put(elems)
+            with self.cond:
+                self.queued[lane] += 1
+                self.cond.notify_all()
+
+    def pick(self, index):
+        """
+        Under cond
+        :return: lane the worker can take a batch from, None if none
+        """
+        used = range(0, self.no_used.value)
+        no_active = len([lane for lane in used if self.queued[lane] > 0 or self.busy[lane] > 0])
+        limit = self.per_device
+        if limit <= 0:
+            limit = max(1, self.no_workers.value - (no_active - 1))
+
+        ready = [lane for lane in used if self.queued[lane] > 0 and self.busy[lane] < limit]
+        if len(ready) == 0:
+            return None
+        home = index % len(used)
+        if home in ready:
+            return home
+        return max(ready, key=lambda lane: self.queued[lane])
+
+    def take(self, index):
+        """
+        Worker side: wait for a batch, release must be called once it is done
+        :param index: of the worker
+        :return: (batch, lane), (None, None) when the lanes are closed and empty
+        """
+        with self.cond:
+            while True:
+                lane = self.pick(index)
+                if lane is not None:
+                    self.queued[lane] -= 1
+                    self.busy[lane] += 1
+                    break
+                if self.closed.value == 1 and sum(self.queued) == 0:
+                    return None, None
+                self.cond.wait()
+        # Counted once put, so it is there or on its way
+        return self.queues[lane].get(), lane
+
+    def release(self, lane):
+        """
+        Worker side: done with the batch taken from lane
+        """
+        with self.cond:
+            self.busy[lane] -= 1
+            self.cond.notify_all()
+
+    def qsize(self):
+        return sum(self.queued)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def close(self):
+        for lane_queue in self.queues:
+            lane_queue.close()
@@ -0,0 +1,120 @@
+import os
+import struct
+import time
+
+from utils.walker import FileEntry
+
+# FIEMAP, physical extents of a file. Linux only
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+FS_IOC_FIEMAP = 0xC020660B
+# struct fiemap: start, length, flags, mapped extents, extent count, reserved
+FIEMAP_HEADER = struct.Struct("=QQIIII")
+# struct fiemap_extent: logical, physical, length, 2 reserved, flags, 3 reserved
+FIEMAP_EXTENT = struct.Struct("=QQQQQIIII")
+
+LAYOUTS = ["off", "auto", "inode", "extent"]
+
+# st_dev -> True/False, None if not known
+_rotational = {}
+
+
+def rotational(st_dev):
+    """
+    :param st_dev: device of a file
+    :return: True for a spinning disk, False for an SSD, None if not known (network, btrfs, not Linux...)
+    """
+    if st_dev not in _rotational:
+        _rotational[st_dev] = None
+        base = "/sys/dev/block/" + str(os.major(st_dev)) + ":" + str(os.minor(st_dev))
+        # A partition has no queue, its disk has
+        for path in (base + "/queue/rotational", base + "/../queue/rotational"):
+            try:
+                with open(path) as f:
+                    _rotational[st_dev] = f.read().strip() == "1"
+                break
+            except OSError:
+                continue
+    return _rotational[st_dev]
+
+
+def first_extent(path):
+    """
+    :return: physical offset of the beginning of a file on its disk, None if not available
+    """
+    if fcntl is None:
+        return None
+    request = bytearray(FIEMAP_HEADER.pack(0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + bytes(FIEMAP_EXTENT.size))
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, request)
+    except OSError:
+        # Not supported by the filesystem
+        return None
+    finally:
+        os.close(fd)
+    if FIEMAP_HEADER.unpack_from(request)[3] == 0:
+        # Empty, or all in the inode
+        return None
+    return FIEMAP_EXTENT.unpack_from(request, FIEMAP_HEADER.size)[1]
+
+
+class LayoutOrder():
+    """
+    Reorders the walked files so that the workers read them in the order they are on the disk: windows of files
+    are collected and sorted on their first physical extent (extent) or their inode number (inode, close to the
+    allocation order on ext4/XFS). A spinning disk then reads ahead instead of seeking between folders.
+    In auto, only the files on spinning disks are held back and sorted on their extent, the others are sent as
+    they come: an SSD does not care.
+    """
+    def __init__(self, mode, window=1024, max_delay=1.0):
+        """
+        :param mode: one of LAYOUTS but off
+        :param window: files sorted together
+        :param max_delay: second(s), a window is sent even if not complete so that the workers do not wait on a
+                          slow walk
+        """
+        self.mode = mode
+        self.window = window
+        self.max_delay = max_delay
+        self.pending = []
+        self.window_start = 0
+        self.no_sorted = 0
+
+    def key(self, elem):
+        fstat = elem.stat
+        offset = None
+        if self.mode != "inode":
+            offset = first_extent(elem)
+        # Files without extent after the others, in inode order
+        return fstat.st_dev, offset is None, offset or 0, fstat.st_ino
+
+    def add(self, elem):
+        """
+        :param elem: walked elem
+        :return: list of the elems to send now, in order
+        """
+        if isinstance(elem, FileEntry) is False or \
+                (self.mode == "auto" and rotational(elem.stat.st_dev) is not True):
+            return [elem]
+
+        if len(self.pending) == 0:
+            self.window_start = time.monotonic()
+        self.pending.append((self.key(elem), elem))
+        if len(self.pending) >= self.window or time.monotonic() - self.window_start > self.max_delay:
+            return self.flush()
+        return []
+
+    def flush(self):
+        """
+        :return: list of the elems held back, in order
+        """
+        pending, self.pending = self.pending, []
+        self.no_sorted += len(pending)
+        return [elem for key, elem in sorted(pending, key=lambda item: item[0])]
@@ -0,0 +1,307 @@
+import bisect
+import heapq
+import json
+import os
+import time
+
+from utils.executors import ProcessExecutor
+
+# Upper bounds of the work() latency histogram buckets, in seconds. One more bucket for everything slower.
+BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0)
+
+# Bytes kept of the path of the slowest files, the end of the path is kept
+PATH_SIZE = 256
+
+
+class Metrics():
+    """
+    Statistics of a Hydra run, in shared memory. Each process only writes its own slots, so nothing is locked:
+     - walker: elems and bytes sent to the workers
+     - workers: elems and bytes done, time spent in work(), work() latency histogram, slowest elems
+     - librarian: elems and bytes stored, time spent in db_insert/db_commit
+     - devices, with utils.lanes: elems and bytes sent by the walker and done by the workers, time spent, per lane
+    Queue depths are sampled by the main process, which also takes the snapshots.
+    """
+    def __init__(self, no_workers, no_slowest=10, executor=None, no_devices=0):
+        """
+        :param no_workers: number of worker processes
+        :param no_slowest: how many of the slowest elems to keep, per worker
+        :param executor: utils.executors executor the stages run with, gives the shared counters
+        :param no_devices: lanes of utils.lanes.DeviceLanes, 0 if the elems are not split on devices
+        """
+        self.no_workers = no_workers
+        self.no_devices = no_devices
+        self.no_slowest = no_slowest
+        self.start = time.time()
+
+        executor = executor or ProcessExecutor()
+        self.walker = executor.array('q', 2)                # elems, bytes
+        self.walker_done = executor.value('b')
+        self.workers = executor.array('q', 2 * no_workers)  # elems, bytes per worker
+        self.work_seconds = executor.array('d', no_workers)
+        self.histogram = executor.array('q', (len(BUCKETS) + 1) * no_workers)
+        self.librarian = executor.array('q', 2)             # elems, bytes
+        self.librarian_seconds = executor.value('d')
+        self.slowest_seconds = executor.array('d', no_slowest * no_workers)
+        self.slowest_paths = executor.array('c', PATH_SIZE * no_slowest * no_workers)
+        self.devices = executor.array('q', no_devices)                      # st_dev of each lane, -1 if none
+        self.devices_walked = executor.array('q', 2 * no_devices)           # elems, bytes per lane
+        self.devices_worked = executor.array('q', 2 * no_devices * no_workers)  # elems, bytes per worker and lane
+        self.device_seconds = executor.array('d', no_devices * no_workers)
+
+        # Worker side: index -> (seconds, slot) of the elems in the shared slots of the worker
+        self.slowest = {}
+        # Main side: previous snapshot, for the recent rates
+        self.previous = None
+
+    @staticmethod
+    def size_of(elem):
+        """
+        :return: size of the file behind an elem, if the walker attached its stat result
+        """
+        fstat = getattr(elem, "stat", None)
+        return fstat.st_size if fstat is not None else 0
+
+    def walked(self, elem):
+        self.walker[0] += 1
+        self.walker[1] += self.size_of(elem)
+
+    def walk_done(self):
+        self.walker_done.value = 1
+
+    def worked(self, index, elem, seconds):
+        """
+        Worker side: account for one call of work()
+        :param index: index of the worker
+        :param elem: what work() got
+        :param seconds: how long work() took
+        """
+        self.workers[2 * index] += 1
+        self.workers[2 * index + 1] += self.size_of(elem)
+        self.work_seconds[index] += seconds
+        self.histogram[(len(BUCKETS) + 1) * index + bisect.bisect_left(BUCKETS, seconds)] += 1
+
+        slowest = self.slowest.setdefault(index, [])
+        if len(slowest) >= self.no_slowest and seconds <= slowest[0][0]:
+            return
+        # Only for the report, it must never fail the elem. File names that are not UTF-8 come surrogate escaped
+        # from scandir, fsencode gives their bytes back.
+        try:
+            path = os.fsencode(str(elem))[-PATH_SIZE:]
+        except (UnicodeError, TypeError, ValueError):
+            path = repr(elem).encode("ascii", "backslashreplace")[-PATH_SIZE:]
+
+        if len(slowest) < self.no_slowest:
+            slot = index * self.no_slowest + len(slowest)
+            heapq.heappush(slowest, (seconds, slot))
+        else:
+            slot = heapq.heapreplace(slowest, (seconds, slowest[0][1]))[1]
+
+        self.slowest_paths[slot * PATH_SIZE:(slot + 1) * PATH_SIZE] = path.ljust(PATH_SIZE, b"\0")
+        self.slowest_seconds[slot] = seconds
+
+    def device_seen(self, lane, device):
+        """
+        Walker side: a lane got its device
+        :param device: st_dev, None for elems that are not files
+        """
+        self.devices[lane] = -1 if device is None else device
+
+    def device_walked(self, lane, elems):
+        """
+        Walker side: elems sent to a lane
+        """
+        self.devices_walked[2 * lane] += len(elems)
+        self.devices_walked[2 * lane + 1] += sum(self.size_of(elem) for elem in elems)
+
+    def device_worked(self, index, lane, elems, seconds):
+        """
+        Worker side: a batch of a lane is done
+        :param index: index of the worker
+        :param seconds: time spent on the batch
+        """
+        slot = index * self.no_devices + lane
+        self.devices_worked[2 * slot] += len(elems)
+        self.devices_worked[2 * slot + 1] += sum(self.size_of(elem) for elem in elems)
+        self.device_seconds[slot] += seconds
+
+    def stored(self, elem, seconds):
+        """
+        Librarian side: account for one stored result
+        :param elem: path of the result
+        :param seconds: time spent storing it
+        """
+        self.librarian[0] += 1
+        self.librarian[1] += self.size_of(elem)
+        self.librarian_seconds.value += seconds
+
+    def snapshot(self, queues=None):
+        """
+        Main side: collect everything
+        :param queues: dict of name -> multiprocessing.Queue, to sample their depth
+        :return: dict, see write_json
+        """
+        now = time.time()
+        elapsed = max(now - self.start, 1e-9)
+
+        stages = {
+            "walker": {"elems": self.walker[0], "bytes": self.walker[1], "busy_seconds": None},
+            "workers": {"elems": sum(self.workers[0::2]), "bytes": sum(self.workers[1::2]),
+                        "busy_seconds": sum(self.work_seconds)},
+            "librarian": {"elems": self.librarian[0], "bytes": self.librarian[1],
+                          "busy_seconds": self.librarian_seconds.value},
+        }
+        for name, stage in stages.items():
+            stage["elems_per_sec"] = stage["elems"] / elapsed
+            stage["bytes_per_sec"] = stage["bytes"] / elapsed
+            if self.previous is not None:
+                interval = max(now - self.previous["time"], 1e-9)
+                before = self.previous["stages"][name]
+                stage["recent_elems_per_sec"] = (stage["elems"] - before["elems"]) / interval
+                stage["recent_bytes_per_sec"] = (stage["bytes"] - before["bytes"]) / interval
+        stages["walker"]["done"] = self.walker_done.value == 1
+        stages["workers"]["per_worker"] = [{"elems": self.workers[2 * i], "bytes": self.workers[2 * i + 1],
+                                            "busy_seconds": self.work_seconds[i]} for i in range(self.no_workers)]
+
+        devices = []
+        for lane in range(0, self.no_devices):
+            if self.devices_walked[2 * lane] == 0:
+                continue
+            slots = range(lane, self.no_devices * self.no_workers, self.no_devices)
+            device = self.devices[lane]
+            device = {"device": "-" if device < 0 else str(os.major(device)) + ":" + str(os.minor(device)),
+                      "walked_elems": self.devices_walked[2 * lane],
+                      "walked_bytes": self.devices_walked[2 * lane + 1],
+                      "elems": sum(self.devices_worked[2 * slot] for slot in slots),
+                      "bytes": sum(self.devices_worked[2 * slot + 1] for slot in slots),
+                      "busy_seconds": sum(self.device_seconds[slot] for slot in slots)}
+            device["bytes_per_sec"] = device["bytes"] / elapsed
+            devices.append(device)
+
+        depths = {}
+        for name, queue in (queues or {}).items():
+            try:
+                depths[name] = queue.qsize()
+            except NotImplementedError:
+                # macOS
+                depths[name] = None
+
+        counts = [0] * (len(BUCKETS) + 1)
+        for i, count in enumerate(self.histogram):
+            counts[i % (len(BUCKETS) + 1)] += count
+
+        slowest = []
+        for slot, seconds in enumerate(self.slowest_seconds):
+            if seconds > 0:
+                path = self.slowest_paths[slot * PATH_SIZE:(slot + 1) * PATH_SIZE].rstrip(b"\0")
+                slowest.append({"path": path.decode("utf-8", errors="replace"), "seconds": seconds})
+        slowest = sorted(slowest, key=lambda elem: elem["seconds"], reverse=True)[:self.no_slowest]
+
+        snapshot = {
+            "time": now,
+            "elapsed": elapsed,
+            "stages": stages,
+            "devices": devices,
+            "queues": depths,
+            "work_latency": {"buckets": list(zip(list(BUCKETS) + ["+Inf"], counts)),
+                             "count": sum(counts), "sum": stages["workers"]["busy_seconds"]},
+            "slowest": slowest,
+            "eta_seconds": self.eta(stages),
+        }
+        self.previous = snapshot
+        return snapshot
+
+    @staticmethod
+    def eta(stages):
+        """
+        Time left from the bytes still to be worked on, at the recent worker speed. While the walker is still
+        running this is a lower bound.
+        :return: seconds, None if nothing was done yet
+        """
+        workers = stages["workers"]
+        rate = workers.get("recent_bytes_per_sec") or workers["bytes_per_sec"]
+        if rate <= 0:
+            return None
+        return max(0, stages["walker"]["bytes"] - workers["bytes"]) / rate
+
+    @staticmethod
+    def status(snapshot):
+        """
+        :return: short line for the console
+        """
+        workers = snapshot["stages"]["workers"]
+        rate = workers.get("recent_bytes_per_sec", workers["bytes_per_sec"])
+        line = " - %.1f MB/s" % (rate / 1e6)
+        if snapshot["eta_seconds"] is not None:
+            prefix = "" if snapshot["stages"]["walker"]["done"] is True else ">"
+            line += " - ETA " + prefix + time.strftime("%H:%M:%S", time.gmtime(snapshot["eta_seconds"]))
+        return line
+
+    @staticmethod
+    def write(snapshot, file):
+        """
+        Replace file with the snapshot: Prometheus text format if the file ends with .prom, JSON otherwise
+        """
+        if file.endswith(".prom"):
+            content = Metrics.prometheus(snapshot)
+        else:
+            content = json.dumps(snapshot, indent=1)
+
+        tmp_file = file + ".tmp"
+        with open(tmp_file, "w") as f:
+            f.write(content)
+        os.replace(tmp_file, file)
+
+    @staticmethod
+    def prometheus(snapshot):
+        """
+        :return: snapshot in the Prometheus text format, for the node exporter textfile collector
+        """
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append("# HELP " + name + " " + help_text)
+            lines.append("# TYPE " + name + " " + kind)
+            for labels, value in samples:
+                label_text = ",".join(key + '="' + str(label).replace("\\", "\\\\").replace('"', '\\"') + '"'
+                                      for key, label in labels.items())
+                lines.append(name + ("{" + label_text + "}" if label_text else "") + " " + repr(float(value)))
+
+        stages = snapshot["stages"]
+        metric("hydra_elems_total", "counter", "Elems done per stage",
+               [({"stage": name}, stage["elems"]) for name, stage in stages.items()])
+        metric("hydra_bytes_total", "counter", "Bytes of the files done per stage",
+               [({"stage": name}, stage["bytes"]) for name, stage in stages.items()])
+        metric("hydra_busy_seconds_total", "counter", "Time spent working per stage",
+               [({"stage": name}, stage["busy_seconds"]) for name, stage in stages.items()
+                if stage["busy_seconds"] is not None])
+        metric("hydra_device_elems_total", "counter", "Elems done per device",
+               [({"device": device["device"]}, device["elems"]) for device in snapshot["devices"]])
+        metric("hydra_device_bytes_total", "counter", "Bytes of the files done per device",
+               [({"device": device["device"]}, device["bytes"]) for device in snapshot["devices"]])
+        metric("hydra_device_busy_seconds_total", "counter", "Time spent by the workers per device",
+               [({"device": device["device"]}, device["busy_seconds"]) for device in snapshot["devices"]])
+        metric("hydra_device_backlog_elems", "gauge", "Elems sent to a device and not done yet",
+               [({"device": device["device"]}, device["walked_elems"] - device["elems"])
+                for device in snapshot["devices"]])
+        metric("hydra_queue_depth", "gauge", "Messages waiting in the queues",
+               [({"queue": name}, depth) for name, depth in snapshot["queues"].items() if depth is not None])
+
+        cumulative = 0
+        buckets = []
+        for bound, count in snapshot["work_latency"]["buckets"]:
+            cumulative += count
+            buckets.append(({"le": bound}, cumulative))
+        lines.append("# HELP hydra_work_seconds Time of work() per elem")
+        lines.append("# TYPE hydra_work_seconds histogram")
+        for labels, value in buckets:
+            lines.append('hydra_work_seconds_bucket{le="' + str(labels["le"]) + '"} ' + str(value))
+        lines.append("hydra_work_seconds_sum " + repr(float(snapshot["work_latency"]["sum"])))
+        lines.append("hydra_work_seconds_count " + str(snapshot["work_latency"]["count"]))
+
+        metric("hydra_slowest_work_seconds", "gauge", "Slowest elems",
+               [({"path": elem["path"]}, elem["seconds"]) for elem in snapshot["slowest"]])
+        if snapshot["eta_seconds"] is not None:
+            metric("hydra_eta_seconds", "gauge", "Estimated time left", [({}, snapshot["eta_seconds"])])
+
+        return "\n".join(lines) + "\n"
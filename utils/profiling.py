@@ -0,0 +1,116 @@
+import cProfile
+import glob
+import io
+import os
+import pstats
+import threading
+
+# Optional sampling profiler, lower overhead and shows where the time goes in C code too
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+MODES = ["cprofile", "sampling"]
+
+
+class Profiled():
+    """
+    Process target running another target under a profiler. The stats are dumped to
+    <profile_dir>/<stage>_<pid>.prof (cProfile) or .txt (sampling), when the target returns. In a thread, the
+    thread id follows the pid.
+    """
+    def __init__(self, target, stage, profile_dir, mode="cprofile", args=()):
+        """
+        :param target: function run by the process
+        :param stage: name of the stage, groups the processes in the report (walker, worker, librarian...)
+        :param profile_dir: where to dump the stats
+        :param mode: cprofile, or sampling if pyinstrument is installed
+        :param args: arguments for target
+        """
+        self.target = target
+        self.stage = stage
+        self.profile_dir = profile_dir
+        self.mode = mode
+        self.args = args
+
+    def __call__(self):
+        file = os.path.join(self.profile_dir, self.stage + "_" + str(os.getpid()))
+        if threading.current_thread() is not threading.main_thread():
+            file += "-" + str(threading.get_native_id())
+
+        if self.mode == "sampling" and pyinstrument is not None:
+            profiler = pyinstrument.Profiler()
+            profiler.start()
+            try:
+                return self.target(*self.args)
+            finally:
+                profiler.stop()
+                with open(file + ".txt", "w") as f:
+                    f.write(profiler.output_text(unicode=False, color=False))
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python 3.12+ runs one cProfile at a time per process, the other threads go unprofiled
+            return self.target(*self.args)
+        try:
+            return self.target(*self.args)
+        finally:
+            profiler.disable()
+            profiler.dump_stats(file + ".prof")
+
+
+def profile_call(function, profile_dir, stage="main", mode="cprofile"):
+    """
+    Profile a function in the current process, same dump as Profiled
+    :return: what function returned
+    """
+    return Profiled(function, stage, profile_dir, mode)()
+
+
+def merge_profiles(profile_dir, report_file=None, no_lines=30):
+    """
+    Merge the stats dumped by all the processes into one report, with one section per stage: all the workers
+    together, then the walker, the librarian...
+    :param profile_dir: folder given to Profiled
+    :param report_file: where to write the report, default report.txt in profile_dir
+    :param no_lines: functions listed per stage and per sort order
+    :return: path of the report
+    """
+    if report_file is None:
+        report_file = os.path.join(profile_dir, "report.txt")
+
+    stages = {}
+    for file in sorted(glob.glob(os.path.join(profile_dir, "*.prof")) + glob.glob(os.path.join(profile_dir, "*.txt"))):
+        name = os.path.basename(file)
+        if file == report_file:
+            continue
+        stages.setdefault(name.rsplit("_", 1)[0], []).append(file)
+
+    with open(report_file, "w") as report:
+        for stage, files in stages.items():
+            prof_files = [file for file in files if file.endswith(".prof")]
+            report.write("=" * 100 + "\n")
+            report.write("Stage " + stage + ": " + str(len(files)) + " process(es)\n")
+            report.write("=" * 100 + "\n")
+
+            if len(prof_files) > 0:
+                output = io.StringIO()
+                stats = pstats.Stats(*prof_files, stream=output)
+                stats.strip_dirs()
+                output.write("Total time: %.3fs\n" % stats.total_tt)
+                for sort in ("cumulative", "tottime"):
+                    output.write("\n--- by " + sort + "\n")
+                    stats.sort_stats(sort).print_stats(no_lines)
+                report.write(output.getvalue())
+
+            # Sampling reports cannot be merged, they are appended as they are
+            for file in files:
+                if file.endswith(".txt"):
+                    with open(file) as f:
+                        report.write("\n--- " + os.path.basename(file) + "\n" + f.read())
+            report.write("\n")
+
+    return report_file
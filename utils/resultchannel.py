@@ -0,0 +1,134 @@
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+import weakref
+
+# On disk: TMPDIR is often a tmpfs, which would put the results back in memory
+DEFAULT_FOLDER = os.path.join(os.path.expanduser("~"), ".cache", "hydra")
+
+
+def remove_files(path, owner_pid):
+    # Copies of the channel in the other processes must not remove it
+    if os.getpid() != owner_pid:
+        return
+    for file in (path, path + "-wal", path + "-shm"):
+        try:
+            os.unlink(file)
+        except FileNotFoundError:
+            pass
+
+
+class ResultChannel():
+    """
+    Results for the main process, in a temporary sqlite file instead of memory. Any stage can put results, they are
+    written in batches. The main process reads them once the stages are done, lazily, in the order they were put
+    or sorted on a key, so memory stays bounded whatever the size of the job.
+    The file is removed when the channel is garbage collected in the process that created it.
+    """
+    def __init__(self, folder=None, flush_size=10000):
+        """
+        :param folder: where to create the file, default the user cache folder
+        :param flush_size: results kept in memory before writing them
+        """
+        self.flush_size = flush_size
+        self.pending = []
+
+        if folder is None:
+            folder = DEFAULT_FOLDER
+        os.makedirs(folder, exist_ok=True)
+
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+        fd, self.path = tempfile.mkstemp(prefix="hydra_results_", suffix=".db", dir=folder)
+        os.close(fd)
+        weakref.finalize(self, remove_files, self.path, os.getpid())
+
+        conn = sqlite3.connect(self.path)
+        # WAL lets several stages write
+        conn.execute("PRAGMA journal_mode=WAL")
+        # Keys are the bytes of the paths: any file name fits, and they sort as the UTF-8 strings do
+        conn.execute("CREATE TABLE results (seq INTEGER PRIMARY KEY, key BLOB, value BLOB)")
+        conn.commit()
+        conn.close()
+
+    def __getstate__(self):
+        # Connections belong to the process/thread that opened them
+        state = self.__dict__.copy()
+        del state['local']
+        del state['lock']
+        state['pending'] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def connection(self):
+        """
+        One connection per process and thread, opened on first use
+        :return: sqlite3 connection
+        """
+        conns = getattr(self.local, 'conns', None)
+        if conns is None:
+            conns = self.local.conns = {}
+        if os.getpid() not in conns:
+            conns[os.getpid()] = sqlite3.connect(self.path, timeout=60)
+        return conns[os.getpid()]
+
+    def put(self, value, key=None):
+        """
+        Send a result to the main process, written with the next batch
+        :param value: anything that can be pickled
+        :param key: optional string to sort the results on
+        """
+        if key is not None:
+            # Surrogate escaped names (not UTF-8) get their bytes back
+            key = os.fsencode(key)
+        with self.lock:
+            self.pending.append((key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)))
+            full = len(self.pending) >= self.flush_size
+        if full is True:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the pending results. Each stage putting results must call it before it ends.
+        """
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+        if len(pending) == 0:
+            return
+        conn = self.connection()
+        with conn:
+            conn.executemany("INSERT INTO results (key, value) VALUES (?, ?)", pending)
+
+    def __len__(self):
+        return self.connection().execute("SELECT count(*) FROM results").fetchone()[0]
+
+    def __iter__(self):
+        """
+        :return: generator of the results, in the order they were written
+        """
+        return self.read("SELECT value FROM results ORDER BY seq")
+
+    def sorted(self, reverse=False):
+        """
+        :param reverse: highest keys first
+        :return: generator of the results sorted on their key, in the order they were written for the same key
+        """
+        conn = self.connection()
+        with conn:
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_results_key ON results (key, seq)")
+        if reverse is True:
+            return self.read("SELECT value FROM results ORDER BY key DESC, seq")
+        return self.read("SELECT value FROM results ORDER BY key, seq")
+
+    def read(self, query):
+        # Own cursor, so that the results can be read again while iterating
+        for value, in self.connection().execute(query):
+            yield pickle.loads(value)
@@ -0,0 +1,218 @@
+import collections
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class FileEntry(str):
+    """
+    Path of a walked file, carrying the stat result taken by the walker. Behaves as the plain path everywhere.
+    """
+    def __new__(cls, path, fstat):
+        entry = super().__new__(cls, path)
+        entry.stat = fstat
+        return entry
+
+    def __reduce__(self):
+        # Only what is needed to rebuild the stat result, it goes through the queues for every file
+        return _rebuild_entry, (str(self), tuple(self.stat)[:10],
+                                (self.stat.st_atime_ns, self.stat.st_mtime_ns, self.stat.st_ctime_ns))
+
+
+def _rebuild_entry(path, fields, times_ns):
+    extra = {'st_atime_ns': times_ns[0], 'st_mtime_ns': times_ns[1], 'st_ctime_ns': times_ns[2],
+             'st_atime': times_ns[0] / 1e9, 'st_mtime': times_ns[1] / 1e9, 'st_ctime': times_ns[2] / 1e9}
+    return FileEntry(path, os.stat_result(fields, extra))
+
+
+def file_stat(path):
+    """
+    :param path: plain path or FileEntry
+    :return: stat result of the file, without a system call if the walker already did it
+    """
+    if isinstance(path, FileEntry):
+        return path.stat
+    return os.stat(path)
+
+
+def count_files(top, limit):
+    """
+    Count what is in a folder and its subfolders, without taking the stat of the files
+    :param top: folder to count
+    :param limit: stop counting past this
+    :return: number of entries that are not folders, at most limit + 1
+    """
+    count = 0
+    dirs = [top]
+    while len(dirs) > 0:
+        try:
+            with os.scandir(dirs.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                        continue
+                    count += 1
+                    if count > limit:
+                        return count
+        except OSError:
+            # The walker reports it
+            continue
+    return count
+
+
+def scan_tree(top, ordered=True, errors=None):
+    """
+    Walk a folder with os.scandir. The stat of each file follows symlinks, like os.stat. Symlinks to folders
+    are not followed, like os.walk.
+    :param top: folder to walk
+    :param ordered: sort files and folders by name, files of a folder come before its subfolders
+    :param errors: optional list, collects (path, exception) for what could not be read
+    :return: generator of (path, stat result), stat result is None if it could not be taken
+    """
+    dirs = [top]
+    while len(dirs) > 0:
+        current = dirs.pop()
+        try:
+            with os.scandir(current) as it:
+                entries = list(it)
+        except OSError as e:
+            if errors is not None:
+                errors.append((current, e))
+            continue
+
+        if ordered is True:
+            entries.sort(key=lambda entry: entry.name)
+
+        subdirs = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                    continue
+                if entry.is_symlink() and entry.is_dir():
+                    continue
+                yield entry.path, entry.stat()
+            except OSError as e:
+                # Broken symlink, file removed in the meantime...
+                if errors is not None:
+                    errors.append((entry.path, e))
+                yield entry.path, None
+
+        # Stack: push in reverse, so the first folder is walked first
+        dirs.extend(reversed(subdirs))
+
+
+def walk_tree(top, no_walkers=1, ordered=True, errors=None):
+    """
+    Same as scan_tree, but the subfolders of top are walked in parallel by no_walkers threads.
+    scandir and stat release the GIL, so this helps on slow storage (NFS, USB disks).
+    :param top: folder to walk
+    :param no_walkers: number of threads
+    :param ordered: keep the order of scan_tree. The subfolders walked ahead wait in bounded queues.
+    :param errors: optional list, collects (path, exception) for what could not be read
+    :return: generator of (path, stat result)
+    """
+    try:
+        with os.scandir(top) as it:
+            entries = list(it)
+    except OSError as e:
+        if errors is not None:
+            errors.append((top, e))
+        return
+
+    subdirs = [entry.path for entry in entries if entry.is_dir(follow_symlinks=False)]
+    subdirs_set = set(subdirs)
+    if no_walkers <= 1 or len(subdirs) < 2:
+        yield from scan_tree(top, ordered, errors)
+        return
+
+    # Files directly in top, then the subfolders
+    if ordered is True:
+        entries.sort(key=lambda entry: entry.name)
+        subdirs.sort()
+    for entry in entries:
+        if entry.path in subdirs_set:
+            continue
+        try:
+            if entry.is_symlink() and entry.is_dir():
+                continue
+            yield entry.path, entry.stat()
+        except OSError as e:
+            if errors is not None:
+                errors.append((entry.path, e))
+            yield entry.path, None
+
+    stop = threading.Event()
+
+    def scan(d, out):
+        # Chunks of the subfolder in out, None when it is done
+        chunk = []
+        try:
+            for elem in scan_tree(d, ordered, errors):
+                if stop.is_set():
+                    return
+                chunk.append(elem)
+                if len(chunk) >= 256:
+                    out.put(chunk)
+                    chunk = []
+        finally:
+            out.put(chunk)
+            out.put(None)
+
+    def drain(future, out):
+        # Unblock a thread still trying to put something
+        while not future.done():
+            try:
+                out.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    with ThreadPoolExecutor(max_workers=no_walkers) as pool:
+        if ordered is True:
+            # The next no_walkers subfolders are walked ahead, each into its own bounded queue. The first one goes
+            # out while it is walked, the next one is started once it is done.
+            remaining = iter(subdirs)
+            walked = collections.deque()
+
+            def walk_next():
+                d = next(remaining, None)
+                if d is not None:
+                    out = queue.Queue(maxsize=16)
+                    walked.append((pool.submit(scan, d, out), out))
+
+            for i in range(0, no_walkers):
+                walk_next()
+            try:
+                while len(walked) > 0:
+                    future, out = walked[0]
+                    for chunk in iter(out.get, None):
+                        yield from chunk
+                    # Errors of the walker thread
+                    future.result()
+                    walked.popleft()
+                    walk_next()
+            finally:
+                stop.set()
+                for future, out in walked:
+                    drain(future, out)
+            return
+
+        # Unordered: whatever is found first goes first
+        found = queue.Queue(maxsize=64)
+        futures = [pool.submit(scan, d, found) for d in subdirs]
+        pending = len(futures)
+        try:
+            while pending > 0:
+                chunk = found.get()
+                if chunk is None:
+                    pending -= 1
+                    continue
+                yield from chunk
+            # Errors of the walker threads
+            for future in futures:
+                future.result()
+        finally:
+            stop.set()
+            for future in futures:
+                drain(future, found)